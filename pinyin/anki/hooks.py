@@ -9,6 +9,7 @@ import sqlalchemy
 import weakref
 
 import pinyin.anki.keys
+import pinyin.dictionary
 import pinyin.factproxy
 from pinyin.logger import log
 import pinyin.media
@@ -290,6 +291,8 @@ class MassFillHook(ToolMenuHook):
         
         # For good measure, mark the deck as modified as well (see #105)
         self.mw.deck.setModified()
+        
+        log.info("Dictionary lookup cache statistics after the fill: %r", pinyin.dictionary.lookupcachestats())
     
         # DEBUG consider future feature to add missing measure words cards after doing so (not now)
         self.notifier.info(self.__class__.notification)
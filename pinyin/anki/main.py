@@ -9,6 +9,7 @@ import shutil
 import pinyin.config
 from pinyin.db import *
 import pinyin.db.builder
+import pinyin.db.image
 import pinyin.forms.builddb
 import pinyin.forms.builddbcontroller
 from pinyin.logger import log
@@ -67,6 +68,9 @@ class PinyinToolkit(object):
             # Initialize the configuration with the stored settings
             config = pinyin.config.Config(settings)
         
+        # Now we know how the user wants the database opened, make sure it happens that way
+        pinyin.db.setreadoptimised(config.readoptimiseddatabase)
+        
         # Build the updaters
         updaters = {
             'expression' : pinyin.updater.FieldUpdaterFromExpression,
@@ -86,42 +90,47 @@ class PinyinToolkit(object):
         self.registerStandardModels()
     
     def tryCreateAndLoadDatabase(self, mw, notifier):
-        datatimestamp, satisfiers = pinyin.db.builder.getSatisfiers()
-        cjklibtimestamp = os.path.getmtime(pinyin.utils.toolkitdir("pinyin", "vendor", "cjklib", "cjklib", "build", "builder.py"))
+        # Put in place any database that we built last time but couldn't install while it was in use
+        try:
+            installstaged([dbpath] + [pinyin.db.image.imagepath(tablename) for tablename in pinyin.db.image.imagetables])
+        except ValueError:
+            # Already logged: we'll just have to build it again
+            pass
         
-        if not(os.path.exists(dbpath)):
-            # MUST rebuild - DB doesn't exist
-            log.info("The database was missing entirely from %s. We had better build it!", dbpath)
-            compulsory = True
-        elif os.path.getmtime(dbpath) < cjklibtimestamp:
-            # MUST rebuild - version upgrade might have changed DB format
-            log.info("The cjklib was upgraded at %d, which is since the database was built (at %d) - for safety we must rebuild", cjklibtimestamp, os.path.getmtime(dbpath))
-            compulsory = True
-        elif os.path.getmtime(dbpath) < datatimestamp:
-            # SHOULD rebuild
-            log.info("The database had a timestamp of %d but we saw a data update at %d - let's rebuild", os.path.getmtime(dbpath), datatimestamp)
-            compulsory = False
-        else:
-            # Do nothing
-            log.info("Database up to date")
-            compulsory = None
+        # NB: this compares the content hashes of the inputs with those recorded when we built the database,
+        # but only hashes those files whose size or modification time has changed since then
+        satisfiers = pinyin.db.builder.getSatisfiers()
+        compulsory = pinyin.db.builder.needsRebuild(dbpath, satisfiers)
         
-        if compulsory is not None:
-            # We at least have the option to rebuild the DB: setup the builder
+        if compulsory:
+            # We have to build the database before the Toolkit can do anything. Show the form, which kicks off the builder
             dbbuilder = pinyin.db.builder.DBBuilder(satisfiers)
-            
-            # Show the form, which kicks off the builder and may give the user the option to cancel
             builddb = pinyin.forms.builddb.BuildDB(mw)
             # NB: VERY IMPORTANT to save the useless controller reference somewhere. This prevents the
             # QThread it spawns being garbage collected while the thread is still running! I hate PyQT4!
             _controller = pinyin.forms.builddbcontroller.BuildDBController(builddb, notifier, dbbuilder, compulsory)
             if builddb.exec_() == QDialog.Accepted:
-                # Successful completion of the build process: replace the existing database, if any
-                shutil.copyfile(dbbuilder.builtdatabasepath, dbpath)
-            elif compulsory:
+                # Successful completion of the build process: install the database
+                try:
+                    installed = installdatabase(dbbuilder.installedfiles)
+                except ValueError:
+                    notifier.exception("The Pinyin Toolkit database was built, but it failed its integrity check!")
+                    return False
+                
+                if not(installed):
+                    # The database we have won't do, so we can't carry on with it until the new one is in place
+                    notifier.info("The Pinyin Toolkit database was built, but the old one is in use (perhaps by another copy of Anki) so it couldn't be replaced. "
+                                  "The Toolkit is disabled until it can install the new database, which it will try again the next time Anki starts.")
+                    return False
+            else:
                 # Eeek! The dialog was "rejected" despite being compulsory. This can only happen if there
                 # was an error while building the database. Better give up now!
                 return False
+        elif compulsory is not None:
+            # The database we have will do for now, so rebuild whatever tables in it are out of date in the background,
+            # and swap the result in once it's ready. NB: keep hold of the controller, just like above
+            dbbuilder = pinyin.db.builder.DBBuilder(satisfiers, dbpath)
+            self.backgroundbuild = pinyin.forms.builddbcontroller.BackgroundBuildDBController(mw, notifier, dbbuilder, lambda: installdatabase(dbbuilder.installedfiles))
         
         # Finally, force the database connection to the (possibly fresh) DB to begin
         database()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+import math
+import os
+import struct
+
+try:
+    from hashlib import md5
+except ImportError:
+    # Python 2.4 only has the deprecated md5 module
+    from md5 import new as md5
+
+import db
+from logger import log
+
+
+"""
+Hashes the text into four 32 bit numbers, all from one md5 digest. Double hashing needs two numbers for
+each key, so that is enough for two different keys derived from the same text.
+"""
+def texthashes(text):
+    return struct.unpack("<IIII", md5(text.encode("utf-8")).digest())
+
+
+"""
+A Bloom filter: a compact set that may claim to contain things it doesn't (with a false
+positive rate fixed when we create it), but never forgets something that was added to it.
+"""
+class BloomFilter(object):
+    def __init__(self, numbits, numhashes, bits=None):
+        self.numbits = numbits
+        self.numhashes = numhashes
+        self.bits = bits or array.array('B', [0]) * ((numbits + 7) // 8)
+    
+    """
+    Creates an empty filter big enough to hold the given number of items at the false positive rate.
+    """
+    @classmethod
+    def forcapacity(cls, capacity, falsepositiverate):
+        # Standard formulae for the optimal size and number of hash functions
+        capacity = max(capacity, 1)
+        numbits = max(8, int(math.ceil(-capacity * math.log(falsepositiverate) / (math.log(2) ** 2))))
+        return cls(numbits, max(1, int(round(float(numbits) / capacity * math.log(2)))))
+    
+    def add(self, what):
+        first, second = texthashes(what)[0:2]
+        self.addhashed(first, second)
+    
+    def __contains__(self, what):
+        first, second = texthashes(what)[0:2]
+        return self.containshashed(first, second)
+    
+    # Double hashing: derive all of our hash functions from a pair of hashes of the key. NB: these are the
+    # innermost loop of segmenting text, so we step through the positions rather than building a list of them
+    def addhashed(self, first, second):
+        bits, numbits = self.bits, self.numbits
+        position, step = first % numbits, (second | 1) % numbits
+        for _n in range(self.numhashes):
+            bits[position >> 3] |= 1 << (position & 7)
+            position = (position + step) % numbits
+    
+    def containshashed(self, first, second):
+        bits, numbits = self.bits, self.numbits
+        position, step = first % numbits, (second | 1) % numbits
+        for _n in range(self.numhashes):
+            if not(bits[position >> 3] & (1 << (position & 7))):
+                return False
+            position = (position + step) % numbits
+        
+        return True
+
+"""
+A prefix index of dictionary headwords, with the same interface as a Trie, backed by a Bloom filter.
+Both isprefix and __contains__ can produce false positives, which the dictionary tolerates because
+it always confirms words with the source before using them.
+
+The filter can be persisted to disk along with a stamp recording what it was built from.
+"""
+class PrefixBloomFilter(object):
+    # Bump the version if you change the layout of the file, or how we hash the words into it
+    magic = "PTKBLOM2"
+    
+    headerformat = "<8sIII"
+    headersize = struct.calcsize(headerformat)
+    
+    def __init__(self, bloomfilter, maxwordlen):
+        self.bloomfilter = bloomfilter
+        self.maxwordlen = maxwordlen
+        
+        # The text we hashed last, and its hashes. Segmenting asks whether some text is a word right after asking
+        # whether it is a prefix, so this saves hashing it again
+        self.lasthashed = (None, None)
+    
+    @classmethod
+    def fromwords(cls, words, falsepositiverate):
+        # Every prefix of a word (including the word itself) gets a prefix key, and the word gets a word key
+        # as well. We hash each text only once, and use two of its hashes for each kind of key
+        prefixhashes, wordhashes = {}, {}
+        maxwordlen = 0
+        for word in words:
+            for prefixlen in range(1, len(word) + 1):
+                prefix = word[:prefixlen]
+                if prefix not in prefixhashes:
+                    prefixhashes[prefix] = texthashes(prefix)
+            wordhashes[word] = prefixhashes[word]
+            maxwordlen = max(maxwordlen, len(word))
+        
+        bloomfilter = BloomFilter.forcapacity(len(prefixhashes) + len(wordhashes), falsepositiverate)
+        for hashes in prefixhashes.values():
+            bloomfilter.addhashed(hashes[0], hashes[1])
+        for hashes in wordhashes.values():
+            bloomfilter.addhashed(hashes[2], hashes[3])
+        
+        return cls(bloomfilter, maxwordlen)
+    
+    def hashes(self, text):
+        lasttext, lasthashes = self.lasthashed
+        if lasttext == text:
+            return lasthashes
+        
+        hashes = texthashes(text)
+        self.lasthashed = (text, hashes)
+        return hashes
+    
+    def isprefix(self, text):
+        hashes = self.hashes(text)
+        return self.bloomfilter.containshashed(hashes[0], hashes[1])
+    
+    def __contains__(self, word):
+        hashes = self.hashes(word)
+        return self.bloomfilter.containshashed(hashes[2], hashes[3])
+    
+    """
+    Persist the filter at the path. We write it alongside and rename it into place, so that if we are
+    interrupted we leave the old filter (or none) rather than half of a new one.
+    """
+    def save(self, path, stamp):
+        def write(file):
+            file.write(struct.pack(self.headerformat, self.magic, self.bloomfilter.numbits, self.bloomfilter.numhashes, self.maxwordlen))
+            file.write(struct.pack("<I", len(stamp)))
+            file.write(stamp)
+            file.write(self.bloomfilter.bits.tostring())
+        
+        db.writereplacing(path, write)
+    
+    """
+    Load the filter persisted at the path, or return None if there isn't one built from the same stamp,
+    or what is there is truncated or otherwise not a filter we could use.
+    """
+    @classmethod
+    def load(cls, path, stamp):
+        if not(os.path.exists(path)):
+            return None
+        
+        file = open(path, "rb")
+        try:
+            header = file.read(cls.headersize)
+            if len(header) != cls.headersize:
+                log.warn("Ignoring the truncated prefix filter at %s", path)
+                return None
+            
+            magic, numbits, numhashes, maxwordlen = struct.unpack(cls.headerformat, header)
+            if magic != cls.magic:
+                log.warn("Ignoring unrecognised prefix filter at %s", path)
+                return None
+            
+            stamplength = file.read(4)
+            if len(stamplength) != 4 or file.read(struct.unpack("<I", stamplength)[0]) != stamp:
+                log.info("The prefix filter at %s is out of date", path)
+                return None
+            
+            bits = array.array('B')
+            bits.fromstring(file.read())
+        finally:
+            file.close()
+        
+        if numbits <= 0 or numhashes <= 0 or len(bits) != (numbits + 7) // 8:
+            log.warn("Ignoring the truncated or corrupt prefix filter at %s", path)
+            return None
+        
+        return cls(BloomFilter(numbits, numhashes, bits), maxwordlen)
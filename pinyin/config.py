@@ -22,6 +22,17 @@ defaultsettings = {
     "version" : 1,
 
     "dictlanguage" : "en",
+    
+    # How many dictionary lookups to remember for each dictionary language. Set to 0 to disable the cache
+    "dictionarycachesize" : 20000,
+    
+    # The proportion of non-words that the in-memory headword index lets through to the dictionary database.
+    # Lower rates mean fewer wasted queries but a bigger index
+    "dictionaryfalsepositiverate" : 0.01,
+    
+    # Should we open the dictionary database in a mode tuned for reading (memory mapped, lock free)? Turn this off
+    # if you see problems opening the database, to go back to SQLite's defaults
+    "readoptimiseddatabase" : True,
 
     "colorizedpinyingeneration"    : True, # Should we try and write readings and measure words that include colorized pinyin?
     "colorizedcharactergeneration" : True, # Should we try and fill out a field called Color with a colored version of the character?
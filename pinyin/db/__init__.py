@@ -1,10 +1,274 @@
+import os
+import shutil
+import tempfile
+import urllib
+
 import cjklib.dbconnector
 import sqlalchemy
 
+# NB: use the same DB-API module as SQLAlchemy does, so our connections look just like the ones it makes
+try:
+    from pysqlite2 import dbapi2 as sqlite
+except ImportError:
+    import sqlite3 as sqlite
+
+from pinyin.db.pool import ConnectionPool
 import pinyin.utils
 from pinyin.logger import log
 
 
 dbpath = pinyin.utils.toolkitdir("pinyin", "db", "cjklib.db")
 
-database = pinyin.utils.Thunk(lambda: cjklib.dbconnector.DatabaseConnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) }))
+# Whether new connections are opened by connectreadoptimised rather than with SQLite's defaults.
+# This follows the "readoptimiseddatabase" setting: change it with setreadoptimised
+readoptimised = True
+
+# Pragmas for every connection the Toolkit reads the database through: nothing it does at runtime
+# should write to it. Versions of SQLite that predate any of these pragmas just ignore them
+readonlypragmas = [("query_only", "ON")]
+
+# Pragmas for a database that nobody writes to while we have it open, on top of those
+readoptimisedpragmas = readonlypragmas + [
+    ("mmap_size", 256 * 1024 * 1024), # Read pages straight out of the operating system's page cache
+    ("cache_size", -8192),            # 8MB of page cache for each connection (negative sizes are in KB)
+    ("temp_store", "MEMORY")          # Sorting for DISTINCT and the like needn't touch the disk
+  ]
+
+"""
+Opens a connector to the database at the path with SQLite's default settings.
+"""
+def connectdefault(path):
+    return cjklib.dbconnector.DatabaseConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=path) })
+
+"""
+Opens a connector to the database at the path with SQLite's default settings, except that it refuses to write.
+"""
+def connectreadonly(path):
+    return connectwithpragmas(path, path, readonlypragmas)
+
+"""
+Opens a connector to the database at the path, tuned for a database we only ever read from.
+
+Where SQLite understands URI filenames we also open the file as immutable, so that SQLite takes no
+locks and never checks for a hot journal. That saves several trips to the file system when we open
+the database and run the first query, which is very noticeable when the Toolkit lives on a network
+drive. The price is that the file must not change underneath an open connection: replace the file
+and reset the pool instead.
+"""
+def connectreadoptimised(path):
+    if urifilenamessupported():
+        filename = "file:" + urllib.pathname2url(utf8path(os.path.abspath(path))) + "?mode=ro&immutable=1"
+    else:
+        log.info("This SQLite doesn't understand URI filenames, so we can't open the database as immutable")
+        filename = path
+    
+    return connectwithpragmas(path, filename, readoptimisedpragmas)
+
+"""
+Opens a connector to the database at the path by opening the filename (which may be a URI for the path) and
+applying the pragmas to each connection.
+"""
+def connectwithpragmas(path, filename, pragmas):
+    def creator():
+        connection = sqlite.connect(filename)
+        for pragma, value in pragmas:
+            connection.execute("PRAGMA %s = %s" % (pragma, value))
+        
+        return connection
+    
+    # NB: the URL still tells SQLAlchemy which dialect to use, but the creator makes the actual connections
+    return cjklib.dbconnector.DatabaseConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=path), "sqlalchemy.creator" : creator })
+
+def connect():
+    if readoptimised:
+        return connectreadoptimised(dbpath)
+    else:
+        return connectreadonly(dbpath)
+
+"""
+Switch the read-optimised open mode on or off. Threads pick up the new mode the next time they
+use the database.
+"""
+def setreadoptimised(enabled):
+    global readoptimised
+    
+    if readoptimised != enabled:
+        log.info("Switching the read-optimised database open mode %s", enabled and "on" or "off")
+        readoptimised = enabled
+        database.reset()
+
+"""
+Reports whether SQLite will interpret a filename starting with file: as a URI. We can't ask for that
+explicitly through the Python 2 DB-API module, so it depends on how the library was compiled. If it
+wasn't compiled that way, the URI would be taken as the name of a new, empty database!
+"""
+def urifilenamessupported():
+    if sqlite.sqlite_version_info < (3, 7, 7):
+        return False
+    
+    try:
+        connection = sqlite.connect(":memory:")
+        try:
+            compileoptions = [row[0] for row in connection.execute("PRAGMA compile_options")]
+        finally:
+            connection.close()
+    except sqlite.Error, e:
+        log.warn("Couldn't ask SQLite how it was compiled: %s", e)
+        return False
+    
+    return "USE_URI" in compileoptions or "USE_URI=1" in compileoptions
+
+"""
+Checks that the database at the path is intact, raising a ValueError if it isn't.
+"""
+def checkintegrity(path):
+    try:
+        connection = sqlite.connect(path)
+        try:
+            problems = [row[0] for row in connection.execute("PRAGMA integrity_check")]
+        finally:
+            connection.close()
+    except sqlite.DatabaseError, e:
+        # A file that is truncated or isn't a database at all may not even get as far as the check
+        problems = [unicode(e)]
+    
+    if problems != [u"ok"]:
+        raise ValueError("The database at %s failed its integrity check: %s" % (path, "; ".join(problems)))
+
+"""
+Installs a freshly built database (and any files that go with it, like the dictionary images) in place
+of the current one, while the Toolkit carries on using the current one. The files are (built path,
+installed path) pairs, with the database first.
+
+We copy the files in next to the ones they replace, check the copy of the database, and only then rename
+each of them over the one it replaces. Renaming is atomic, so a connection always sees either all of the
+old database or all of the new one, and one that is open (or a mapped image) keeps reading the old file.
+We finish by resetting the pool, so each thread reopens the database the next time it uses it.
+
+Windows won't let us replace a file that is open. If that happens, we leave the copies where they are and
+installstaged puts them in place when the Toolkit next starts, before anything opens the database. We return
+whether we installed the new database now.
+"""
+def installdatabase(files):
+    # NB: copy the database last, so that its copy being intact means we have all the others, but make sure
+    # the copies of the rest are no older than it, or they won't be used in preference to the database
+    for builtpath, path in files[1:] + files[:1]:
+        log.info("Copying the built %s in next to the one it replaces", os.path.basename(path))
+        shutil.copyfile(builtpath, stagedpath(path))
+    
+    for _builtpath, path in files[1:]:
+        os.utime(stagedpath(path), None)
+    
+    return installstaged([path for _builtpath, path in files])
+
+"""
+Renames the copies of the files left by installdatabase over the files they replace, if the copy of the database
+(the first file) is there and intact. Where we can't replace a file that is open, we first move every file we are
+replacing out of the way, and only start installing once they have all gone: if one of them won't move, we put back
+the ones that did and try again next time, so we never pair a new image with the old database or vice versa.
+We return whether we installed a new database, which we don't if there wasn't one.
+"""
+def installstaged(paths):
+    if not(os.path.exists(stagedpath(paths[0]))):
+        return False
+    
+    try:
+        checkintegrity(stagedpath(paths[0]))
+    except ValueError, e:
+        log.error("Discarding the new database rather than installing it: %s", e)
+        for path in paths:
+            if os.path.exists(stagedpath(path)):
+                os.remove(stagedpath(path))
+        raise
+    
+    replacing = [path for path in paths if os.path.exists(stagedpath(path))]
+    try:
+        moveaside(replacing)
+    except OSError, e:
+        log.warn("Couldn't replace the database while it is in use, so it will be replaced next time: %s", e)
+        return False
+    
+    # NB: rename the database last, so that if we are interrupted part way through we try again next time
+    for path in replacing[1:] + replacing[:1]:
+        renameover(stagedpath(path), path)
+    
+    for path in replacing:
+        if os.path.exists(asidepath(path)):
+            os.remove(asidepath(path))
+    
+    log.info("Installed the new database")
+    database.reset()
+    return True
+
+def stagedpath(path):
+    return path + ".new"
+
+def asidepath(path):
+    return path + ".old"
+
+# Whether renaming a file over another one works even if the one it replaces is open. It doesn't on Windows
+replacesopenfiles = os.name != "nt"
+
+"""
+Gets the files at the paths out of the way of the files that will replace them, if we can't just rename over them.
+Either all of them move, or none of them do and we raise the OSError that stopped us.
+"""
+def moveaside(paths):
+    if replacesopenfiles:
+        return
+    
+    moved = []
+    try:
+        for path in paths:
+            if os.path.exists(path):
+                # This fails if anyone has the file open (or mapped), which is what we want to find out
+                os.rename(path, asidepath(path))
+                moved.append(path)
+    except OSError:
+        for path in moved:
+            os.rename(asidepath(path), path)
+        raise
+
+"""
+Renames the file at the source path to the target path, replacing whatever is there.
+"""
+def renameover(source, target):
+    if not(replacesopenfiles) and os.path.exists(target):
+        # Windows won't rename over an existing file, so we get it out of the way first. This fails if anyone has
+        # the file open (which is why we can't do this while the Toolkit is running), but it can't lose the file
+        os.remove(target)
+    
+    os.rename(source, target)
+
+"""
+Replaces the file at the path with whatever the write function writes to the file it is given. That file is a new one
+alongside the path, which we only rename over the path once it is complete, so nothing is lost if we are interrupted.
+"""
+def writereplacing(path, write):
+    handle, temppath = tempfile.mkstemp(prefix=os.path.basename(path) + ".", dir=os.path.dirname(os.path.abspath(path)))
+    output = os.fdopen(handle, "wb")
+    try:
+        try:
+            write(output)
+        finally:
+            output.close()
+    except:
+        os.remove(temppath)
+        raise
+    
+    # NB: temporary files are only readable by their owner, but we want whatever permissions the old file had
+    if os.path.exists(path):
+        shutil.copymode(path, temppath)
+    else:
+        os.chmod(temppath, 0644)
+    
+    renameover(temppath, path)
+
+def utf8path(path):
+    if isinstance(path, unicode):
+        return path.encode("utf-8")
+    else:
+        return path
+
+# NB: we don't use getDBConnector because it hands out a single shared connector, and we want one per thread
+database = ConnectionPool(connect)
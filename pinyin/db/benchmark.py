@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import sys
+import time
+
+import sqlalchemy
+
+import pinyin.db
+
+
+"""
+Compares opening and querying the dictionary database with SQLite's default settings against the
+read-optimised mode. Run it from the directory containing the pinyin package:
+
+  python -m pinyin.db.benchmark [path to database] [rounds] [lookups]
+
+For each mode we time opening a fresh connection together with the first query on it (which is what
+the user waits for when the Toolkit starts), followed by a batch of headword lookups like the ones a
+dictionary makes. The operating system caches the file after the first round, so to see the effect on
+a cold start or on a network drive point the benchmark at a database on that drive.
+"""
+
+modes = [("default", pinyin.db.connectdefault),
+         ("read-optimised", pinyin.db.connectreadoptimised)]
+
+def sampleheadwords(path, lookups):
+    connector = pinyin.db.connectdefault(path)
+    try:
+        headwords = [row[0] for row in connector.selectRows(sqlalchemy.text("SELECT HeadwordSimplified FROM CEDICT"))]
+    finally:
+        connector.connection.close()
+    
+    # NB: seed the generator so that every run of the benchmark looks up the same words
+    return random.Random(0).sample(headwords, min(lookups, len(headwords)))
+
+def timemode(path, connect, headwords):
+    started = time.time()
+    connector = connect(path)
+    try:
+        connector.selectScalar(sqlalchemy.text("SELECT COUNT(*) FROM sqlite_master"))
+        opened = time.time()
+        
+        query = sqlalchemy.text("SELECT Reading, Translation FROM CEDICT WHERE HeadwordSimplified = :headword OR HeadwordTraditional = :headword")
+        for headword in headwords:
+            connector.connection.execute(query, headword=headword).fetchall()
+        finished = time.time()
+    finally:
+        connector.connection.close()
+        connector.engine.dispose()
+    
+    return opened - started, finished - opened
+
+def benchmark(path, rounds, lookups):
+    headwords = sampleheadwords(path, lookups)
+    
+    timings = dict([(name, []) for name, _connect in modes])
+    for round in range(rounds):
+        # Alternate which mode goes first so that neither gets all the benefit of a warm file cache
+        if round % 2 == 0:
+            roundmodes = modes
+        else:
+            roundmodes = list(reversed(modes))
+        
+        for name, connect in roundmodes:
+            timings[name].append(timemode(path, connect, headwords))
+    
+    print "%d rounds of opening %s and looking up %d headwords" % (rounds, path, len(headwords))
+    for name, _connect in modes:
+        opens, queries = [[timing[n] for timing in timings[name]] for n in range(2)]
+        print "%-15s first query: best %7.2fms, median %7.2fms    lookups: best %7.2fms, median %7.2fms" % \
+                (name, 1000 * min(opens), 1000 * median(opens), 1000 * min(queries), 1000 * median(queries))
+
+def median(xs):
+    xs = sorted(xs)
+    return xs[len(xs) // 2]
+
+if __name__ == "__main__":
+    path = len(sys.argv) > 1 and sys.argv[1] or pinyin.db.dbpath
+    rounds = len(sys.argv) > 2 and int(sys.argv[2]) or 10
+    lookups = len(sys.argv) > 3 and int(sys.argv[3]) or 1000
+    
+    benchmark(path, rounds, lookups)
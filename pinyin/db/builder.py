@@ -1,18 +1,506 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import cjklib
 import cjklib.build
+import cjklib.build.builder
 import cjklib.dbconnector
+import codecs
 import re
 import shutil
 import sqlalchemy
+import sys
 import tempfile
+import time
 import os
 import zipfile
 
+try:
+    import multiprocessing
+except ImportError:
+    # Only Python 2.6 and later have it, so on earlier versions we can only build in one process
+    multiprocessing = None
+
+try:
+    import resource
+except ImportError:
+    # Windows doesn't have it, so we can't say how much memory a build took there
+    resource = None
+
 from pinyin.logger import log
+import pinyin.db
+import pinyin.db.image
+import pinyin.db.schema
 import pinyin.utils
 
 
+# Indexes for the queries we make at runtime, on top of the ones cjklib creates. cjklib indexes each headword
+# column on its own, which lets SQLite answer the OR in our lookups with one index for each side, but loading
+# the headwords for the prefix index still has to read every translation. Indexing the headword pairs turns that
+# into a scan of a covering index, and serves the lookups just as well.
+#
+# We don't add (Headword, Reading, Translation) indexes: they would store a second copy of every translation,
+# roughly doubling the size of the database, to save one row fetch per matching entry. CharacterPinyin needs
+# nothing, because its primary key already covers (ChineseCharacter, Reading).
+runtimeindexes = dict([(tablename, [["HeadwordSimplified", "HeadwordTraditional"], ["HeadwordTraditional", "HeadwordSimplified"]])
+                       for tablename in ["CEDICT", "CFDICT", "HanDeDict"]])
+
+def createRuntimeIndexes(database):
+    for tablename, indexkeys in runtimeindexes.items():
+        if not(database.hasTable(tablename)):
+            log.info("Not indexing the missing table %s", tablename)
+            continue
+        
+        for indexcolumns in indexkeys:
+            # NB: name the indexes the same way that cjklib does
+            indexname = tablename + "__" + "_".join(indexcolumns)
+            log.info("Creating index %s", indexname)
+            database.execute('CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)' % (indexname, tablename, ", ".join(['"%s"' % column for column in indexcolumns])))
+    
+    # Gather the statistics the query planner needs to choose between the indexes
+    log.info("Analyzing the database")
+    database.execute("ANALYZE")
+
+# The files each group of tables is built from, so that we know which groups to rebuild when some of them
+# change. The other groups are built from the data that comes with cjklib, and only change along with it
+groupinputs = {
+    "CEDICT"          : ["cedict_ts.u8"],
+    "CFDICT"          : ["cfdict.u8"],
+    "HanDeDict"       : ["handedict.u8"],
+    "CharacterPinyin" : ["characterpinyin.tsv", "Unihan.txt"]
+  }
+
+# The inputs we can do without, as long as we have all of the inputs they are listed with. We only need the full Unihan
+# database if we don't have the character readings that trimunihan extracts from it
+optionalinputs = {
+    "characterpinyin.tsv" : [],
+    "Unihan.txt"          : ["characterpinyin.tsv"]
+  }
+
+# Bump this whenever a change to how we build the database changes what ends up in it
+builderversion = 1
+
+# The tables in the built database recording what each group of tables was built from, and the
+# content hashes of the input files along with the size and modification time they had
+manifesttable = "PinyinToolkitManifest"
+inputstable = "PinyinToolkitInputs"
+
+# The entry in the manifest that records the version of the builder rather than a group of tables
+builderkey = "(builder)"
+
+"""
+Identifies everything about the way we build the database that could change its contents: our own
+builder version, and the code of the cjklib builders, which we identify by content rather than by
+version so that it changes with any patch we make to our copy of cjklib.
+"""
+def builderStamp():
+    cjklibbuilderpath = os.path.splitext(cjklib.build.builder.__file__)[0] + ".py"
+    if os.path.exists(cjklibbuilderpath):
+        cjklibstamp = pinyin.utils.filemd5(cjklibbuilderpath)
+    else:
+        # Probably frozen into an executable, with no source to hand
+        cjklibstamp = getattr(cjklib, "__version__", None)
+    
+    return repr((builderversion, cjklibstamp))
+
+"""
+Works out a stamp for each of the groups, identifying everything it is built from: the content hashes
+of its input files, the version of the schema and the builder stamp. A group whose stamp hasn't changed
+doesn't need rebuilding.
+"""
+def groupStamps(groups, inputhashes, builderstamp=None):
+    return dict([(group, repr(([(requirement, inputhashes.get(requirement)) for requirement in groupinputs.get(group, [])], pinyin.db.schema.schemaversion, builderstamp)))
+                 for group in groups])
+
+"""
+Reads the manifest of the database at the path as a dictionary from group name (or the builder key) to stamp.
+We return an empty manifest if there is no database there, or it predates manifests.
+"""
+def readManifest(path):
+    return dict(readManifestTable(path, "SELECT TableGroup, Stamp FROM %s" % manifesttable))
+
+"""
+Reads what we knew about the input files when we built the database at the path, as a dictionary from the
+name of the file to its signature (modification time and size) and its content hash.
+"""
+def readKnownInputs(path):
+    # NB: SQLite gives the hashes back as unicode, but they must have the same repr as the str ones we compute
+    return dict([(name, ((modified, size), str(hash))) for name, modified, size, hash in readManifestTable(path, "SELECT Name, Modified, Size, Hash FROM %s" % inputstable)])
+
+def readManifestTable(path, query):
+    if path is None or not(os.path.exists(path)):
+        return []
+    
+    connection = pinyin.db.sqlite.connect(path)
+    try:
+        try:
+            return connection.execute(query).fetchall()
+        except pinyin.db.sqlite.OperationalError, e:
+            log.info("Couldn't read the manifest of the database at %s, so it probably predates them: %s", path, e)
+            return []
+    finally:
+        connection.close()
+
+"""
+Records the stamps of the groups (and the builder), and what we know about the input files, which the
+satisfiers should have passed to contenthash already.
+"""
+def writeManifest(database, stamps, satisfiers):
+    database.execute("DROP TABLE IF EXISTS %s" % manifesttable)
+    database.execute("CREATE TABLE %s (TableGroup VARCHAR(255) PRIMARY KEY, Stamp TEXT)" % manifesttable)
+    for group, stamp in stamps.items():
+        database.execute(sqlalchemy.text("INSERT INTO %s VALUES (:group, :stamp)" % manifesttable), group=group, stamp=stamp)
+    
+    database.execute("DROP TABLE IF EXISTS %s" % inputstable)
+    database.execute("CREATE TABLE %s (Name VARCHAR(255) PRIMARY KEY, Modified REAL, Size INTEGER, Hash VARCHAR(255))" % inputstable)
+    for _requirement, sourcefile, _satisfier in satisfiers:
+        modified, size = sourcefile.signature()
+        database.execute(sqlalchemy.text("INSERT INTO %s VALUES (:name, :modified, :size, :hash)" % inputstable), name=sourcefile.name, modified=modified, size=size, hash=sourcefile.hash)
+
+"""
+Works out the stamps we would give the groups we want if we built them from the satisfiers right now.
+"""
+def currentStamps(satisfiers, knowninputs):
+    builderstamp = builderStamp()
+    stamps = groupStamps(DBBuilder.wantgroups, dict([(requirement, sourcefile.contenthash(knowninputs)) for requirement, sourcefile, _satisfier in satisfiers]), builderstamp)
+    stamps[builderkey] = builderstamp
+    return stamps
+
+"""
+Decides what to do about the database at the path on startup: returns None if it is up to date, True if we
+must rebuild it from scratch, or False if we should rebuild some of it.
+"""
+def needsRebuild(path, satisfiers):
+    if not(os.path.exists(path)):
+        log.info("The database was missing entirely from %s. We had better build it!", path)
+        return True
+    
+    manifest = readManifest(path)
+    stamps = currentStamps(satisfiers, readKnownInputs(path))
+    if builderkey in manifest and manifest[builderkey] != stamps[builderkey]:
+        # MUST rebuild - a new version of the builder might have changed the database format
+        log.info("The database was built by a different version of the builder - for safety we must rebuild")
+        return True
+    
+    stalegroups = staleGroups(DBBuilder.wantgroups, manifest, stamps)
+    if len(stalegroups) > 0:
+        # SHOULD rebuild
+        log.info("The inputs for the tables %s have changed since the database was built - let's rebuild", stalegroups)
+        return False
+    
+    log.info("Database up to date")
+    return None
+
+def staleGroups(groups, manifest, stamps):
+    return [group for group in groups if manifest.get(group) != stamps[group]]
+
+# Groups of tables that don't depend on each other, so that we can build each set in its own worker process.
+# The groups built from cjklib's own data are quick to build, so they share a worker
+independentgroups = [["CEDICT"], ["CFDICT"], ["HanDeDict"], ["CharacterPinyin"], ["PinyinSyllables", "PinyinInitialFinal"]]
+
+# Whether builders farm the build out to worker processes when they can. We don't by default, because the Toolkit builds
+# from a Qt thread inside Anki, and fork()ing a process with other threads running (and Qt's state) isn't safe. Building
+# from the command line (with --parallel) is, and the DBBuilder can be told to
+parallelbuild = False
+
+"""
+Reports whether we can farm the build out to worker processes. We insist on a fork()ing platform: elsewhere
+multiprocessing starts workers by running the main script again, which would be Anki itself, and that doesn't
+work from a frozen executable either. There's also no point with only one processor to share the work.
+"""
+def canBuildInParallel():
+    return multiprocessing is not None and hasattr(os, "fork") and not(hasattr(sys, "frozen")) and multiprocessing.cpu_count() > 1
+
+"""
+Splits the groups up into the jobs for the worker processes: one for each set of independent groups.
+"""
+def parallelJobs(groups):
+    jobs = [[group for group in independent if group in groups] for independent in independentgroups]
+    return [job for job in jobs if len(job) > 0]
+
+def makeCjkDatabaseBuilder(database, datapath):
+    return cjklib.build.DatabaseBuilder(
+        dbConnectInst=database,
+        # We need to turn quiet on, because Anki throws a hissy fit if you write to stderr
+        # We turn disableFTS3 on because it makes my SELECTs 4 times faster on SQLite 3.4.0
+        quiet=True, enableFTS3=False, rebuildExisting=False, noFail=False,
+        dataPath=datapath,
+        prefer=['CharacterVariantBMPBuilder', 'CombinedStrokeCountBuilder',
+                'CombinedCharacterResidualStrokeCountBuilder',
+                'HanDeDictFulltextSearchBuilder', 'UnihanBMPBuilder'])
+
+"""
+The work done by each worker process in a parallel build: build the groups into a database of their own, and
+report how long that took.
+"""
+def buildGroupsInto(job):
+    path, groups, datapath = job
+    
+    log.info("Building the tables %s into %s", groups, path)
+    started = time.time()
+    database = cjklib.dbconnector.DatabaseConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=path) })
+    try:
+        makeCjkDatabaseBuilder(database, datapath).build(groups)
+    finally:
+        database.connection.close()
+        database.engine.dispose()
+    
+    return time.time() - started
+
+"""
+Copies the tables in the database at the part path, along with their indexes, into the database at the path.
+"""
+def mergeDatabase(path, partpath):
+    log.info("Merging the tables built into %s", partpath)
+    connection = pinyin.db.sqlite.connect(path)
+    try:
+        # NB: we can't ATTACH in the middle of a transaction, so manage them ourselves
+        connection.isolation_level = None
+        connection.execute("ATTACH DATABASE ? AS part", (partpath,))
+        try:
+            connection.execute("BEGIN")
+            try:
+                schema = connection.execute("SELECT type, name, sql FROM part.sqlite_master WHERE type IN ('table', 'index') AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%'").fetchall()
+                
+                # Fill the tables before creating the indexes, which is faster than maintaining them as we go
+                for type, name, sql in schema:
+                    if type == "table":
+                        connection.execute(sql)
+                        connection.execute('INSERT INTO main."%s" SELECT * FROM part."%s"' % (name, name))
+                
+                for type, name, sql in schema:
+                    if type == "index":
+                        connection.execute(sql)
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            
+            connection.execute("COMMIT")
+        finally:
+            connection.execute("DETACH DATABASE part")
+    finally:
+        connection.close()
+
+"""
+Returns the rows of the table for compiling into an image, as writeimage wants them. The image keeps the entries for
+each headword in the order we give them, so we give them in the order of the dictionary file, just as the runtime
+queries against the database do.
+"""
+def imageRows(database, tablename):
+    table = pinyin.db.schema.metadata.tables[tablename]
+    fileorder = [pinyin.db.schema.fileorder(table)]
+    if tablename == "CharacterPinyin":
+        return [(character, character, reading, u"") for character, reading in database.selectRows(sqlalchemy.select([table.c.ChineseCharacter, table.c.Reading], order_by=fileorder))]
+    else:
+        return database.selectRows(sqlalchemy.select([table.c.HeadwordSimplified, table.c.HeadwordTraditional, table.c.Reading, table.c.Translation], order_by=fileorder))
+
+# The dictionaries in CEDICT format, which we can import ourselves much faster than cjklib's builders (which insert
+# them a row at a time, each in its own transaction). We don't by default, but the DBBuilder can be told to
+nativedictionaries = ["CEDICT", "CFDICT", "HanDeDict"]
+nativeimport = False
+
+"""
+Imports the CEDICT format dictionary at the source path into a new table in the database at the path, building
+exactly the table (and indexes) that cjklib would. We stream the entries into a single transaction and only
+index the table once it is full.
+"""
+def importDictionary(path, tablename, sourcepath):
+    log.info("Importing %s into the %s table", sourcepath, tablename)
+    connection = pinyin.db.sqlite.connect(path)
+    try:
+        connection.isolation_level = None
+        connection.execute("BEGIN")
+        try:
+            connection.execute('CREATE TABLE "%s" ("HeadwordTraditional" VARCHAR(255), "HeadwordSimplified" VARCHAR(255), "Reading" VARCHAR(255) COLLATE NOCASE, "Translation" TEXT COLLATE NOCASE)' % tablename)
+            connection.executemany('INSERT INTO "%s" VALUES (?, ?, ?, ?)' % tablename, dictionaryEntries(sourcepath))
+            
+            for column in ["HeadwordTraditional", "HeadwordSimplified", "Reading"]:
+                connection.execute('CREATE INDEX "%s__%s" ON "%s" ("%s")' % (tablename, column, tablename, column))
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+"""
+Generates the (traditional, simplified, reading, translation) entries of the CEDICT format dictionary at the path,
+reading it a line at a time. We parse the lines just like cjklib does, so that we get the same entries it would.
+"""
+def dictionaryEntries(path):
+    entryregex = cjklib.build.builder.CEDICTFormatBuilder.ENTRY_REGEX
+    
+    file = codecs.open(path, "r", "utf-8")
+    try:
+        for line in file:
+            if line.lstrip().startswith("#"):
+                continue
+            
+            match = entryregex.match(line)
+            if match:
+                yield match.groups()
+            elif line.strip() != "":
+                log.warn("Skipping a line of %s that doesn't look like a dictionary entry: %r", path, line)
+    finally:
+        file.close()
+
+"""
+Imports the character readings that trimunihan extracted from the Unihan database (in the file at the source path)
+into a new CharacterPinyin table in the database at the path, just like the one cjklib builds from the full database.
+"""
+def importCharacterPinyin(path, sourcepath):
+    log.info("Importing %s into the CharacterPinyin table", sourcepath)
+    connection = pinyin.db.sqlite.connect(path)
+    try:
+        connection.isolation_level = None
+        connection.execute("BEGIN")
+        try:
+            connection.execute('CREATE TABLE "CharacterPinyin" ("ChineseCharacter" VARCHAR(1) NOT NULL, "Reading" VARCHAR(255) NOT NULL, PRIMARY KEY ("ChineseCharacter", "Reading"))')
+            connection.executemany('INSERT INTO "CharacterPinyin" VALUES (?, ?)', characterReadings(sourcepath))
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+"""
+Generates the (character, reading) pairs in the file of character readings at the path, which has a line for each
+character: the character, a tab, and its readings separated by spaces.
+"""
+def characterReadings(path):
+    file = codecs.open(path, "r", "utf-8")
+    try:
+        for line in file:
+            if line.startswith("#"):
+                continue
+            
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) != 2:
+                if line.strip() != "":
+                    log.warn("Skipping a line of %s that doesn't look like character readings: %r", path, line)
+                continue
+            
+            character, readings = fields
+            for reading in readings.split():
+                yield character, reading
+    finally:
+        file.close()
+
+# The phases of a build, in the order they happen, as they are named in its timings
+buildphases = ["Planning", "Copying", "Importing", "Building", "Indexing", "Compiling images"]
+
+"""
+Returns the most memory that this process (or the largest of the worker processes it has waited for) has had
+resident at once so far, in bytes, or None if we can't tell.
+"""
+def peakMemory():
+    if resource is None:
+        return None
+    
+    peak = max([resource.getrusage(who).ru_maxrss for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]])
+    if sys.platform == "darwin":
+        # Mac OS X reports it in bytes, and everyone else in kilobytes
+        return peak
+    else:
+        return peak * 1024
+
+"""
+How long one phase of a build, or building one table (or the image of one), took. Any of the rows, the bytes of
+input read and the peak memory may be None if they don't apply or we couldn't measure them.
+"""
+class Timing(object):
+    def __init__(self, kind, name, seconds, rows=None, bytesread=None, peakmemory=None):
+        self.kind = kind
+        self.name = name
+        self.seconds = seconds
+        self.rows = rows
+        self.bytesread = bytesread
+        self.peakmemory = peakmemory
+    
+    def rowsPerSecond(self):
+        if self.rows is None or self.seconds <= 0:
+            return None
+        else:
+            return self.rows / self.seconds
+    
+    def __str__(self):
+        measurements = ["%.2fs" % self.seconds]
+        if self.rows is not None:
+            measurements.append("%d rows" % self.rows)
+        if self.rowsPerSecond() is not None:
+            measurements.append("%.0f rows/s" % self.rowsPerSecond())
+        if self.bytesread is not None:
+            measurements.append("%.1fMB read" % (self.bytesread / 1048576.0))
+        if self.peakmemory is not None:
+            measurements.append("peak memory %.1fMB" % (self.peakmemory / 1048576.0))
+        
+        return "%s %s: %s" % (self.name, self.kind, ", ".join(measurements))
+
+"""
+Collects the timings of a build as it goes, logging each one and passing it to the progress callback (if any) as
+soon as it is done. A phase lasts until the next one starts, and adds up the rows and bytes of the tables built in it.
+"""
+class BuildTimings(object):
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.timings = []
+        self.started = time.time()
+        self.phasename = None
+    
+    def phase(self, name):
+        self.finishPhase()
+        
+        log.info("Starting the %s phase of the build", name)
+        self.phasename = name
+        self.phasestarted = time.time()
+        self.phaserows = None
+        self.phasebytesread = None
+    
+    def read(self, bytesread):
+        self.phasebytesread = addCounts(self.phasebytesread, bytesread)
+    
+    def table(self, name, seconds, rows=None, bytesread=None, kind="table"):
+        self.phaserows = addCounts(self.phaserows, rows)
+        self.read(bytesread)
+        self.record(Timing(kind, name, seconds, rows, bytesread, peakMemory()))
+    
+    def finishPhase(self):
+        if self.phasename is None:
+            return
+        
+        self.record(Timing("phase", self.phasename, time.time() - self.phasestarted, self.phaserows, self.phasebytesread, peakMemory()))
+        self.phasename = None
+    
+    def finish(self):
+        self.finishPhase()
+        log.info("Built the database in %.2fs", time.time() - self.started)
+    
+    def record(self, timing):
+        log.info("Build timing: %s", timing)
+        self.timings.append(timing)
+        if self.progress is not None:
+            self.progress(timing)
+
+def addCounts(total, count):
+    if total is None:
+        return count
+    elif count is None:
+        return total
+    else:
+        return total + count
+
+"""
+Counts the rows of the table in the database at the path.
+"""
+def countRows(path, tablename):
+    connection = pinyin.db.sqlite.connect(path)
+    try:
+        return connection.execute('SELECT COUNT(*) FROM "%s"' % tablename).fetchone()[0]
+    finally:
+        connection.close()
+
 class DBBuilder(object):
     wantgroups = [
         # Dictionaries - do NOT include the _Words tables: we want the full meanings only:
@@ -24,13 +512,32 @@ class DBBuilder(object):
         #'LocaleCharacterVariant', 'StrokeCount', 'ComponentLookup',
         #'CharacterVariant', 'ZVariants'
       ]
-
+    
     cjkdatapath = pinyin.utils.toolkitdir("pinyin", "vendor", "cjklib", "cjklib", "data")
-
+    
     builtdatabasepath = property(lambda self: os.path.join(self.dictionarydatapath, "cjklib.db"))
-
-    def __init__(self, satisfiers):
+    builtimagepaths = property(lambda self: [(tablename, os.path.join(self.dictionarydatapath, pinyin.db.image.imagefilename(tablename))) for tablename in pinyin.db.image.imagetables])
+    
+    # The (built path, installed path) pairs to give to pinyin.db.installdatabase once we've built them
+    installedfiles = property(lambda self: [(self.builtdatabasepath, pinyin.db.dbpath)] + [(builtimagepath, pinyin.db.image.imagepath(tablename)) for tablename, builtimagepath in self.builtimagepaths])
+    
+    """
+    The satisfiers are (requirement, source file, satisfier) triples, as returned by getSatisfiers. If we are given
+    an existing database, we only rebuild the groups of tables in it whose inputs have changed since it was
+    built, and take the rest (along with their images) as they are.
+    
+    Unless told otherwise, we only build independent groups of tables in parallel if the parallelbuild flag is set
+    (and we can), and leave importing the dictionaries to cjklib unless the nativeimport flag is set.
+    """
+    def __init__(self, satisfiers, existingdatabasepath=None, parallel=None, native=None):
         self.satisfiers = satisfiers
+        self.existingdatabasepath = existingdatabasepath
+        if parallel is None:
+            parallel = parallelbuild
+        self.parallel = parallel and canBuildInParallel()
+        if native is None:
+            native = nativeimport
+        self.native = native
         self.dictionarydatapath = tempfile.mkdtemp()
         self.cjkdbbuilder = None
     
@@ -41,35 +548,223 @@ class DBBuilder(object):
         except IOError:
             pass
     
-    def build(self):
-        # [1/4]: copy and extract necessary files into a location cjklib can deal with
+    """
+    Builds the database and its images in our temporary directory. If given a progress callback, we call it with
+    the Timing of each phase of the build, and of each table and image we build, as soon as it is done.
+    """
+    def build(self, progress=None):
+        self.timings = BuildTimings(progress)
+        
+        # [1/7]: work out what needs building, and start from what we can keep of the existing database
+        self.timings.phase("Planning")
+        stamps = currentStamps(self.satisfiers, readKnownInputs(self.existingdatabasepath))
+        stalegroups = staleGroups(DBBuilder.wantgroups, readManifest(self.existingdatabasepath), stamps)
+        if len(stalegroups) < len(DBBuilder.wantgroups):
+            log.info("Rebuilding only the tables %s of the existing database", stalegroups)
+            self.copyExistingDatabase(stalegroups)
+        else:
+            log.info("Building every table from scratch")
+        
+        # [2/7]: copy and extract the files we need into a location cjklib can deal with. We only need the ones that
+        # the stale groups are built from, but we can't say what ungrouped inputs are for, so take those regardless
+        self.timings.phase("Copying")
         log.info("Copying in dictionary data")
-        for requirement, satisfier in self.satisfiers:
-            satisfier(os.path.join(self.dictionarydatapath, requirement))
+        neededrequirements = set(pinyin.utils.concat([groupinputs.get(group, []) for group in stalegroups]))
+        for requirement, _stamp, satisfier in self.satisfiers:
+            if requirement in neededrequirements or requirement not in pinyin.utils.concat(groupinputs.values()):
+                target = os.path.join(self.dictionarydatapath, requirement)
+                satisfier(target)
+                self.timings.read(os.path.getsize(target))
         
-        # [2/4]: setup the database builder with a standard set of requirements
-        log.info("Initializing builder")
-        database = cjklib.dbconnector.DatabaseConnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=self.builtdatabasepath) })
-        self.cjkdbbuilder = cjklib.build.DatabaseBuilder(
-            dbConnectInst=database,
-            # We need to turn quiet on, because Anki throws a hissy fit if you write to stderr
-            # We turn disableFTS3 on because it makes my SELECTs 4 times faster on SQLite 3.4.0
-            quiet=True, enableFTS3=False, rebuildExisting=False, noFail=False,
-            dataPath=[self.dictionarydatapath, self.cjkdatapath],
-            prefer=['CharacterVariantBMPBuilder', 'CombinedStrokeCountBuilder',
-                    'CombinedCharacterResidualStrokeCountBuilder',
-                    'HanDeDictFulltextSearchBuilder', 'UnihanBMPBuilder'])
-        
-        # [3/4]: build the database
+        # [3/7]: import the dictionaries ourselves if we've been asked to, and the character readings if we have them
+        # without the full Unihan database. Then build what we can of the rest in worker processes, each into its own
+        # database, and merge the results
+        self.timings.phase("Importing")
+        nativegroups = []
+        if self.native:
+            nativegroups.extend(nativedictionaries)
+        if "characterpinyin.tsv" in [requirement for requirement, _sourcefile, _satisfier in self.satisfiers]:
+            nativegroups.append("CharacterPinyin")
+        
+        for group in stalegroups:
+            if group in nativegroups:
+                self.importNatively(group)
+        
+        cjklibgroups = [group for group in stalegroups if group not in nativegroups]
+        jobs = parallelJobs(cjklibgroups)
+        if self.parallel and len(jobs) > 1:
+            self.buildInParallel(jobs)
+            cjklibgroups = []
+        
+        # [4/7]: setup the database builder with a standard set of requirements, and build whatever is left of the
+        # database. NB: the builder skips tables that already exist, which are the ones we kept or built in parallel.
+        # We build each set of independent groups separately so that we can time them (just like the workers do)
+        self.timings.phase("Building")
         log.info("Building the cjklib database: the target file is %s", self.builtdatabasepath)
-        self.cjkdbbuilder.build(DBBuilder.wantgroups)
+        database = cjklib.dbconnector.DatabaseConnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=self.builtdatabasepath) })
+        self.cjkdbbuilder = makeCjkDatabaseBuilder(database, [self.dictionarydatapath, self.cjkdatapath])
+        for job in parallelJobs(DBBuilder.wantgroups):
+            started = time.time()
+            self.cjkdbbuilder.build(job)
+            if len([group for group in job if group in cjklibgroups]) > 0:
+                self.timeTables(job, time.time() - started)
+        
+        # [5/7]: check that we got the tables the Toolkit expects, index them for the lookups we do at runtime, and record what we built them from
+        self.timings.phase("Indexing")
+        pinyin.db.schema.verifySchema(database)
+        createRuntimeIndexes(database)
+        writeManifest(database, stamps, self.satisfiers)
+        
+        # [6/7]: compile the tables we look words up in into read-only images that can be mmapped at runtime
+        self.timings.phase("Compiling images")
+        log.info("Compiling dictionary images")
+        for tablename, imagepath in self.builtimagepaths:
+            if tablename not in stalegroups and self.copyExistingImage(tablename, imagepath):
+                continue
+            
+            started = time.time()
+            rows = imageRows(database, tablename)
+            pinyin.db.image.writeimage(imagepath, rows)
+            self.timings.table(tablename, time.time() - started, len(rows), kind="image")
         
-        # [4/4]: clean up, so that we don't get errors if (when) the temporary database is deleted
+        # [7/7]: clean up, so that we don't get errors if (when) the temporary database is deleted
         database.connection.close()
         del database.connection
         database.engine.dispose()
         del database.engine
+        
+        self.timings.finish()
+    
+    def importNatively(self, group):
+        started = time.time()
+        if group == "CharacterPinyin":
+            sourcepath = os.path.join(self.dictionarydatapath, "characterpinyin.tsv")
+            importCharacterPinyin(self.builtdatabasepath, sourcepath)
+        else:
+            sourcepath = os.path.join(self.dictionarydatapath, groupinputs[group][0])
+            importDictionary(self.builtdatabasepath, group, sourcepath)
+        
+        self.timings.table(group, time.time() - started, countRows(self.builtdatabasepath, group), os.path.getsize(sourcepath))
+    
+    def buildInParallel(self, jobs):
+        log.info("Building the tables %s in parallel", jobs)
+        partpaths = [os.path.join(self.dictionarydatapath, "part%d.db" % n) for n in range(len(jobs))]
+        
+        pool = multiprocessing.Pool(min(len(jobs), multiprocessing.cpu_count()))
+        try:
+            jobseconds = pool.map(buildGroupsInto, [(partpath, job, [self.dictionarydatapath, self.cjkdatapath]) for partpath, job in zip(partpaths, jobs)])
+        finally:
+            pool.close()
+            pool.join()
+        
+        for partpath in partpaths:
+            mergeDatabase(self.builtdatabasepath, partpath)
+        
+        # NB: the jobs ran at the same time, so their times add up to more than the phase took
+        for job, seconds in zip(jobs, jobseconds):
+            self.timeTables(job, seconds)
+    
+    """
+    Records the time it took to build the groups of tables in a job, along with how many rows they have and
+    how much input they were built from. We don't know how many bytes the groups built from cjklib's own data read.
+    """
+    def timeTables(self, job, seconds):
+        rows = sum([countRows(self.builtdatabasepath, group) for group in job])
+        
+        inputpaths = [os.path.join(self.dictionarydatapath, requirement) for requirement in pinyin.utils.concat([groupinputs.get(group, []) for group in job])]
+        bytesread = None
+        for inputpath in inputpaths:
+            if os.path.exists(inputpath):
+                bytesread = addCounts(bytesread, os.path.getsize(inputpath))
+        
+        if len(job) > 1:
+            self.timings.table(" and ".join(job), seconds, rows, bytesread, kind="tables")
+        else:
+            self.timings.table(job[0], seconds, rows, bytesread)
+    
+    def copyExistingDatabase(self, stalegroups):
+        shutil.copyfile(self.existingdatabasepath, self.builtdatabasepath)
+        
+        # Get rid of the tables we are going to rebuild, so that the cjklib builder knows to build them
+        connection = pinyin.db.sqlite.connect(self.builtdatabasepath)
+        try:
+            for group in stalegroups:
+                connection.execute('DROP TABLE IF EXISTS "%s"' % group)
+            connection.commit()
+        finally:
+            connection.close()
+    
+    def copyExistingImage(self, tablename, imagepath):
+        existingimagepath = os.path.join(os.path.dirname(self.existingdatabasepath), pinyin.db.image.imagefilename(tablename))
+        if not(os.path.exists(existingimagepath)) or os.path.getmtime(existingimagepath) < os.path.getmtime(self.existingdatabasepath):
+            return False
+        
+        log.info("Keeping the existing image of %s", tablename)
+        shutil.copyfile(existingimagepath, imagepath)
+        return True
+
+
+# How much of a file we extract from an archive at a time
+extractchunksize = 64 * 1024
+
+"""
+Extracts the file at the path in the zip to the target a chunk at a time, so that we never hold the whole
+of a (possibly very large) dictionary in memory.
+"""
+def extractFromZip(sourcezip, pathinzip, target):
+    targetfile = open(target, "wb")
+    try:
+        if hasattr(sourcezip, "open"):
+            sourcefile = sourcezip.open(pathinzip)
+            try:
+                shutil.copyfileobj(sourcefile, targetfile, extractchunksize)
+            finally:
+                sourcefile.close()
+        else:
+            # Python 2.5 can only decompress the whole file at once
+            targetfile.write(sourcezip.read(pathinzip))
+    finally:
+        targetfile.close()
 
+"""
+Makes a plain file available at the target. cjklib only reads the files, so where the platform supports
+them we use a symbolic link rather than copying the whole file.
+"""
+def linkOrCopyFile(source, target):
+    if hasattr(os, "symlink"):
+        try:
+            os.symlink(os.path.abspath(source), target)
+            return
+        except OSError, e:
+            log.info("Couldn't link %s to %s, so copying it instead: %s", target, source, e)
+    
+    shutil.copyfile(source, target)
+
+"""
+One of the files that we build the database from. We identify it by the hash of its contents, so that
+copying or unzipping it doesn't count as a change, but working that out means reading the whole file.
+So we only do it if its size or modification time has changed since we last knew its hash.
+"""
+class SourceFile(object):
+    def __init__(self, name, path, computehash):
+        self.name = name
+        self.path = path
+        self.computehash = computehash
+        self.hash = None
+    
+    def signature(self):
+        return pinyin.utils.filesignature(self.path)
+    
+    def contenthash(self, knowninputs):
+        if self.hash is None:
+            knownsignature, knownhash = knowninputs.get(self.name, (None, None))
+            if knownsignature is not None and knownsignature == self.signature():
+                self.hash = knownhash
+            else:
+                log.info("Hashing the contents of %s", self.name)
+                self.hash = self.computehash()
+        
+        return self.hash
 
 def getSatisfiers():
     dictionarydir = lambda *components: pinyin.utils.toolkitdir("pinyin", "dictionaries", *components)
@@ -78,7 +773,7 @@ def getSatisfiers():
         def inner():
             source = dictionarydir(path)
             if os.path.exists(source):
-                return path, os.path.getmtime(source), lambda target: shutil.copyfile(source, target)
+                return SourceFile(path, source, lambda: pinyin.utils.filemd5(source)), lambda target: linkOrCopyFile(source, target)
             else:
                 log.info("Missing ordinary file at %s", source)
                 return None
@@ -113,15 +808,11 @@ def getSatisfiers():
                 log.info("Zip file at %s lacked a file called %s", path, os.path.join(*pathinzipcomponents))
                 return None
             
-            def go(target):
-                # Extract the selected file from the zip
-                targetfile = open(target, 'w')
-                try:
-                    targetfile.write(sourcezip.read(pathinzip))
-                finally:
-                    targetfile.close()
+            # NB: the zip already records a checksum of the file, so we can identify its contents without decompressing it
+            info = sourcezip.getinfo(pathinzip)
+            computehash = lambda: "crc32:%08x:%d" % (info.CRC & 0xffffffff, info.file_size)
             
-            return path + ":" + pathinzip, os.path.getmtime(zipsource), go
+            return SourceFile(path + ":" + pathinzip, zipsource, computehash), lambda target: extractFromZip(sourcezip, pathinzip, target)
         
         return inner
     
@@ -176,33 +867,42 @@ def getSatisfiers():
                           plainArchiveSource("shipped.zip", ["cfdict_nb.u8"]),
                           timestampedFileSource("cfdict-%s.txt")],
         "Unihan.txt"   : [fileSource("Unihan.txt"),
-                          plainArchiveSource("Unihan.zip", ["Unihan.txt"])]
+                          plainArchiveSource("Unihan.zip", ["Unihan.txt"])],
+        "characterpinyin.tsv" : [fileSource("characterpinyin.tsv")]
       }
     
-    maxtimestamp = 0
     satisfiers = []
     for requirement, sources in requirements.items():
         success = False
         for source in sources:
-            timestampsatisfier = source()
-            if timestampsatisfier:
-                satisfiedby, timestamp, satisfier = timestampsatisfier
-                log.info("The requirement for %s was satisified by %s (with a timestamp of %d)", requirement, satisfiedby, timestamp)
+            sourcesatisfier = source()
+            if sourcesatisfier:
+                sourcefile, satisfier = sourcesatisfier
+                log.info("The requirement for %s was satisified by %s", requirement, sourcefile.name)
                 
-                maxtimestamp = max(maxtimestamp, timestamp)
-                satisfiers.append((requirement, satisfier))
+                satisfiers.append((requirement, sourcefile, satisfier))
                 
                 success = True
                 break
         
-        if not(success):
+        if not(success) and requirement not in optionalinputs:
             raise IOError("Couldn't satisfy our need for '%s' during dictionary generation" % requirement)
     
-    return maxtimestamp, satisfiers
+    # Check that we have whatever the optional requirements we went without were standing in for
+    satisfied = [requirement for requirement, _sourcefile, _satisfier in satisfiers]
+    for requirement, insteadof in optionalinputs.items():
+        if requirement not in satisfied:
+            missing = [instead for instead in insteadof if instead not in satisfied]
+            if len(missing) > 0:
+                raise IOError("Couldn't satisfy our need for '%s' (or %s instead) during dictionary generation" % (requirement, ", ".join(missing)))
+            
+            log.info("Going without the optional requirement for %s", requirement)
+    
+    return satisfiers
 
 if __name__ == "__main__":
-    import shutil
-    
-    builder = DBBuilder(getSatisfiers()[1])
-    builder.build()
-    shutil.copyfile(builder.builtdatabasepath, pinyin.utils.toolkitdir("pinyin", "db", "cjklib.db"))
\ No newline at end of file
+    # Pass --native to import the dictionaries with our own importer rather than cjklib's, and --parallel to build
+    # independent tables in worker processes
+    builder = DBBuilder(getSatisfiers(), pinyin.db.dbpath, parallel="--parallel" in sys.argv[1:] or None, native="--native" in sys.argv[1:] or None)
+    builder.build(lambda timing: sys.stdout.write("%s\n" % timing))
+    pinyin.db.installdatabase(builder.installedfiles)
\ No newline at end of file
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import struct
+
+import pinyin.db
+from pinyin.logger import log
+
+
+# The tables we compile into images when we build the database
+imagetables = ["CEDICT", "CFDICT", "HanDeDict", "CharacterPinyin"]
+
+# Bump the version if you change the layout of the file
+magic = "PTKDICT1"
+
+headerformat = "<8sIII"
+headersize = struct.calcsize(headerformat)
+
+def imagefilename(tablename):
+    return tablename + ".dictimage"
+
+def imagepath(tablename):
+    return os.path.join(os.path.dirname(pinyin.db.dbpath), imagefilename(tablename))
+
+"""
+Reports whether there is an image for the table that is at least as new as the database,
+and so can be used instead of querying the database.
+"""
+def isimagecurrent(tablename):
+    path = imagepath(tablename)
+    if not(os.path.exists(path)) or not(os.path.exists(pinyin.db.dbpath)):
+        return False
+
+    return os.path.getmtime(path) >= os.path.getmtime(pinyin.db.dbpath)
+
+"""
+Write a compact, read-only dictionary image to the given path. The rows should be tuples
+of (simplified headword, traditional headword, reading, translation) in priority order.
+
+The layout of the file is as follows (all integers are little endian unsigned 32 bit):
+  * Header: magic, number of headwords, length of the longest headword in characters, and
+    the length of the headword blob in bytes
+  * Headword offsets: one per headword plus a sentinel, relative to the headword blob
+  * Entry offsets: one per headword plus a sentinel, relative to the entry blob
+  * Headword blob: the UTF-8 encoded headwords, sorted bytewise (and hence by code point)
+  * Entry blob: for each headword, a sequence of length-prefixed UTF-8 (reading, translation) pairs
+"""
+def writeimage(path, rows):
+    entries = {}
+    for simplified, traditional, reading, translation in rows:
+        for headword in set([simplified, traditional]):
+            entries.setdefault(headword.encode("utf-8"), []).append((reading.encode("utf-8"), (translation or u"").encode("utf-8")))
+
+    headwords = entries.keys()
+    headwords.sort()
+
+    headwordoffsets, headwordblob, offset = [], [], 0
+    entryoffsets, entryblob, entryoffset = [], [], 0
+    for headword in headwords:
+        headwordoffsets.append(offset)
+        headwordblob.append(headword)
+        offset += len(headword)
+
+        entryoffsets.append(entryoffset)
+        for reading, translation in entries[headword]:
+            for field in [reading, translation]:
+                entryblob.append(struct.pack("<I", len(field)))
+                entryblob.append(field)
+                entryoffset += 4 + len(field)
+
+    headwordoffsets.append(offset)
+    entryoffsets.append(entryoffset)
+
+    maxwordlen = max([0] + [len(headword.decode("utf-8")) for headword in headwords])
+
+    file = open(path, "wb")
+    try:
+        file.write(struct.pack(headerformat, magic, len(headwords), maxwordlen, offset))
+        file.write(struct.pack("<%dI" % len(headwordoffsets), *headwordoffsets))
+        file.write(struct.pack("<%dI" % len(entryoffsets), *entryoffsets))
+        file.write("".join(headwordblob))
+        file.write("".join(entryblob))
+    finally:
+        file.close()
+
+    log.info("Wrote dictionary image with %d headwords to %s", len(headwords), path)
+
+"""
+A dictionary image opened with mmap. Lookups are binary searches over the sorted headwords in
+the mapped file, so nothing but the entries we actually ask for is ever copied into Python, and
+several processes with the same image open share the operating system's page cache.
+
+The image can also act as a prefix index for segmentation, since the headwords are sorted.
+"""
+class DictionaryImage(object):
+    def __init__(self, path):
+        file = open(path, "rb")
+        try:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # NB: the mapping stays valid after we close the file
+            file.close()
+
+        filemagic, self.count, self.maxwordlen, headwordbloblength = struct.unpack(headerformat, self.mmap[0:headersize])
+        if filemagic != magic:
+            raise IOError("The file at %s is not a dictionary image we understand" % path)
+
+        self.headwordoffsetsstart = headersize
+        self.entryoffsetsstart = self.headwordoffsetsstart + 4 * (self.count + 1)
+        self.headwordblobstart = self.entryoffsetsstart + 4 * (self.count + 1)
+        self.entryblobstart = self.headwordblobstart + headwordbloblength
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, word):
+        encoded = word.encode("utf-8")
+        i = self.lowerbound(encoded)
+        return i < self.count and self.headword(i) == encoded
+
+    def close(self):
+        self.mmap.close()
+
+    def isprefix(self, text):
+        encoded = text.encode("utf-8")
+        i = self.lowerbound(encoded)
+        return i < self.count and self.headword(i).startswith(encoded)
+
+    def headwords(self):
+        for i in range(self.count):
+            yield self.headword(i).decode("utf-8")
+
+    def lookup(self, word):
+        encoded = word.encode("utf-8")
+        i = self.lowerbound(encoded)
+        if i >= self.count or self.headword(i) != encoded:
+            return []
+
+        start, end = self.offsets(self.entryoffsetsstart, i)
+        fields, position = [], self.entryblobstart + start
+        while position < self.entryblobstart + end:
+            length, = struct.unpack("<I", self.mmap[position:position + 4])
+            fields.append(self.mmap[position + 4:position + 4 + length].decode("utf-8"))
+            position += 4 + length
+
+        return [(fields[n], fields[n + 1]) for n in range(0, len(fields), 2)]
+
+    # Internal helpers: all in terms of UTF-8 encoded byte strings
+
+    def offsets(self, table, i):
+        return struct.unpack("<II", self.mmap[table + 4 * i:table + 4 * (i + 2)])
+
+    def headword(self, i):
+        start, end = self.offsets(self.headwordoffsetsstart, i)
+        return self.mmap[self.headwordblobstart + start:self.headwordblobstart + end]
+
+    def lowerbound(self, encoded):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.headword(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import cjklib.dbconnector
+import sqlalchemy
+
+import pinyin.db
+import pinyin.db.builder
+import pinyin.utils
+
+
+"""
+Compares importing a CEDICT format dictionary with cjklib's builder against our native importer. Run it
+from the directory containing the pinyin package:
+
+  python -m pinyin.db.importbenchmark [path to dictionary] [rounds]
+
+By default we import the copy of CFDICT that ships with the Toolkit. Each round imports the dictionary
+into a fresh database with both importers, and we check that they built the same table.
+"""
+
+def cjklibimport(path, datapath):
+    database = cjklib.dbconnector.DatabaseConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=path) })
+    try:
+        pinyin.db.builder.makeCjkDatabaseBuilder(database, [datapath]).build(["CFDICT"])
+    finally:
+        database.connection.close()
+        database.engine.dispose()
+
+def nativeimport(path, datapath):
+    pinyin.db.builder.importDictionary(path, "CFDICT", os.path.join(datapath, "cfdict.u8"))
+
+modes = [("cjklib", cjklibimport),
+         ("native", nativeimport)]
+
+def timemode(sourcepath, doimport):
+    datapath = tempfile.mkdtemp()
+    try:
+        # NB: this is the name cjklib looks for, and the one the database builder gives the file
+        shutil.copyfile(sourcepath, os.path.join(datapath, "cfdict.u8"))
+        
+        path = os.path.join(datapath, "cjklib.db")
+        started = time.time()
+        doimport(path, datapath)
+        finished = time.time()
+        
+        return finished - started, dump(path)
+    finally:
+        shutil.rmtree(datapath)
+
+def dump(path):
+    connection = pinyin.db.sqlite.connect(path)
+    try:
+        # NB: SQLAlchemy lays out the SQL it creates tables with differently, so ignore the whitespace
+        schema = [(type, name, re.sub(r"\s*([(),])\s*", r"\1", sql)) for type, name, sql in connection.execute("SELECT type, name, sql FROM sqlite_master WHERE tbl_name = 'CFDICT' ORDER BY name")]
+        return schema, connection.execute('SELECT * FROM "CFDICT" ORDER BY rowid').fetchall()
+    finally:
+        connection.close()
+
+def benchmark(sourcepath, rounds):
+    timings = dict([(name, []) for name, _doimport in modes])
+    dumps = {}
+    for round in range(rounds):
+        for name, doimport in modes:
+            timing, dumps[name] = timemode(sourcepath, doimport)
+            timings[name].append(timing)
+    
+    print "%d rounds of importing %s (%d entries)" % (rounds, sourcepath, len(dumps["native"][1]))
+    for name, _doimport in modes:
+        print "%-7s best %8.2fms, median %8.2fms" % (name, 1000 * min(timings[name]), 1000 * median(timings[name]))
+    
+    if dumps["cjklib"] == dumps["native"]:
+        print "Both importers built the same table"
+    else:
+        print "WARNING: the importers built different tables!"
+
+def median(xs):
+    xs = sorted(xs)
+    return xs[len(xs) // 2]
+
+if __name__ == "__main__":
+    sourcepath = len(sys.argv) > 1 and sys.argv[1] or pinyin.utils.toolkitdir("pinyin", "dictionaries", "cfdict-20091018.txt")
+    rounds = len(sys.argv) > 2 and int(sys.argv[2]) or 5
+    
+    benchmark(sourcepath, rounds)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+from pinyin.logger import log
+
+
+"""
+Hands out database connections, one per thread. SQLite connections can't be shared between threads,
+and funnelling every lookup through a single one would serialise them anyway, so each thread that
+touches the database lazily gets its own connection, which it keeps for next time.
+
+The pool stands in for a single connector: calling it returns the connector for the current thread,
+and any other attribute access is forwarded to that connector, so the pool can be used exactly where
+a DatabaseConnector was used before.
+
+Resetting the pool makes every thread open a fresh connection next time it needs one, which is what we
+want after the database file has been replaced.
+"""
+class ConnectionPool(object):
+    def __init__(self, connect):
+        # Need to initialize all fields or __getattr__ gets a look at them!
+        self.connect = connect
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.generation = 0
+    
+    def __call__(self):
+        local = self.local
+        if getattr(local, "generation", None) != self.generation:
+            if getattr(local, "connector", None) is not None:
+                log.info("Closing database connection from an earlier generation of the pool")
+                closequietly(local.connector)
+            
+            # NB: read the generation first, so a reset while we connect makes us connect again next time
+            generation = self.generation
+            log.info("Opening database connection for thread %s", threading.currentThread().getName())
+            local.connector = self.connect()
+            local.generation = generation
+        
+        return local.connector
+    
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+        finally:
+            self.lock.release()
+    
+    # Transparent proxying of access onto the connector for the current thread
+    def __getattr__(self, name):
+        return getattr(self.__call__(), name)
+
+def closequietly(connector):
+    try:
+        connector.connection.close()
+        connector.engine.dispose()
+    except Exception, e:
+        log.warn("Error while closing a database connection: %s", e)
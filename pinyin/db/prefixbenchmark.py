@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import sys
+import time
+
+import pinyin.bloomfilter
+import pinyin.db
+import pinyin.dictionary
+import pinyin.trie
+import pinyin.utils
+
+
+"""
+Compares the ways a dictionary can find out which of the candidate words in some text are (or start)
+headwords: probing the Bloom filter we keep for database tables, probing an in-memory trie, and asking
+the database itself. Run it from the directory containing the pinyin package:
+
+  python -m pinyin.db.prefixbenchmark [path to database] [table] [rounds] [sentences]
+
+The candidates are every substring of the sample sentences up to the length of the longest headword,
+which is what segmenting the sentences would probe without a prefix index to cut the walk short.
+"""
+
+def loadheadwords(path, tablename):
+    connection = pinyin.db.sqlite.connect(path)
+    try:
+        return list(set(pinyin.utils.concat([list(row) for row in connection.execute('SELECT HeadwordSimplified, HeadwordTraditional FROM "%s"' % tablename)])))
+    finally:
+        connection.close()
+
+def samplecandidates(headwords, sentences, maxwordlen):
+    # NB: seed the generator so that every run of the benchmark probes the same candidates. Mix in
+    # some single characters from the headwords, so that plenty of the candidates aren't headwords
+    generator = random.Random(0)
+    characters = list(set(pinyin.utils.concat([list(headword) for headword in headwords[:1000]])))
+    
+    candidates = []
+    for _sentence in range(sentences):
+        sentence = u"".join([generator.choice([generator.choice(headwords), generator.choice(characters)]) for _word in range(10)])
+        for i in range(len(sentence)):
+            for end in range(i + 1, min(len(sentence), i + maxwordlen) + 1):
+                candidates.append(sentence[i:end])
+    
+    return candidates
+
+def probeindex(index, candidates):
+    # NB: probe in the same order as segmenting does, which only asks about whole words for prefixes
+    for candidate in candidates:
+        if index.isprefix(candidate):
+            candidate in index
+
+def probedatabase(path, tablename, candidates):
+    connection = pinyin.db.sqlite.connect(path)
+    try:
+        query = 'SELECT 1 FROM "%s" WHERE HeadwordSimplified = ? OR HeadwordTraditional = ? LIMIT 1' % tablename
+        for candidate in candidates:
+            connection.execute(query, (candidate, candidate)).fetchall()
+    finally:
+        connection.close()
+
+def benchmark(path, tablename, rounds, sentences):
+    headwords = loadheadwords(path, tablename)
+    bloomfilter = pinyin.bloomfilter.PrefixBloomFilter.fromwords(headwords, pinyin.dictionary.defaultfalsepositiverate)
+    trie = pinyin.trie.Trie(headwords)
+    candidates = samplecandidates(headwords, sentences, trie.maxwordlen)
+    
+    modes = [("bloom filter", lambda: probeindex(bloomfilter, candidates)),
+             ("trie", lambda: probeindex(trie, candidates)),
+             ("database", lambda: probedatabase(path, tablename, candidates))]
+    
+    timings = dict([(name, []) for name, _probe in modes])
+    for round in range(rounds):
+        for name, probe in modes:
+            started = time.time()
+            probe()
+            timings[name].append(time.time() - started)
+    
+    print "%d rounds of probing %d candidates against %d headwords of %s" % (rounds, len(candidates), len(headwords), tablename)
+    for name, _probe in modes:
+        print "%-12s best %8.2fms, median %8.2fms, %6.2fus per candidate" % \
+                (name, 1000 * min(timings[name]), 1000 * median(timings[name]), 1000000 * min(timings[name]) / len(candidates))
+
+def median(xs):
+    xs = sorted(xs)
+    return xs[len(xs) // 2]
+
+if __name__ == "__main__":
+    path = len(sys.argv) > 1 and sys.argv[1] or pinyin.db.dbpath
+    tablename = len(sys.argv) > 2 and sys.argv[2] or "CEDICT"
+    rounds = len(sys.argv) > 3 and int(sys.argv[3]) or 5
+    sentences = len(sys.argv) > 4 and int(sys.argv[4]) or 1000
+    
+    benchmark(path, tablename, rounds, sentences)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlalchemy
+
+import pinyin.db
+from pinyin.logger import log
+
+
+"""
+A static description of the tables that the Toolkit reads at runtime, as cjklib builds them. Using
+this instead of reflecting the tables with autoload saves a round of queries against the SQLite
+metadata the first time each table is used after Anki starts.
+
+The database builder checks that the tables it builds match this description, and records the
+schema version in the database. Bump the version whenever you change the description, so that
+databases built against the old one get rebuilt.
+"""
+
+schemaversion = 1
+
+metadata = sqlalchemy.MetaData()
+
+def dictionaryTable(tablename):
+    return sqlalchemy.Table(tablename, metadata,
+        sqlalchemy.Column("HeadwordTraditional", sqlalchemy.String(255)),
+        sqlalchemy.Column("HeadwordSimplified", sqlalchemy.String(255)),
+        sqlalchemy.Column("Reading", sqlalchemy.String(255)),
+        sqlalchemy.Column("Translation", sqlalchemy.Text))
+
+dictionarytables = dict([(tablename, dictionaryTable(tablename)) for tablename in ["CEDICT", "CFDICT", "HanDeDict"]])
+
+characterpinyin = sqlalchemy.Table("CharacterPinyin", metadata,
+    sqlalchemy.Column("ChineseCharacter", sqlalchemy.String(1), primary_key=True),
+    sqlalchemy.Column("Reading", sqlalchemy.String(255), primary_key=True))
+
+pinyinsyllables = sqlalchemy.Table("PinyinSyllables", metadata,
+    sqlalchemy.Column("Pinyin", sqlalchemy.String(7), primary_key=True),
+    sqlalchemy.Column("Source", sqlalchemy.String(1)))
+
+"""
+Returns a column to order rows of the table by so that they come back in the order they were imported, which for
+the dictionaries is their priority order. SQLite would otherwise return them in the order of whatever index it
+answered the query from.
+"""
+def fileorder(table):
+    return sqlalchemy.literal_column('"%s".rowid' % table.name)
+
+"""
+Checks the tables in the database against our description of them, raising a ValueError if any
+of them are missing or lack a column we expect. If they all match, we stamp the database with
+the schema version.
+"""
+def verifySchema(database):
+    for table in metadata.sorted_tables:
+        if not(database.hasTable(table.name)):
+            raise ValueError("The database lacks the %s table" % table.name)
+        
+        builtcolumns = set([column.name for column in sqlalchemy.Table(table.name, sqlalchemy.MetaData(), autoload=True, autoload_with=database.connection).c])
+        missingcolumns = [column.name for column in table.c if column.name not in builtcolumns]
+        if missingcolumns:
+            raise ValueError("The %s table in the database lacks the columns %s" % (table.name, ", ".join(missingcolumns)))
+    
+    log.info("The database matches version %d of the schema", schemaversion)
+    database.execute("PRAGMA user_version = %d" % schemaversion)
+
+"""
+Returns the version of the schema that the database at the path was verified against when it
+was built, or 0 if it never was.
+"""
+def databaseSchemaVersion(path):
+    # NB: open our own connection rather than using the pool, because the file may be about to be replaced
+    connection = pinyin.db.sqlite.connect(path)
+    try:
+        return connection.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        connection.close()
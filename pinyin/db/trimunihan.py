@@ -1,4 +1,27 @@
 #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import codecs
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import cjklib.dbconnector
+import sqlalchemy
+
+import pinyin.db
+import pinyin.db.builder
+
+
+"""
+Trims the Unihan database down to the fields we build the database from, and optionally extracts the character
+readings that the builder would derive from it into a compact file that it can load CharacterPinyin from instead.
+Run it from the directory containing the pinyin package:
+
+  python -m pinyin.db.trimunihan [path to Unihan.txt] [--readings path to characterpinyin.tsv]
+"""
 
 # You can get the list of fields you need to keep by examining
 # the output of the database builder:
@@ -6,26 +29,67 @@ keepfields = ["kMandarin",   # Reading available for almost all characters, in f
               "kXHC1983",    # Syllabised reading and unknown reference data from Xiàndài Hànyǔ Cídiǎn
               "kHanyuPinlu"] # Reading and frequency data (relatively sparse) from Xiàndài Hànyǔ Pínlǜ Cídiǎn
 
-# Extract trimmed old data
-unihan = open('Unihan.txt','r')
-try:
-    outputlines = []
-    for line in unihan:
-        skip = not(line.startswith("#"))
-        for keepfield in keepfields:
-            if line[7:].startswith(keepfield):
-                skip = False
-        
-        if skip:
-            continue
-        
-        outputlines.append(line)
-finally:
-    unihan.close()
-
-# Overwrite with new data
-unihan = open('Unihan.txt','w+')
-try:
-    unihan.writelines(outputlines)
-finally:
-    unihan.close()
\ No newline at end of file
+# Matches the comments, and the lines for the fields we keep. NB: code points outside the BMP have five hex digits
+keepregex = re.compile(r"#|U\+[0-9A-F]+\t(?:%s)\t" % "|".join(keepfields))
+
+"""
+Trims the Unihan database at the path in place, a line at a time.
+"""
+def trim(path):
+    def write(output):
+        unihan = open(path, "rb")
+        try:
+            for line in unihan:
+                if keepregex.match(line):
+                    output.write(line)
+        finally:
+            unihan.close()
+    
+    pinyin.db.writereplacing(path, write)
+
+"""
+Writes the readings that cjklib derives from the Unihan database at the path to a file at the readings path, in
+the format that the database builder's characterReadings understands: one line per character, with the character
+and its readings separated by a tab, and the readings by spaces.
+"""
+def writeReadings(path, readingspath):
+    datapath = tempfile.mkdtemp()
+    try:
+        # Let cjklib decide what the readings are, so that we get exactly what it would have built
+        pinyin.db.builder.linkOrCopyFile(path, os.path.join(datapath, "Unihan.txt"))
+        database = cjklib.dbconnector.DatabaseConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=os.path.join(datapath, "readings.db")) })
+        try:
+            pinyin.db.builder.makeCjkDatabaseBuilder(database, [datapath, pinyin.db.builder.DBBuilder.cjkdatapath]).build(["CharacterPinyin"])
+            rows = database.selectRows(sqlalchemy.text('SELECT "ChineseCharacter", "Reading" FROM "CharacterPinyin" ORDER BY "ChineseCharacter", "Reading"'))
+        finally:
+            database.connection.close()
+            database.engine.dispose()
+    finally:
+        shutil.rmtree(datapath)
+    
+    readings = {}
+    for character, reading in rows:
+        readings.setdefault(character, []).append(reading)
+    
+    def write(output):
+        output = codecs.getwriter("utf-8")(output)
+        output.write(u"# Character readings extracted from %s by trimunihan\n" % os.path.basename(path))
+        for character in sorted(readings.keys()):
+            output.write(u"%s\t%s\n" % (character, u" ".join(readings[character])))
+    
+    pinyin.db.writereplacing(readingspath, write)
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    
+    readingspath = None
+    if "--readings" in arguments:
+        readingspath = arguments[arguments.index("--readings") + 1]
+        arguments.remove("--readings")
+        arguments.remove(readingspath)
+    
+    path = len(arguments) > 0 and arguments[0] or "Unihan.txt"
+    
+    trim(path)
+    if readingspath is not None:
+        writeReadings(path, readingspath)
@@ -2,15 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import codecs
+import itertools
+import marshal
 import os
 import re
+import threading
+import time
 
 import sqlalchemy
 
+import bloomfilter
+import db
 from db import database
+import db.image as dbimage
+import db.schema as dbschema
 from logger import log
 from model import *
 import meanings
+from trie import Trie
 from utils import *
 
 
@@ -21,81 +30,505 @@ def parseMeaning(meaning, simptradindex):
     
     return lambda prefersimptrad, tonedcharscallback: meanings.MeaningFormatter(simptradindex, prefersimptrad).parsedefinition(meaning, tonedcharscallback)
 
-def fileSource(dictname):
-    filename = toolkitdir("pinyin", "dictionaries", dictname)
+"""
+A source of dictionary entries: carries a precomputed prefix index of every headword it has
+entries for, and can look up the (reading, meaning function) pairs stored against them.
+
+Lookups are batched: lookupmany takes a list of words and returns a dictionary mapping each
+of them to its (possibly empty) list of entries, so that database-backed sources can answer
+all of the words in a sentence with a single query.
+"""
+class DictionarySource(object):
+    def __init__(self, prefixes, lookupmany):
+        self.prefixes = prefixes
+        self.lookupmany = lookupmany
     
-    # Avoid loading auxilliary dictionaries that aren't there (e.g. the dict-userdict.txt if the user hasn't created it)
-    if not(os.path.exists(filename)):
-        log.warn("Skipping missing dictionary at %s", filename)
-        return None
+    def __call__(self, word):
+        return self.lookupmany([word])[word]
     
-    log.info("Loading file-based dictionary from %s", filename)
+    """
+    Bring the source up to date with whatever it was loaded from, returning the headwords whose entries changed.
+    """
+    def poll(self):
+        return []
+
+# SQLite will not accept more than 999 parameters in a statement, and we can use two per word
+sqlbatchsize = 250
+
+# How many sentences we parse at once when asked to parse lots of them
+parsebatchsize = 500
+
+# How many characters we read at once from a stream, and the longest HTML tag we are prepared to wait for the end of
+streamblocksize = 64 * 1024
+streammaxtaglength = 1024
+
+# The proportion of non-words that we are prepared to let through to the database
+defaultfalsepositiverate = 0.01
+
+def dictionarypath(dictname):
+    return toolkitdir("pinyin", "dictionaries", dictname)
+
+"""
+Parse lines in CEDICT format, yielding the headwords, reading and meaning of each entry.
+"""
+def parseDictionaryLines(lines):
+    for line in lines:
+        # Match this line
+        m = PinyinDictionary.lineregex.match(line)
+        if not(m):
+            continue
+        
+        # Extract information from dictionary: simplified, traditional, pinyin, definition
+        yield m.group(1), m.group(2), m.group(3), m.group(5)
+
+"""
+Parse a CEDICT-format dictionary file into a dictionary mapping headwords to lists of (reading, meaning) pairs.
+"""
+def parseDictionaryFile(filename):
+    log.info("Parsing file-based dictionary from %s", filename)
     file = codecs.open(filename, "r", encoding='utf-8')
     try:
         readingsmeanings = FactoryDict(lambda _: [])
-        maxcharacterlen = 0
-        for line in file:
-            # Match this line
-            m = PinyinDictionary.lineregex.match(line)
-            if not(m):
-                continue
-            
-            # Extract information from dictionary
-            lcharacters = m.group(1)
-            rcharacters = m.group(2)
-            raw_pinyin = m.group(3)
-            raw_definition = m.group(5)
-            
+        for lcharacters, rcharacters, raw_pinyin, raw_definition in parseDictionaryLines(file):
             # Save meanings and readings
             for characters in [lcharacters, rcharacters]:
-                # Update the maximum character length
-                maxcharacterlen = max(maxcharacterlen, len(characters))
-                
                 # Save the readings and meanings for both simplified and traditional keys
                 readingsmeanings[characters].append((raw_pinyin, raw_definition))
     finally:
         file.close()
     
-    return maxcharacterlen, lambda word: [(reading, parseMeaning(meaning, 0)) for reading, meaning in readingsmeanings[word]]
+    # NB: marshal only understands the built in dictionary type
+    return dict(readingsmeanings)
+
+# Bump this if you change what parseDictionaryFile returns
+filecacheversion = 1
 
-def databaseDictionarySource(tablename, simptradindex):
+# The directory we keep the caches of parsed dictionary files in, or None to keep each one next to its file
+filecachedir = None
+
+def dictionaryCachePath(filename):
+    if filecachedir is None:
+        return filename + ".cache"
+    else:
+        return os.path.join(filecachedir, os.path.basename(filename) + ".cache")
+
+"""
+Parse a dictionary file, going via a marshalled cache of the result that we keep next to it (unless told
+to keep it in the filecachedir). The cache
+is only used if it was made from a file with the same modification time and size by this version of
+the code, and otherwise it is regenerated.
+"""
+def loadDictionaryFile(filename):
+    cachefilename = dictionaryCachePath(filename)
+    stamp = (filecacheversion, marshal.version, filesignature(filename))
+    
+    if os.path.exists(cachefilename):
+        try:
+            file = open(cachefilename, "rb")
+            try:
+                cachestamp, readingsmeanings = marshal.load(file)
+            finally:
+                file.close()
+            
+            if cachestamp == stamp:
+                log.info("Loaded cached parse of %s", filename)
+                return readingsmeanings
+        except (IOError, EOFError, ValueError, TypeError), e:
+            log.warn("Ignoring unreadable dictionary cache at %s: %s", cachefilename, e)
+    
+    readingsmeanings = parseDictionaryFile(filename)
+    try:
+        file = open(cachefilename, "wb")
+        try:
+            marshal.dump((stamp, readingsmeanings), file)
+        finally:
+            file.close()
+    except (IOError, OSError), e:
+        log.warn("Couldn't save the dictionary cache to %s: %s", cachefilename, e)
+    
+    return readingsmeanings
+
+def fileSource(dictname):
+    filename = dictionarypath(dictname)
+    
+    # Avoid loading auxilliary dictionaries that aren't there (e.g. the dict-userdict.txt if the user hasn't created it)
+    if not(os.path.exists(filename)):
+        log.warn("Skipping missing dictionary at %s", filename)
+        return None
+    
+    log.info("Loading file-based dictionary from %s", filename)
+    readingsmeanings = loadDictionaryFile(filename)
+    
+    def inner(words):
+        return dict([(word, [(reading, parseMeaning(meaning, 0)) for reading, meaning in readingsmeanings.get(word, [])]) for word in words])
+    
+    return DictionarySource(Trie(readingsmeanings.keys()), inner)
+
+"""
+A file-based source that keeps itself up to date with the file as it is edited. When polled, it checks
+whether the file has changed (at most once every pollinterval seconds) and if so works out which lines
+were added and removed. Only the headwords on those lines are re-parsed, and the listeners are told
+which headwords changed so that they can throw away anything they know about them.
+
+The file need not exist: in that case the source is empty until it is created.
+"""
+class WatchedFileSource(DictionarySource):
+    def __init__(self, filename, pollinterval=1.0):
+        self.filename = filename
+        self.pollinterval = pollinterval
+        self.listeners = []
+        self.lock = threading.Lock()
+        
+        self.signature = filesignature(filename)
+        self.lastpolled = time.time()
+        
+        self.lines = self.readlines()
+        if self.signature is None:
+            self.readingsmeanings = {}
+        else:
+            log.info("Loading watched file-based dictionary from %s", filename)
+            self.readingsmeanings = loadDictionaryFile(filename)
+        
+        DictionarySource.__init__(self, Trie(self.readingsmeanings.keys()), self.lookupwords)
+    
+    def lookupwords(self, words):
+        return dict([(word, [(reading, parseMeaning(meaning, 0)) for reading, meaning in self.readingsmeanings.get(word, [])]) for word in words])
+    
+    def readlines(self):
+        if not(os.path.exists(self.filename)):
+            return []
+        
+        file = codecs.open(self.filename, "r", encoding='utf-8')
+        try:
+            return file.readlines()
+        finally:
+            file.close()
+    
+    def poll(self):
+        # Several threads might be parsing with this source, but only one of them needs to apply the changes
+        if not(self.lock.acquire(False)):
+            return []
+        
+        try:
+            return self.pollholdinglock()
+        finally:
+            self.lock.release()
+    
+    def pollholdinglock(self):
+        now = time.time()
+        if now - self.lastpolled < self.pollinterval:
+            return []
+        
+        self.lastpolled = now
+        signature = filesignature(self.filename)
+        if signature == self.signature:
+            return []
+        
+        # Diff the lines as multisets: we don't care where in the file a line moved to
+        newlines = self.readlines()
+        counts = {}
+        for line in self.lines:
+            counts[line] = counts.get(line, 0) - 1
+        for line in newlines:
+            counts[line] = counts.get(line, 0) + 1
+        changedlines = [line for line, count in counts.items() if count != 0]
+        
+        changedheadwords = set()
+        for lcharacters, rcharacters, _, _ in parseDictionaryLines(changedlines):
+            changedheadwords.add(lcharacters)
+            changedheadwords.add(rcharacters)
+        
+        log.info("Dictionary %s changed on %d lines, affecting %d headwords", self.filename, len(changedlines), len(changedheadwords))
+        
+        # Rebuild the entries for the changed headwords from the new file contents, to keep them in file order.
+        # We only bother running the regex on lines that can possibly mention one of the changed headwords.
+        newreadingsmeanings = dict([(headword, []) for headword in changedheadwords])
+        candidatelines = [line for line in newlines if len(changedheadwords.intersection(line.split(None, 2)[:2])) > 0]
+        for lcharacters, rcharacters, raw_pinyin, raw_definition in parseDictionaryLines(candidatelines):
+            for characters in [lcharacters, rcharacters]:
+                if characters in newreadingsmeanings:
+                    newreadingsmeanings[characters].append((raw_pinyin, raw_definition))
+        
+        for headword, readingsmeanings in newreadingsmeanings.items():
+            if len(readingsmeanings) > 0:
+                self.readingsmeanings[headword] = readingsmeanings
+                self.prefixes.add(headword)
+            else:
+                self.readingsmeanings.pop(headword, None)
+                self.prefixes.discard(headword)
+        
+        self.lines = newlines
+        self.signature = signature
+        
+        for listener in self.listeners:
+            listener(changedheadwords)
+        
+        return changedheadwords
+
+"""
+Returns a prefix index for the headwords of a database table. Rather than holding the headwords
+themselves in memory we use a Bloom filter, which we save next to the database so that we only
+have to pull the headwords out of the database once each time it is rebuilt.
+"""
+def headwordPrefixes(tablename, loadheadwords, falsepositiverate):
+    path = os.path.join(os.path.dirname(db.dbpath), tablename + ".prefixes")
+    stamp = repr((filesignature(db.dbpath), falsepositiverate))
+    
+    try:
+        prefixes = bloomfilter.PrefixBloomFilter.load(path, stamp)
+    except (IOError, OSError), e:
+        # NB: we can always build the filter again, so don't let a file we can't read stop the Toolkit starting
+        log.warn("Couldn't load the headword prefix filter from %s: %s", path, e)
+        prefixes = None
+    
+    if prefixes is not None:
+        log.info("Loaded the headword prefix filter for %s", tablename)
+        return prefixes
+    
+    log.info("Building the headword prefix filter for %s", tablename)
+    prefixes = bloomfilter.PrefixBloomFilter.fromwords(loadheadwords(), falsepositiverate)
+    try:
+        prefixes.save(path, stamp)
+    except (IOError, OSError), e:
+        log.warn("Couldn't save the headword prefix filter to %s: %s", path, e)
+    
+    return prefixes
+
+"""
+The queries we make against the dictionary tables at runtime. The database builder creates indexes
+that make every one of them index-driven, and the tests check that it does. The entries for a word
+must come back in priority order, so we ask for them in the order of the dictionary file.
+"""
+def headwordsquery(dicttable):
+    return sqlalchemy.select([dicttable.c.HeadwordSimplified, dicttable.c.HeadwordTraditional])
+
+def entriesquery(dicttable, headwords):
+    return sqlalchemy.select([dicttable.c.HeadwordSimplified, dicttable.c.HeadwordTraditional, dicttable.c.Reading, dicttable.c.Translation],
+                             sqlalchemy.or_(dicttable.c.HeadwordSimplified.in_(headwords), dicttable.c.HeadwordTraditional.in_(headwords)),
+                             order_by=[dbschema.fileorder(dicttable)])
+
+def charactersquery(readingtable):
+    return sqlalchemy.select([readingtable.c.ChineseCharacter], distinct=True)
+
+def characterreadingsquery(readingtable, characters):
+    return sqlalchemy.select([readingtable.c.ChineseCharacter, readingtable.c.Reading], readingtable.c.ChineseCharacter.in_(characters),
+                             order_by=[dbschema.fileorder(readingtable)])
+
+"""
+Runs one of the queries above for a batch of words, compiling the SQL for it only once rather than
+building and compiling a fresh expression tree for every batch. Each distinct number of words needs its
+own statement, so we round batches up to a few bucket sizes by repeating the last word, which makes no
+difference to the result of an IN.
+
+We execute the compiled SQL directly on a DB-API cursor from the current thread's connection, which
+also lets SQLite reuse its prepared statements. If SQLite reports an error (the database might be locked,
+or being swapped for a new one) we run just that batch through SQLAlchemy instead. Anything else means we
+can't compile the SQL or the DB-API doesn't work the way we expect, so we fall back on SQLAlchemy for good.
+"""
+class BatchQuery(object):
+    def __init__(self, makequery):
+        self.makequery = makequery
+        self.statements = {}
+        self.useraw = True
+    
+    def __call__(self, words):
+        words = list(words)
+        if len(words) == 0:
+            return []
+        
+        if self.useraw:
+            try:
+                return self.executeraw(words)
+            except db.sqlite.Error, e:
+                log.warn("Running a dictionary query through SQLAlchemy after an error running it directly: %s", e)
+            except Exception, e:
+                log.warn("Falling back on SQLAlchemy for dictionary queries after an error running them directly: %s", e)
+                self.useraw = False
+        
+        return database.selectRows(self.makequery(words))
+    
+    def executeraw(self, words):
+        bucket = bucketsize(len(words))
+        paddedwords = words + [words[-1]] * (bucket - len(words))
+        
+        sql, wordindexes = self.statement(bucket)
+        cursor = database.connection.connection.cursor()
+        try:
+            cursor.execute(sql, [paddedwords[wordindex] for wordindex in wordindexes])
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+    
+    def statement(self, bucket):
+        statement = self.statements.get(bucket)
+        if statement is None:
+            compiled = self.makequery([sqlalchemy.bindparam("word%d" % n) for n in range(bucket)]).compile(bind=database.engine)
+            
+            # NB: a word can appear several times in the statement, so remember which word goes in each position
+            statement = (unicode(compiled), [int(name[len("word"):]) for name in compiled.positiontup])
+            self.statements[bucket] = statement
+        
+        return statement
+
+def bucketsize(numwords):
+    bucket = 1
+    while bucket < numwords:
+        bucket *= 2
+    
+    return max(numwords, min(bucket, sqlbatchsize))
+
+def databaseDictionarySource(tablename, simptradindex, falsepositiverate):
     log.info("Loading full dictionary from database table %s", tablename)
     
-    dicttable = sqlalchemy.Table(tablename, database.metadata, autoload=True)
-    maxcharacterlen = database.selectScalar(sqlalchemy.func.max(sqlalchemy.func.length(dicttable.c.HeadwordSimplified)))
+    dicttable = dbschema.dictionarytables[tablename]
     
-    def inner(word):
-        for reading, meaning in database.selectRows(sqlalchemy.select(
-                [dicttable.c.Reading,
-                 dicttable.c.Translation],
-                sqlalchemy.or_(dicttable.c.HeadwordSimplified == word,
-                               dicttable.c.HeadwordTraditional == word))):
-            yield (reading, parseMeaning(meaning, simptradindex))
+    def loadheadwords():
+        headwords = set()
+        for simplified, traditional in database.selectRows(headwordsquery(dicttable)):
+            headwords.add(simplified)
+            headwords.add(traditional)
+        
+        return headwords
+    
+    lookupentries = BatchQuery(lambda headwords: entriesquery(dicttable, headwords))
+    def inner(words):
+        readingsmeanings = dict([(word, []) for word in words])
+        for chunk in chunked(words, sqlbatchsize):
+            for simplified, traditional, reading, meaning in lookupentries(chunk):
+                # NB: one row can answer two of the words we asked about if they are the
+                # simplified and traditional forms of each other
+                for headword in set([simplified, traditional]):
+                    if headword in readingsmeanings:
+                        readingsmeanings[headword].append((reading, parseMeaning(meaning, simptradindex)))
+        
+        return readingsmeanings
     
-    return maxcharacterlen, inner
+    return DictionarySource(headwordPrefixes(tablename, loadheadwords, falsepositiverate), inner)
 
-def databaseReadingSource():
+def databaseReadingSource(falsepositiverate):
     log.info("Loading character reading database")
     
-    readingtable = sqlalchemy.Table("CharacterPinyin", database.metadata, autoload=True)
+    readingtable = dbschema.characterpinyin
+    loadheadwords = lambda: [character[0] for character in database.selectRows(charactersquery(readingtable))]
     
-    return 1, lambda word: [(reading[0], None) for reading in database.selectRows(sqlalchemy.select([readingtable.c.Reading], readingtable.c.ChineseCharacter == word))]
+    lookupreadings = BatchQuery(lambda characters: characterreadingsquery(readingtable, characters))
+    def inner(words):
+        readingsmeanings = dict([(word, []) for word in words])
+        for chunk in chunked(words, sqlbatchsize):
+            for character, reading in lookupreadings(chunk):
+                readingsmeanings[character].append((reading, None))
+        
+        return readingsmeanings
+    
+    return DictionarySource(headwordPrefixes("CharacterPinyin", loadheadwords, falsepositiverate), inner)
+
+def imageDictionarySource(tablename, simptradindex):
+    log.info("Loading dictionary image for table %s", tablename)
+    
+    image = dbimage.DictionaryImage(dbimage.imagepath(tablename))
+    
+    def inner(words):
+        return dict([(word, [(reading, parseMeaning(meaning, simptradindex)) for reading, meaning in image.lookup(word)]) for word in words])
+    
+    # NB: the image is sorted, so it can serve as its own prefix index
+    return DictionarySource(image, inner)
+
+"""
+Load the dictionary in the given table, preferring the compiled image of it if it is up to date.
+"""
+def tableDictionarySource(tablename, simptradindex, falsepositiverate=defaultfalsepositiverate):
+    if dbimage.isimagecurrent(tablename):
+        return imageDictionarySource(tablename, simptradindex)
+    else:
+        return databaseDictionarySource(tablename, simptradindex, falsepositiverate)
+
+def readingSource(falsepositiverate=defaultfalsepositiverate):
+    if dbimage.isimagecurrent("CharacterPinyin"):
+        # The image of this table has empty translations, which parseMeaning turns into None
+        return imageDictionarySource("CharacterPinyin", 0)
+    else:
+        return databaseReadingSource(falsepositiverate)
 
-def squelchMeaning(maxlensource):
+def squelchMeaning(source):
     log.info("Preparing to squelch meanings")
     
-    def inner(word):
-        for reading, meaningfun in maxlensource[1](word):
-            if meaningfun is None:
-                yield reading, None
-            else:
-                def squelch(*meanargs):
-                    meaning, measurewords = meaningfun(*meanargs)
-                    return None, measurewords
-                
-                yield reading, squelch
+    def squelch(meaningfun):
+        if meaningfun is None:
+            return None
+        
+        def inner(*meanargs):
+            meaning, measurewords = meaningfun(*meanargs)
+            return None, measurewords
+        
+        return inner
+    
+    def inner(words):
+        return dict([(word, [(reading, squelch(meaningfun)) for reading, meaningfun in readingsmeanings])
+                     for word, readingsmeanings in source.lookupmany(words).items()])
+    
+    return DictionarySource(source.prefixes, inner)
+
+"""
+Sources are expensive to load, so we load each of them at most once and share it between all of the
+dictionaries that use it, whatever their language. Each source is registered with a stamp describing
+the files it was loaded from: if the stamp changes, the source is loaded again the next time it is asked for.
+"""
+sharedsources = {}
+sharedsourceslock = threading.RLock()
+
+def sharedSource(key, stamp, load):
+    sharedsourceslock.acquire()
+    try:
+        stampedsource = sharedsources.get(key)
+        if stampedsource is None or stampedsource[0] != stamp:
+            stampedsource = (stamp, load())
+            sharedsources[key] = stampedsource
+        
+        return stampedsource[1]
+    finally:
+        sharedsourceslock.release()
+
+def sharedFileSource(dictname):
+    return sharedSource(("file", dictname), filesignature(dictionarypath(dictname)), lambda: fileSource(dictname))
+
+"""
+The user dictionary is watched rather than reloaded when it changes, since people edit it while the toolkit is running.
+"""
+def sharedUserDictionarySource():
+    def load():
+        source = WatchedFileSource(dictionarypath('dict-userdict.txt'))
+        source.listeners.append(invalidatelookupcaches)
+        return source
+    
+    return sharedSource(("watched", 'dict-userdict.txt'), None, load)
+
+def sharedTableDictionarySource(tablename, simptradindex, falsepositiverate):
+    stamp = (filesignature(db.dbpath), filesignature(dbimage.imagepath(tablename)))
+    return sharedSource(("table", tablename, simptradindex, falsepositiverate), stamp, lambda: tableDictionarySource(tablename, simptradindex, falsepositiverate))
+
+def sharedReadingSource(falsepositiverate):
+    stamp = (filesignature(db.dbpath), filesignature(dbimage.imagepath("CharacterPinyin")))
+    return sharedSource(("reading", falsepositiverate), stamp, lambda: readingSource(falsepositiverate))
+
+# The caches of lookup results (including negative ones) for each language outlive any particular set of loaded dictionaries
+lookupcaches = {}
+
+def lookupcache(language, capacity):
+    cache = lookupcaches.get(language)
+    if cache is None:
+        cache = LRUCache(capacity)
+        lookupcaches[language] = cache
+    else:
+        cache.resize(capacity)
     
-    return maxlensource[0], inner
+    return cache
+
+def invalidatelookupcaches(words):
+    for cache in lookupcaches.values():
+        cache.invalidate(words)
+
+def lookupcachestats():
+    return dict([(language, cache.stats()) for language, cache in lookupcaches.items()])
 
 """
 Encapsulates one or more Chinese dictionaries, and provides the ability to transform
@@ -106,61 +539,115 @@ class PinyinDictionary(object):
     lineregex = re.compile(r"^([^#\s]+)\s+([^\s]+)\s+\[([^\]]+)\](\s+)?(.*)$")
     
     @classmethod
-    def loadall(cls):
-        def buildDictionary(usefallback, table, simptradindex):
+    def loadall(cls, cachesize=0, falsepositiverate=defaultfalsepositiverate):
+        def buildDictionary(language, usefallback, table, simptradindex):
             # DEBUG - this means that we will lose measure words for languages other than English - seperate the two
             rawsources = [
                     # User dictionary has absolute priority
-                    fileSource('dict-userdict.txt'),
+                    sharedUserDictionarySource(),
                     # Pinyin Toolkit specific overrides for system dictionaries
-                    fileSource('pinyin_toolkit_sydict.u8'),
+                    sharedFileSource('pinyin_toolkit_sydict.u8'),
                     # Main language database
-                    table and databaseDictionarySource(table, simptradindex) or None,
-                    # Fallback databases for readings only if we have a non-english primary database
-                    usefallback and squelchMeaning(databaseDictionarySource("CEDICT", 1)) or None,
+                    table and sharedTableDictionarySource(table, simptradindex, falsepositiverate) or None,
+                    # Fallback databases for readings only if we have a non-english primary database.
+                    # NB: this shares the CEDICT data with the English dictionary: squelching is just a cheap wrapper
+                    usefallback and squelchMeaning(sharedTableDictionarySource("CEDICT", 1, falsepositiverate)) or None,
                     # Unihan as a last resort - lowest quality data
-                    databaseReadingSource()
+                    sharedReadingSource(falsepositiverate)
                 ]
             
-            return PinyinDictionary([source for source in rawsources if source is not None])
+            # NB: can't use and/or to choose the cache, because an empty cache is falsy
+            cache = None
+            if cachesize > 0:
+                cache = lookupcache(language, cachesize)
+            
+            return PinyinDictionary([source for source in rawsources if source is not None], cache)
         
-        dictionaries = {}
-        for language, table, simptradindex in [('en', "CEDICT", 1), ('de', "HanDeDict", 0), ('fr', "CFDICT", 0), ('default', None, None)]:
-            dictionaries[language] = Thunk(lambda l=language, t=table, sti=simptradindex: buildDictionary(l != 'en', t, sti))
+        def buildDictionaries():
+            dictionaries = {}
+            for language, table, simptradindex in [('en', "CEDICT", 1), ('de', "HanDeDict", 0), ('fr', "CFDICT", 0), ('default', None, None)]:
+                dictionaries[language] = Thunk(lambda l=language, t=table, sti=simptradindex: buildDictionary(l, l != 'en', t, sti))
+            
+            return database.generation, dictionaries
         
+        # NB: the pool moves on to a new generation when the database is replaced underneath us. The shared sources
+        # notice the new files and load again, but we have to ask for them again, and the cached lookups are stale
+        generationdictionaries = [buildDictionaries()]
         def inner(language):
+            generation, dictionaries = generationdictionaries[0]
+            if generation != database.generation:
+                log.info("The database has changed since we loaded the dictionaries, so loading them again")
+                for cache in lookupcaches.values():
+                    cache.clear()
+                
+                generation, dictionaries = generationdictionaries[0] = buildDictionaries()
+            
             return (dictionaries.get(language, None) or dictionaries['default'])()
         
         return inner
     
-    def __init__(self, maxlenssources):
-        maxlens, self.__sources = unzip(maxlenssources)
-        self.__maxcharacterlen = max(maxlens)
+    def __init__(self, sources, cache=None):
+        self.__sources = sources
+        self.__cache = cache
+        self.__maxcharacterlen = max([source.prefixes.maxwordlen for source in sources])
+    
+    """
+    Pick up any changes to the sources since we last looked.
+    """
+    def refresh(self):
+        changedwords = set()
+        for source in self.__sources:
+            changedwords.update(source.poll())
+        
+        # NB: the source has already told the shared caches, but ours may be private
+        if self.__cache is not None:
+            self.__cache.invalidate(changedwords)
+        
+        # NB: another dictionary sharing a source might have been the one to see it change
+        self.__maxcharacterlen = max([source.prefixes.maxwordlen for source in self.__sources])
 
     """
     Given a string of Hanzi, return the result rendered into a list of Pinyin and unrecognised tokens (as strings).
     """
     def reading(self, sentence):
         log.info("Requested reading for %s", sentence)
-        
+        return self.readingfromparsed(self.parse(sentence))
+    
+    """
+    Like reading, but for many sentences at once: yields the readings in the same order as the sentences.
+    """
+    def readingmany(self, sentences):
+        for parsed in self.parsemany(sentences):
+            yield self.readingfromparsed(parsed)
+    
+    def readingfromparsed(self, parsed):
         def addword(words, _text, readingtokens):
             words.append(Word(*readingtokens))
         
-        return self.mapparsedtokens(sentence, addword)
+        return self.mapparsedtokens(parsed, addword)
 
     """
     Given a string of Hanzi, return the result rendered into a list of characters with tone information and unrecognised tokens (as string).
     """
     def tonedchars(self, sentence):
         log.info("Requested toned characters for %s", sentence)
-        
+        return self.tonedcharsfromparsed(self.parse(sentence))
+    
+    """
+    Like tonedchars, but for many sentences at once: yields the toned characters in the same order as the sentences.
+    """
+    def tonedcharsmany(self, sentences):
+        for parsed in self.parsemany(sentences):
+            yield self.tonedcharsfromparsed(parsed)
+    
+    def tonedcharsfromparsed(self, parsed):
         def addword(words, text, readingtokens):
             # Match up the reading data with the characters to produce toned characters
             words.extend(tonedcharactersfromreading(text, [Word(*readingtokens)]))
         
-        return self.mapparsedtokens(sentence, addword)
+        return self.mapparsedtokens(parsed, addword)
 
-    def mapparsedtokens(self, sentence, addword):
+    def mapparsedtokens(self, parsed, addword):
         # Represents the resulting stream of words
         words = []
         
@@ -173,7 +660,7 @@ class PinyinDictionary(object):
                 words.append(Word(Text("".join(pendingunrecognised[0]))))
                 pendingunrecognised[0] = []
         
-        for readingsmeanings, text in self.parse(sentence):
+        for readingsmeanings, text in parsed:
             if readingsmeanings is None:
                 # A single unrecognised character: it's probably just whitespace or punctuation.
                 # Append it directly to the token list.
@@ -193,10 +680,19 @@ class PinyinDictionary(object):
     """
     def meanings(self, sentence, prefersimptrad):
         log.info("Requested meanings for %s", sentence)
-        
+        return self.meaningsfromparsed(self.parse(sentence), prefersimptrad)
+    
+    """
+    Like meanings, but for many sentences at once: yields the (meanings, measure words) pairs in the same order as the sentences.
+    """
+    def meaningsmany(self, sentences, prefersimptrad):
+        for parsed in self.parsemany(sentences):
+            yield self.meaningsfromparsed(parsed, prefersimptrad)
+    
+    def meaningsfromparsed(self, parsed, prefersimptrad):
         isfirstparsedthing = True
         foundmeanings, foundmeasurewords = None, None
-        for readingsmeanings, text in self.parse(sentence):
+        for readingsmeanings, text in parsed:
             if readingsmeanings is None and (ispunctuation(text.strip()) or text.strip() == u""):
                 # Discard punctuation and whitespace from consideration, or we don't return a reading for e.g. "你好!"
                 continue
@@ -212,19 +708,19 @@ class PinyinDictionary(object):
             isfirstparsedthing = False
             
             if readingsmeanings is not None:
-                # A recognised thing!  Find the definition in the dictionary:
-                while len(readingsmeanings) > 0 and readingsmeanings[0][1] is None:
-                    readingsmeanings.pop(0)
+                # A recognised thing!  Find the definition in the dictionary.
+                # NB: don't mutate the list, because parsemany shares it between sentences
+                meaningfuns = [meaningfun for _reading, meaningfun in readingsmeanings if meaningfun is not None]
                 
                 # Did we actually have a non-null meaning in there?
-                if len(readingsmeanings) == 0:
+                if len(meaningfuns) == 0:
                     # NB: we return None if there is no meaning in the codomain. This case can
                     # occur if the character only comes
                     log.info("We found a reading but no meaning for some text")
                     return None, None
                 else:
                     # Instantiate the raw definition with our particular requirements
-                    foundmeanings, foundmeasurewords = readingsmeanings[0][1](prefersimptrad, self.tonedchars)
+                    foundmeanings, foundmeasurewords = meaningfuns[0](prefersimptrad, self.tonedchars)
                     
         return foundmeanings, foundmeasurewords
 
@@ -236,14 +732,101 @@ class PinyinDictionary(object):
         # Strip HTML
         sentence = striphtml(sentence)
         
+        self.refresh()
+        
+        # Plan the segmentation using the prefix indexes alone, so that we can fetch the data for
+        # every word in the sentence from the sources in a single batch
+        found = self.parseexactmany(self.segmentwords(sentence))
+        for token in self.parsesegmented(sentence, found):
+            yield token
+    
+    """
+    Parse many sentences, yielding a list of the parsed tokens for each one in turn. We work through
+    the sentences in batches of parsebatchsize, looking up the words for a whole batch at once and only
+    segmenting each distinct sentence in the batch once, so this is much cheaper than calling parse
+    repeatedly. The sentences can be any iterable: we never hold more than one batch in memory.
+    
+    NB: the lists of readings and meanings may be shared between the results, so must not be mutated.
+    """
+    def parsemany(self, sentences):
+        for batch in chunked(sentences, parsebatchsize):
+            log.debug("Parsing a batch of %d sentences", len(batch))
+            self.refresh()
+            
+            batch = [striphtml(sentence) for sentence in batch]
+            distinctsentences = set(batch)
+            
+            words = []
+            for sentence in distinctsentences:
+                words.extend(self.segmentwords(sentence))
+            
+            found = self.parseexactmany(words)
+            parsed = dict([(sentence, list(self.parsesegmented(sentence, found))) for sentence in distinctsentences])
+            for sentence in batch:
+                yield parsed[sentence]
+    
+    """
+    Parse text of any size incrementally, yielding the same tokens that parse would for the whole of it.
+    The stream can be a file-like object open in Unicode mode (e.g. from codecs.open) or an iterable of
+    unicode chunks. We only keep hold of the text that might still be part of a word we haven't
+    decided on yet (or of an HTML tag we haven't seen the end of), so memory use doesn't grow with the text.
+    """
+    def parsestream(self, stream):
+        if hasattr(stream, "read"):
+            stream = iter(lambda file=stream: file.read(streamblocksize), u"")
+        
+        # Raw text that might be the start of an HTML tag, and stripped text we haven't parsed yet
+        unstripped, unparsed = u"", u""
+        for chunk in itertools.chain(stream, [None]):
+            isfinal = chunk is None
+            unstripped += chunk or u""
+            
+            # Hold back anything from the first unclosed tag onwards, unless it's too long to be a tag
+            tagstart = unstripped.find(u"<", unstripped.rfind(u">") + 1)
+            if isfinal or tagstart < 0 or len(unstripped) - tagstart > streammaxtaglength:
+                tagstart = len(unstripped)
+            
+            unparsed += striphtml(unstripped[:tagstart])
+            unstripped = unstripped[tagstart:]
+            
+            # Only parse as far as we can be sure that we can see the whole of any word starting there
+            self.refresh()
+            parseupto = isfinal and len(unparsed) or len(unparsed) - self.__maxcharacterlen
+            if parseupto <= 0:
+                continue
+            
+            # NB: only look up the words we are about to parse. The ones in the text we hold back will be
+            # looked up along with the next chunk, and parsesegmented looks up any stragglers itself
+            found = self.parseexactmany(self.segmentwords(unparsed, parseupto))
+            parsedupto = 0
+            for readingsmeanings, text in self.parsesegmented(unparsed, found, parseupto):
+                yield readingsmeanings, text
+                parsedupto += len(text)
+            
+            unparsed = unparsed[parsedupto:]
+    
+    """
+    Parse a sentence that has had HTML stripped, using the prefetched results of looking up words in it where possible.
+    If a stopping point is given, we don't yield any tokens starting at or beyond it.
+    """
+    def parsesegmented(self, sentence, found, stop=None):
+        if stop is None:
+            stop = len(sentence)
+        
         # Iterate through the text
         i = 0;
-        while i < len(sentence):
-            # Try all possible word lengths (naive, but easy to code)
+        while i < stop:
+            # Find the lengths of all the headwords starting here, and try the longest first.
+            # Only those candidates ever reach the sources.
             found_something = False
-            for word_len in range(self.__maxcharacterlen, 0, -1):
+            for word_len in reversed(self.matchlengths(sentence, i)):
                 candidate_word = sentence[i:i + word_len]
-                readingmeanings = self.parseexact(candidate_word)
+                if candidate_word not in found:
+                    # Only happens if a source indexes a word it then has no entries for, e.g. because
+                    # the index is a Bloom filter that gave us a false positive
+                    found[candidate_word] = self.parseexact(candidate_word)
+                
+                readingmeanings = found[candidate_word]
                 if len(readingmeanings) > 0:
                     # A real word! Let's yield it immediately
                     yield (readingmeanings, candidate_word)
@@ -259,12 +842,84 @@ class PinyinDictionary(object):
                 yield (None, sentence[i:i+1])
                 i += 1
     
+    """
+    Returns the lengths of all the headwords that start at the given position in the text,
+    shortest first. We walk the prefix indexes of all the sources in lockstep, and stop
+    extending the candidate as soon as it isn't the prefix of a headword in any of them.
+    """
+    def matchlengths(self, sentence, i):
+        lengths = []
+        for end in range(i + 1, min(len(sentence), i + self.__maxcharacterlen) + 1):
+            candidate_word = sentence[i:end]
+            
+            isprefix, isword = False, False
+            for source in self.__sources:
+                if source.prefixes.isprefix(candidate_word):
+                    isprefix = True
+                    isword = isword or candidate_word in source.prefixes
+            
+            if not(isprefix):
+                break
+            elif isword:
+                lengths.append(end - i)
+        
+        return lengths
+    
+    """
+    Returns the words that a maximal munch of the text would choose, judging by the prefix indexes alone.
+    If a stopping point is given, we don't return any words starting at or beyond it.
+    """
+    def segmentwords(self, sentence, stop=None):
+        if stop is None:
+            stop = len(sentence)
+        
+        words = []
+        i = 0
+        while i < stop:
+            lengths = self.matchlengths(sentence, i)
+            if len(lengths) == 0:
+                i += 1
+            else:
+                words.append(sentence[i:i + lengths[-1]])
+                i += lengths[-1]
+        
+        return words
+    
     # The readings and meaning functions returned for a word should correspond to each other,
     # and be returned in priority order: highest priority first
     def parseexact(self, word):
-        readingsmeanings = []
+        return self.parseexactmany([word])[word]
+    
+    def parseexactmany(self, words):
+        if self.__cache is None:
+            return self.lookupmany(words)
+        
+        readingsmeanings, missingwords = {}, []
+        for word in set(words):
+            cached = self.__cache.get(word)
+            if cached is None:
+                missingwords.append(word)
+            else:
+                readingsmeanings[word] = cached
+        
+        if len(missingwords) > 0:
+            for word, found in self.lookupmany(missingwords).items():
+                self.__cache[word] = found
+                readingsmeanings[word] = found
+        
+        # NB: hand out copies, because our callers are allowed to mutate the lists
+        return dict([(word, list(found)) for word, found in readingsmeanings.items()])
+    
+    def lookupmany(self, words):
+        readingsmeanings = dict([(word, []) for word in words])
         for source in self.__sources:
-            readingsmeanings.extend(source(word))
+            # Don't bother asking sources that we know don't have the word
+            sourcewords = [word for word in readingsmeanings.keys() if word in source.prefixes]
+            if len(sourcewords) == 0:
+                continue
+            
+            for word, sourcereadingsmeanings in source.lookupmany(sourcewords).items():
+                readingsmeanings[word].extend(sourcereadingsmeanings)
         
         # TODO: (perhaps) consolidate competing definitions from a single source if
         # they occur as a result of simplification and we prefer simplified characters
@@ -23,13 +23,16 @@ class BuildDB(QDialog):
 if __name__ == "__main__":
     import sys
     import time
+    import pinyin.db.builder
     import pinyin.forms.builddbcontroller
     import pinyin.mocks
     
     class MockDBBuilder(object):
-        def build(self):
+        def build(self, progress=None):
             print "Building!"
-            time.sleep(5)
+            for phase in pinyin.db.builder.buildphases:
+                time.sleep(1)
+                progress(pinyin.db.builder.Timing("phase", phase, 1.0))
             print "Building done"
     
     app = QApplication(sys.argv)
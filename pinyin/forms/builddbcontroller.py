@@ -7,6 +7,7 @@ import cjklib
 import sys
 
 from pinyin.logger import log
+import pinyin.db.builder
 
 
 def makerichtext(paragraphs):
@@ -41,37 +42,80 @@ updateddatabasemessage = makerichtext([
     ''
   ])
 
+"""
+A thread that just constructs the database, and then does whatever else we ask of it off the GUI thread, emitting
+buildprogress(timing) as each part of the build finishes, and buildsuccess() or buildfailure(exception info) when it is done.
+"""
+class BuildDBWorker(QThread):
+    def __init__(self, dbbuilder, afterbuild=None):
+        QThread.__init__(self)
+        self.dbbuilder = dbbuilder
+        self.afterbuild = afterbuild
+    
+    def run(self):
+        # NB: do not use suppressexceptions because throwing an exception at this point
+        # can cause segfaults in PyQt4 -- we better suppress the exception for developers too!
+        try:
+            self.dbbuilder.build(lambda timing: self.emit(SIGNAL("buildprogress(PyQt_PyObject)"), timing))
+            if self.afterbuild is not None:
+                self.afterbuild()
+            
+            self.emit(SIGNAL("buildsuccess()"))
+        except:
+            log.exception("Suppressed exception in database build process")
+            self.emit(SIGNAL("buildfailure(PyQt_PyObject)"), sys.exc_info())
+
 class BuildDBController(object):
     def __init__(self, view, notifier, dbbuilder, compulsory):
         # Reflect the initial setting values into the controls
         view.controls.explanationLabel.setText(compulsory and firstrunmessage or updateddatabasemessage)
         view.controls.cancelButtonBox.setEnabled(not(compulsory))
         
-        # Create and run a thread that just constructs the database
-        class Worker(QThread):
-            def run(self):
-                # NB: do not use suppressexceptions because throwing an exception at this point
-                # can cause segfaults in PyQt4 -- we better suppress the exception for developers too!
-                try:
-                    dbbuilder.build()
-                    self.emit(SIGNAL("buildsuccess()"))
-                except:
-                    log.exception("Suppressed exception in database build process")
-                    self.emit(SIGNAL("buildfailure(PyQt_PyObject)"), sys.exc_info())
+        # Count off the phases of the build as they finish
+        view.controls.progressBar.setMaximum(len(pinyin.db.builder.buildphases))
+        view.controls.progressBar.setValue(0)
         
         # NB: there is an EXTREMELY NASTY garbage collection bug lurking here. We need to
         # ensure that the QThread is not garbage collected or else we will get a segmentation
         # fault. This means that we must assign the thread as a member of self and make sure
         # that the BuildDBController is saved somewhere by >it's< user! Apparently this is
         # normal: <http://www.nabble.com/-python-Qt4-a-problem-of-QThread-td16993255.html>
-        self.thread = Worker()
+        self.thread = BuildDBWorker(dbbuilder)
         
         def buildFailure(e):
             notifier.exception("There was an error while building the Pinyin Toolkit database!", e)
             view.done(QDialog.Rejected)
         
+        def buildProgress(timing):
+            if timing.kind == "phase":
+                view.controls.progressBar.setValue(pinyin.db.builder.buildphases.index(timing.name) + 1)
+            
+            # Say what just finished on the bar itself, and give the full measurements when the user hovers over it
+            view.controls.progressBar.setFormat("%s %s: %.1fs" % (timing.name, timing.kind, timing.seconds))
+            view.controls.progressBar.setToolTip(str(timing))
+        
+        view.connect(self.thread, SIGNAL("buildprogress(PyQt_PyObject)"), buildProgress)
         view.connect(self.thread, SIGNAL("buildsuccess()"), lambda: view.done(QDialog.Accepted))
         view.connect(self.thread, SIGNAL("buildfailure(PyQt_PyObject)"), lambda e: buildFailure(e))
         
         # GO!
         self.thread.start()
+
+"""
+Rebuilds the database without showing any dialog, so that the user can get on with studying while it happens.
+Once it is built, the thread installs it as well: lookups carry on using the existing database until then.
+The same garbage collection caveats apply as to the BuildDBController.
+"""
+class BackgroundBuildDBController(object):
+    def __init__(self, parent, notifier, dbbuilder, install):
+        self.thread = BuildDBWorker(dbbuilder, install)
+        
+        def buildFailure(e):
+            # Nothing is lost: we carry on using the database we already have, and will try again next time
+            notifier.exception("There was an error while updating the Pinyin Toolkit database in the background!", e)
+        
+        parent.connect(self.thread, SIGNAL("buildsuccess()"), lambda: log.info("Finished updating the database in the background"))
+        parent.connect(self.thread, SIGNAL("buildfailure(PyQt_PyObject)"), lambda e: buildFailure(e))
+        
+        log.info("Updating the database in the background")
+        self.thread.start()
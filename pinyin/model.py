@@ -7,6 +7,7 @@ import sqlalchemy
 import unicodedata
 
 from db import database
+import db.schema as dbschema
 from logger import log
 import utils
 
@@ -111,13 +112,19 @@ class Text(unicode):
         return visitor.visitText(self)
 
 """
-Represents a single Pinyin character in the system.
+Represents a single Pinyin character in the system. Treat these as immutable: Pinyin.parse hands out
+the same Pinyin object every time it sees the same spelling.
 """
 class Pinyin(object):
     # Extract a simple regex of all the possible pinyin.
     # NB: we have to delay-load  this in order to give the UI a chance to create the database if it is missing
     # NB: we only need to consider the ü versions because the regex is used to check *after* we have normalised to ü
-    validpinyin = utils.Thunk(lambda: set(["r"] + [substituteForUUmlaut(pinyin[0]).lower() for pinyin in database.selectRows(sqlalchemy.select([sqlalchemy.Table("PinyinSyllables", database.metadata, autoload=True).c.Pinyin]))]))
+    # NB: this is shared between all threads, each of which queries the database through its own pooled connection
+    validpinyin = utils.SynchronizedThunk(lambda: set(["r"] + [substituteForUUmlaut(pinyin[0]).lower() for pinyin in database.selectRows(sqlalchemy.select([dbschema.pinyinsyllables.c.Pinyin]))]))
+    
+    # Maps the spellings of every valid pinyin that we expect to see a lot of to a Pinyin shared by all the spellings of
+    # that pinyin, along with whether the spelling was numeric. Delay-loaded for the same reason as validpinyin
+    spellings = utils.SynchronizedThunk(lambda: Pinyin.buildspellings())
     
     def __init__(self, word, toneinfo, htmlattrs=None):
         self.word = word
@@ -171,6 +178,42 @@ class Pinyin(object):
     """
     @classmethod
     def parse(cls, text, forcenumeric=False):
+        # Almost everything we parse is one of the spellings we know about, so just look it up
+        spelling = cls.spellings().get(text)
+        if spelling is not None and (spelling[1] or not(forcenumeric)):
+            return spelling[0]
+        
+        # Anything else (including tonified text when we need numeric pinyin, so that we raise the usual error) has to be parsed
+        return cls.parsewithoutspellings(text, forcenumeric=forcenumeric)
+    
+    """
+    Works out every spelling of every valid pinyin syllable and tone that we expect to see: numeric and tonified,
+    with each of the ways of writing ü, in lower case, capitalised and in upper case. We find out what each spelling means by
+    parsing it, so looking it up gives exactly what parsing would have done.
+    """
+    @classmethod
+    def buildspellings(cls):
+        spellings, shared = {}, {}
+        for word in cls.validpinyin():
+            for tone in range(1, 6):
+                numeric = word + unicode(tone)
+                for spelling in [numeric] + (waysToSubstituteAwayUUmlaut(numeric) or []) + [PinyinTonifier().tonify(numeric)]:
+                    for casedspelling in set([spelling, spelling.capitalize(), spelling.upper()]):
+                        try:
+                            pinyin = cls.parsewithoutspellings(casedspelling)
+                        except ValueError:
+                            # For example, the tonified neutral tone "r" is too short to be pinyin
+                            continue
+                        
+                        # Share one Pinyin between all the spellings that mean the same thing
+                        key = (pinyin.word, pinyin.toneinfo.written)
+                        spellings[casedspelling] = (shared.setdefault(key, pinyin), casedspelling[-1].isdigit())
+        
+        log.info("Found %d spellings of %d pinyin", len(spellings), len(shared))
+        return spellings
+    
+    @classmethod
+    def parsewithoutspellings(cls, text, forcenumeric=False):
         # Normalise u: and v: into umlauted version:
         # NB: might think about doing lower() here, as some dictionary words have upper case (e.g. proper names)
         text = substituteForUUmlaut(text)
@@ -399,10 +442,16 @@ def tokenize(html, forcenumeric=False):
         for attrs in attributesstack:
             current_attrs.update(attrs)
         
-        for k, v in current_attrs.items():
-            what.htmlattrs[k] = v
+        if len(current_attrs) == 0:
+            return what
         
-        return what
+        # NB: build a new token rather than changing the attributes of this one, because the Pinyin may be shared
+        htmlattrs = what.htmlattrs.copy()
+        htmlattrs.update(current_attrs)
+        if isinstance(what, Pinyin):
+            return Pinyin(what.word, what.toneinfo, htmlattrs)
+        else:
+            return Text(unicode(what), htmlattrs)
     
     # Stateful recursive algorithm for consuming the parse tree: tokens accumulate in the 'tokens' list
     tokens = []
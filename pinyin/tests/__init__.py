@@ -1,13 +1,28 @@
+import atexit
+import shutil
+import tempfile
+
+import pinyin.dictionary
+
+# Keep the caches of the parsed dictionary files that the tests load out of the source tree
+pinyin.dictionary.filecachedir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, pinyin.dictionary.filecachedir, True)
+
+import bloomfilter
+import builder
 import config
 import dictionary
 import dictionaryonline
 import factproxy
+import image
 import meanings
 import media
 import model
 import numbers
+import pool
 import model
 import statistics
 import transformations
+import trie
 import updater
 import utils
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from pinyin.bloomfilter import *
+from pinyin.utils import withtempdir
+
+
+class BloomFilterTest(unittest.TestCase):
+    def testNoFalseNegatives(self):
+        words = [unicode(n) for n in range(1000)]
+        bloomfilter = BloomFilter.forcapacity(len(words), 0.01)
+        for word in words:
+            bloomfilter.add(word)
+        
+        for word in words:
+            self.assertTrue(word in bloomfilter)
+    
+    def testFalsePositiveRate(self):
+        bloomfilter = BloomFilter.forcapacity(1000, 0.01)
+        for n in range(1000):
+            bloomfilter.add(unicode(n))
+        
+        falsepositives = len([n for n in range(1000, 11000) if unicode(n) in bloomfilter])
+        self.assertTrue(falsepositives < 300)
+    
+    def testEmpty(self):
+        self.assertFalse(u"你好" in BloomFilter.forcapacity(0, 0.01))
+
+class PrefixBloomFilterTest(unittest.TestCase):
+    def testWordsAndPrefixes(self):
+        prefixes = PrefixBloomFilter.fromwords([u"图书馆", u"书"], 0.0001)
+        self.assertEquals(prefixes.maxwordlen, 3)
+        
+        self.assertTrue(u"图书馆" in prefixes)
+        self.assertTrue(u"书" in prefixes)
+        self.assertFalse(u"图书" in prefixes)
+        
+        self.assertTrue(prefixes.isprefix(u"图"))
+        self.assertTrue(prefixes.isprefix(u"图书馆"))
+        self.assertFalse(prefixes.isprefix(u"馆"))
+    
+    def testSaveAndLoad(self):
+        def do(path):
+            filepath = os.path.join(path, "Prefixes")
+            PrefixBloomFilter.fromwords([u"图书馆", u"书"], 0.0001).save(filepath, "stamp")
+            
+            prefixes = PrefixBloomFilter.load(filepath, "stamp")
+            self.assertEquals(prefixes.maxwordlen, 3)
+            self.assertTrue(u"图书馆" in prefixes)
+            self.assertTrue(prefixes.isprefix(u"图书"))
+            self.assertFalse(u"图书" in prefixes)
+        
+        withtempdir(do)
+    
+    def testLoadOutOfDate(self):
+        def do(path):
+            filepath = os.path.join(path, "Prefixes")
+            PrefixBloomFilter.fromwords([u"书"], 0.01).save(filepath, "old stamp")
+            self.assertEquals(PrefixBloomFilter.load(filepath, "new stamp"), None)
+        
+        withtempdir(do)
+    
+    def testLoadOldFormat(self):
+        def do(path):
+            filepath = os.path.join(path, "Prefixes")
+            PrefixBloomFilter.fromwords([u"书"], 0.01).save(filepath, "stamp")
+            
+            # A filter saved by an older version hashed its words differently, so we can't use it
+            contents = open(filepath, "rb").read()
+            file = open(filepath, "wb")
+            try:
+                file.write("PTKBLOM1" + contents[8:])
+            finally:
+                file.close()
+            
+            self.assertEquals(PrefixBloomFilter.load(filepath, "stamp"), None)
+        
+        withtempdir(do)
+    
+    def testLoadTruncated(self):
+        def do(path):
+            filepath = os.path.join(path, "Prefixes")
+            PrefixBloomFilter.fromwords([u"图书馆", u"书"], 0.0001).save(filepath, "stamp")
+            contents = open(filepath, "rb").read()
+            
+            # Wherever we were interrupted writing the file, we shouldn't use what we got
+            for length in [0, 4, PrefixBloomFilter.headersize + 2, len(contents) - 1]:
+                file = open(filepath, "wb")
+                try:
+                    file.write(contents[:length])
+                finally:
+                    file.close()
+                
+                self.assertEquals(PrefixBloomFilter.load(filepath, "stamp"), None)
+        
+        withtempdir(do)
+    
+    def testSaveReplaces(self):
+        def do(path):
+            filepath = os.path.join(path, "Prefixes")
+            PrefixBloomFilter.fromwords([u"书"], 0.01).save(filepath, "old stamp")
+            PrefixBloomFilter.fromwords([u"图书馆"], 0.01).save(filepath, "new stamp")
+            
+            self.assertTrue(u"图书馆" in PrefixBloomFilter.load(filepath, "new stamp"))
+            self.assertEquals(os.listdir(path), ["Prefixes"])
+        
+        withtempdir(do)
+    
+    def testLoadMissing(self):
+        def do(path):
+            self.assertEquals(PrefixBloomFilter.load(os.path.join(path, "Missing"), "stamp"), None)
+        
+        withtempdir(do)
@@ -0,0 +1,612 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import unittest
+import zipfile
+
+import cjklib
+import cjklib.dbconnector
+import sqlalchemy
+
+import pinyin.db
+import pinyin.db.image
+import pinyin.db.trimunihan
+import pinyin.utils
+from pinyin.db.builder import *
+from pinyin.db.schema import *
+from pinyin.dictionary import headwordsquery, entriesquery, charactersquery, characterreadingsquery
+from pinyin.utils import concat, withtempdir
+
+
+# The tables as cjklib creates them, along with the indexes it gives them
+cjklibschema = concat([[
+    'CREATE TABLE "%s" ("HeadwordTraditional" VARCHAR(255), "HeadwordSimplified" VARCHAR(255), "Reading" VARCHAR(255) COLLATE NOCASE, "Translation" TEXT COLLATE NOCASE)' % tablename,
+    'CREATE INDEX "%s__HeadwordTraditional" ON "%s" ("HeadwordTraditional")' % (tablename, tablename),
+    'CREATE INDEX "%s__HeadwordSimplified" ON "%s" ("HeadwordSimplified")' % (tablename, tablename),
+    'CREATE INDEX "%s__Reading" ON "%s" ("Reading")' % (tablename, tablename)
+  ] for tablename in ["CEDICT", "CFDICT", "HanDeDict"]]) + [
+    'CREATE TABLE "CharacterPinyin" ("ChineseCharacter" VARCHAR(1) NOT NULL, "Reading" VARCHAR(255) NOT NULL, PRIMARY KEY ("ChineseCharacter", "Reading"))',
+    'CREATE TABLE PinyinSyllables (Pinyin VARCHAR(7) PRIMARY KEY, Source VARCHAR(1))'
+  ]
+
+rows = [(u"書", u"书", u"shu1", u"/book/"),
+        (u"圖書館", u"图书馆", u"tu2 shu1 guan3", u"/library/"),
+        (u"你好", u"你好", u"ni3 hao3", u"/hello/")]
+
+class RuntimeIndexesTest(unittest.TestCase):
+    def testCreatesIndexes(self):
+        def check(database):
+            indexnames = [row[0] for row in database.selectRows(sqlalchemy.text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'CEDICT'"))]
+            self.assertTrue("CEDICT__HeadwordSimplified_HeadwordTraditional" in indexnames)
+            self.assertTrue("CEDICT__HeadwordTraditional_HeadwordSimplified" in indexnames)
+        
+        withDatabase(check)
+    
+    def testIndexingTwiceIsHarmless(self):
+        withDatabase(createRuntimeIndexes)
+    
+    def testDictionaryQueriesUseIndexes(self):
+        def check(database):
+            self.assertIndexDriven(database, "CEDICT", headwordsquery(dictionarytables["CEDICT"]))
+            self.assertIndexDriven(database, "CEDICT", entriesquery(dictionarytables["CEDICT"], [u"书", u"圖書館"]))
+        
+        withDatabase(check)
+    
+    def testCharacterQueriesUseIndexes(self):
+        def check(database):
+            self.assertIndexDriven(database, "CharacterPinyin", charactersquery(characterpinyin))
+            self.assertIndexDriven(database, "CharacterPinyin", characterreadingsquery(characterpinyin, [u"书", u"你"]))
+        
+        withDatabase(check)
+    
+    # Test helpers
+    def assertIndexDriven(self, database, tablename, query):
+        compiled = query.compile(bind=database.engine)
+        parameters = [compiled.params[name] for name in compiled.positiontup]
+        
+        cursor = database.connection.connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + unicode(compiled), parameters)
+        plan = [row[-1] for row in cursor.fetchall()]
+        
+        # Every step that reads the table should go through an index
+        steps = [step for step in plan if tablename in step]
+        self.assertTrue(len(steps) > 0, plan)
+        for step in steps:
+            self.assertTrue("INDEX" in step, plan)
+
+class SchemaTest(unittest.TestCase):
+    def testVerifyRecordsVersion(self):
+        def check(database, path):
+            verifySchema(database)
+            self.assertEquals(databaseSchemaVersion(path), schemaversion)
+        
+        withDatabase(check, withpath=True)
+    
+    def testUnverifiedDatabaseHasNoVersion(self):
+        withDatabase(lambda database, path: self.assertEquals(databaseSchemaVersion(path), 0), withpath=True)
+    
+    def testVerifyMissingTable(self):
+        def check(database):
+            database.execute('DROP TABLE "HanDeDict"')
+            self.assertRaises(ValueError, lambda: verifySchema(database))
+        
+        withDatabase(check)
+    
+    def testVerifyMissingColumn(self):
+        def check(database):
+            database.execute('DROP TABLE "PinyinSyllables"')
+            database.execute('CREATE TABLE "PinyinSyllables" ("Syllable" VARCHAR(7), "Source" VARCHAR(1))')
+            self.assertRaises(ValueError, lambda: verifySchema(database))
+        
+        withDatabase(check)
+    
+    def testStaticTablesQueryDatabase(self):
+        def check(database):
+            self.assertEquals(database.selectRows(sqlalchemy.select([characterpinyin.c.Reading], characterpinyin.c.ChineseCharacter == u"书")), [(u"shu1",)])
+        
+        withDatabase(check)
+
+class ImageRowsTest(unittest.TestCase):
+    def testDictionaryRowsInFileOrder(self):
+        def check(database):
+            database.execute(sqlalchemy.text("INSERT INTO CEDICT VALUES (:t, :s, :r, :m)"), [dict(t=u"髮", s=u"发", r=u"fa4", m=u"/hair/"), dict(t=u"發", s=u"发", r=u"fa1", m=u"/to send out/")])
+            self.assertEquals([row[2] for row in imageRows(database, "CEDICT") if row[0] == u"发"], [u"fa4", u"fa1"])
+        
+        withDatabase(check)
+    
+    def testCharacterRowsInFileOrder(self):
+        def check(database):
+            database.execute(sqlalchemy.text("INSERT INTO CharacterPinyin VALUES (:c, :r)"), [dict(c=u"发", r=u"fa4"), dict(c=u"发", r=u"fa1")])
+            self.assertEquals([row for row in imageRows(database, "CharacterPinyin") if row[0] == u"发"], [(u"发", u"发", u"fa4", u""), (u"发", u"发", u"fa1", u"")])
+        
+        withDatabase(check)
+
+class ManifestTest(unittest.TestCase):
+    inputhashes = dict([(requirement, "hash of " + requirement) for requirement in ["cedict_ts.u8", "cfdict.u8", "handedict.u8", "Unihan.txt"]])
+    
+    def testOnlyChangedInputsMakeGroupsStale(self):
+        changedinputhashes = self.inputhashes.copy()
+        changedinputhashes["cfdict.u8"] = "hash of a newer cfdict.u8"
+        
+        stamps = groupStamps(DBBuilder.wantgroups, self.inputhashes)
+        self.assertEquals(staleGroups(DBBuilder.wantgroups, stamps, groupStamps(DBBuilder.wantgroups, changedinputhashes)), ["CFDICT"])
+    
+    def testNewBuilderMakesEverythingStale(self):
+        stamps = groupStamps(DBBuilder.wantgroups, self.inputhashes, "old builder")
+        self.assertEquals(staleGroups(DBBuilder.wantgroups, stamps, groupStamps(DBBuilder.wantgroups, self.inputhashes, "new builder")), DBBuilder.wantgroups)
+    
+    def testEverythingStaleWithoutManifest(self):
+        self.assertEquals(staleGroups(DBBuilder.wantgroups, {}, groupStamps(DBBuilder.wantgroups, self.inputhashes)), DBBuilder.wantgroups)
+    
+    def testManifestRoundTrip(self):
+        def check(database, path):
+            satisfiers = self.makeSatisfiers(os.path.dirname(path))
+            stamps = currentStamps(satisfiers, {})
+            writeManifest(database, stamps, satisfiers)
+            self.assertEquals(readManifest(path), stamps)
+            self.assertEquals(readKnownInputs(path), dict([(sourcefile.name, (sourcefile.signature(), sourcefile.hash)) for _requirement, sourcefile, _satisfier in satisfiers]))
+        
+        withDatabase(check, withpath=True)
+    
+    def testNoManifest(self):
+        self.assertEquals(readManifest(None), {})
+        self.assertEquals(readManifest(os.path.join(os.path.dirname(__file__), "nonexistant.db")), {})
+        withDatabase(lambda database, path: self.assertEquals(readManifest(path), {}), withpath=True)
+        withDatabase(lambda database, path: self.assertEquals(readKnownInputs(path), {}), withpath=True)
+    
+    def testNeedsRebuildMissingDatabase(self):
+        withtempdir(lambda path: self.assertEquals(needsRebuild(os.path.join(path, "missing.db"), self.makeSatisfiers(path)), True))
+    
+    def testNeedsRebuildWithoutManifest(self):
+        withDatabase(lambda database, path: self.assertEquals(needsRebuild(path, self.makeSatisfiers(os.path.dirname(path))), False), withpath=True)
+    
+    def testNeedsRebuild(self):
+        def check(database, path):
+            satisfiers = self.makeSatisfiers(os.path.dirname(path))
+            writeManifest(database, currentStamps(satisfiers, {}), satisfiers)
+            self.assertEquals(needsRebuild(path, self.makeSatisfiers(os.path.dirname(path))), None)
+            
+            # Touching a file without changing it is not enough to make us rebuild
+            cedictpath = os.path.join(os.path.dirname(path), "cedict_ts.u8")
+            os.utime(cedictpath, (0, 0))
+            self.assertEquals(needsRebuild(path, self.makeSatisfiers(os.path.dirname(path))), None)
+            
+            # But changing what is in it is
+            writefile(cedictpath, "a newer dictionary")
+            self.assertEquals(needsRebuild(path, self.makeSatisfiers(os.path.dirname(path))), False)
+        
+        withDatabase(check, withpath=True)
+    
+    def testNeedsRebuildForNewBuilder(self):
+        def check(database, path):
+            satisfiers = self.makeSatisfiers(os.path.dirname(path))
+            stamps = currentStamps(satisfiers, {})
+            stamps[builderkey] = "an older builder"
+            writeManifest(database, stamps, satisfiers)
+            self.assertEquals(needsRebuild(path, self.makeSatisfiers(os.path.dirname(path))), True)
+        
+        withDatabase(check, withpath=True)
+    
+    # Test helpers
+    def makeSatisfiers(self, path):
+        satisfiers = []
+        for requirement in self.inputhashes.keys():
+            filepath = os.path.join(path, requirement)
+            if not(os.path.exists(filepath)):
+                writefile(filepath, "contents of " + requirement)
+            
+            satisfiers.append((requirement, SourceFile(requirement, filepath, lambda filepath=filepath: pinyin.utils.filemd5(filepath)), None))
+        
+        return satisfiers
+
+class SourceFileTest(unittest.TestCase):
+    def testHashesNewFile(self):
+        withtempdir(lambda path: self.assertEquals(self.makeSourceFile(path).contenthash({}), "hash"))
+    
+    def testReusesKnownHashWhenUnchanged(self):
+        def do(path):
+            sourcefile = self.makeSourceFile(path)
+            self.assertEquals(sourcefile.contenthash({ "test.u8" : (sourcefile.signature(), "known hash") }), "known hash")
+            self.assertEquals(self.hashed, [])
+        
+        withtempdir(do)
+    
+    def testHashesAgainWhenChanged(self):
+        def do(path):
+            sourcefile = self.makeSourceFile(path)
+            modified, size = sourcefile.signature()
+            self.assertEquals(sourcefile.contenthash({ "test.u8" : ((modified, size + 1), "known hash") }), "hash")
+        
+        withtempdir(do)
+    
+    def testHashesOnlyOnce(self):
+        def do(path):
+            sourcefile = self.makeSourceFile(path)
+            sourcefile.contenthash({})
+            sourcefile.contenthash({})
+            self.assertEquals(self.hashed, ["test.u8"])
+        
+        withtempdir(do)
+    
+    # Test helpers
+    def makeSourceFile(self, path):
+        self.hashed = []
+        def computehash():
+            self.hashed.append("test.u8")
+            return "hash"
+        
+        filepath = os.path.join(path, "test.u8")
+        writefile(filepath, "contents")
+        return SourceFile("test.u8", filepath, computehash)
+
+class ParallelBuildTest(unittest.TestCase):
+    def testJobsKeepIndependentGroupsApart(self):
+        self.assertEquals(parallelJobs(DBBuilder.wantgroups), [["CEDICT"], ["CFDICT"], ["HanDeDict"], ["CharacterPinyin"], ["PinyinSyllables", "PinyinInitialFinal"]])
+    
+    def testJobsOnlyForStaleGroups(self):
+        self.assertEquals(parallelJobs(["PinyinInitialFinal", "CFDICT"]), [["CFDICT"], ["PinyinInitialFinal"]])
+    
+    def testMerge(self):
+        def do(path):
+            mainpath, partpath = os.path.join(path, "main.db"), os.path.join(path, "part.db")
+            self.makeDatabase(mainpath, ['CREATE TABLE "Kept" ("Value" INTEGER)', 'INSERT INTO "Kept" VALUES (1)'])
+            self.makeDatabase(partpath, ['CREATE TABLE "Built" ("Key" VARCHAR(255), "Value" INTEGER)', 'CREATE INDEX "Built__Key" ON "Built" ("Key")',
+                                         'INSERT INTO "Built" VALUES (\'a\', 2)', 'INSERT INTO "Built" VALUES (\'b\', 3)'])
+            
+            mergeDatabase(mainpath, partpath)
+            
+            connection = pinyin.db.sqlite.connect(mainpath)
+            try:
+                self.assertEquals(connection.execute('SELECT * FROM "Kept"').fetchall(), [(1,)])
+                self.assertEquals(connection.execute('SELECT * FROM "Built" ORDER BY "Key"').fetchall(), [(u"a", 2), (u"b", 3)])
+                self.assertEquals(connection.execute("SELECT tbl_name FROM sqlite_master WHERE name = 'Built__Key'").fetchall(), [(u"Built",)])
+                self.assertEquals(connection.execute("PRAGMA database_list").fetchall()[1:], [])
+            finally:
+                connection.close()
+        
+        withtempdir(do)
+    
+    def testBuildInWorkersAndMerge(self):
+        # NB: we don't need more than one processor to check that the workers and the merge work, just a way to start them
+        if multiprocessing is None or not(hasattr(os, "fork")):
+            return
+        
+        def do(path):
+            mainpath = os.path.join(path, "main.db")
+            self.makeDatabase(mainpath, [])
+            
+            datapath = os.path.join(os.path.dirname(cjklib.__file__), "data")
+            jobs = [(os.path.join(path, "part%d.db" % n), [group], [datapath]) for n, group in enumerate(["PinyinSyllables", "PinyinInitialFinal"])]
+            pool = multiprocessing.Pool(len(jobs))
+            try:
+                jobseconds = pool.map(buildGroupsInto, jobs)
+            finally:
+                pool.close()
+                pool.join()
+            
+            self.assertEquals(len(jobseconds), 2)
+            for partpath, _groups, _datapath in jobs:
+                mergeDatabase(mainpath, partpath)
+            
+            self.assertTrue(countRows(mainpath, "PinyinSyllables") > 400)
+            self.assertTrue(countRows(mainpath, "PinyinInitialFinal") > 400)
+        
+        withtempdir(do)
+    
+    def testSequentialUnlessAskedOrFlagged(self):
+        self.assertFalse(DBBuilder([]).parallel)
+        self.assertEquals(DBBuilder([], parallel=True).parallel, canBuildInParallel())
+    
+    # Test helpers
+    def makeDatabase(self, path, statements):
+        connection = pinyin.db.sqlite.connect(path)
+        try:
+            for statement in statements:
+                connection.execute(statement)
+            connection.commit()
+        finally:
+            connection.close()
+
+class NativeImportTest(unittest.TestCase):
+    contents = u"""# CFDICT -*- coding: utf-8 -*-
+書 书 [shu1] /livre/
+
+圖書館 图书馆 [tu2 shu1 guan3] /bibliothèque/
+not an entry
+你好 [ni3 hao3] /bonjour/
+"""
+
+    def testEntries(self):
+        def do(path):
+            sourcepath = self.writeDictionary(path)
+            self.assertEquals(list(dictionaryEntries(sourcepath)), [
+                (u"書", u"书", u"shu1", u"/livre/"),
+                (u"圖書館", u"图书馆", u"tu2 shu1 guan3", u"/bibliothèque/"),
+                (u"你好", None, u"ni3 hao3", u"/bonjour/")])
+        
+        withtempdir(do)
+    
+    def testImportBuildsCjklibTable(self):
+        def do(path):
+            dbpath = os.path.join(path, "test.db")
+            importDictionary(dbpath, "CFDICT", self.writeDictionary(path))
+            
+            connection = pinyin.db.sqlite.connect(dbpath)
+            try:
+                self.assertEquals(sorted([row[0] for row in connection.execute("SELECT sql FROM sqlite_master WHERE tbl_name = 'CFDICT'")]),
+                                  sorted([statement for statement in cjklibschema if '"CFDICT"' in statement]))
+                self.assertEquals(connection.execute('SELECT "HeadwordSimplified", "Translation" FROM "CFDICT" WHERE "Reading" = \'SHU1\'').fetchall(), [(u"书", u"/livre/")])
+            finally:
+                connection.close()
+        
+        withtempdir(do)
+    
+    # Test helpers
+    def writeDictionary(self, path):
+        sourcepath = os.path.join(path, "cfdict.u8")
+        writefile(sourcepath, self.contents.encode("utf-8"))
+        return sourcepath
+
+class CharacterReadingsTest(unittest.TestCase):
+    contents = u"""# Character readings extracted from Unihan.txt by trimunihan
+〇	ling2
+书	shu1
+
+行	hang2 xing2
+"""
+
+    def testReadings(self):
+        withtempdir(lambda path: self.assertEquals(list(characterReadings(self.writeReadings(path))),
+                                                   [(u"〇", u"ling2"), (u"书", u"shu1"), (u"行", u"hang2"), (u"行", u"xing2")]))
+    
+    def testImportBuildsCjklibTable(self):
+        def do(path):
+            dbpath = os.path.join(path, "test.db")
+            importCharacterPinyin(dbpath, self.writeReadings(path))
+            
+            connection = pinyin.db.sqlite.connect(dbpath)
+            try:
+                self.assertEquals([row[0] for row in connection.execute("SELECT sql FROM sqlite_master WHERE tbl_name = 'CharacterPinyin' AND sql IS NOT NULL")],
+                                  [statement for statement in cjklibschema if '"CharacterPinyin"' in statement])
+                self.assertEquals(connection.execute('SELECT "Reading" FROM "CharacterPinyin" WHERE "ChineseCharacter" = ? ORDER BY "Reading"', (u"行",)).fetchall(), [(u"hang2",), (u"xing2",)])
+            finally:
+                connection.close()
+        
+        withtempdir(do)
+    
+    # Test helpers
+    def writeReadings(self, path):
+        readingspath = os.path.join(path, "characterpinyin.tsv")
+        writefile(readingspath, self.contents.encode("utf-8"))
+        return readingspath
+
+class TrimUnihanTest(unittest.TestCase):
+    def testTrim(self):
+        def do(path):
+            unihanpath = os.path.join(path, "Unihan.txt")
+            writefile(unihanpath, "# Unihan database\n"
+                                  "U+4E66\tkDefinition\tbook\n"
+                                  "U+4E66\tkMandarin\tSHU1\n"
+                                  "U+4E66\tkXHC1983\t1059.010:sh\xc5\xab\n"
+                                  "\n"
+                                  "U+20000\tkCantonese\tho1\n"
+                                  "U+20000\tkMandarin\tHE1\n"
+                                  "U+20001\tkMandarinish\tHE1\n")
+            
+            pinyin.db.trimunihan.trim(unihanpath)
+            self.assertEquals(readfile(unihanpath), "# Unihan database\n"
+                                                    "U+4E66\tkMandarin\tSHU1\n"
+                                                    "U+4E66\tkXHC1983\t1059.010:sh\xc5\xab\n"
+                                                    "U+20000\tkMandarin\tHE1\n")
+            
+            # Nothing left lying around from writing the trimmed file
+            self.assertEquals(os.listdir(path), ["Unihan.txt"])
+        
+        withtempdir(do)
+
+class BuildTimingsTest(unittest.TestCase):
+    def testPhasesAddUpTheirTables(self):
+        timings = BuildTimings()
+        timings.phase("Importing")
+        timings.table("CEDICT", 2.0, 1000, 4096)
+        timings.table("CFDICT", 1.0, 500, None)
+        timings.phase("Building")
+        timings.finish()
+        
+        self.assertEquals([(timing.kind, timing.name) for timing in timings.timings],
+                          [("table", "CEDICT"), ("table", "CFDICT"), ("phase", "Importing"), ("phase", "Building")])
+        self.assertEquals((timings.timings[2].rows, timings.timings[2].bytesread), (1500, 4096))
+        self.assertEquals((timings.timings[3].rows, timings.timings[3].bytesread), (None, None))
+    
+    def testProgressSeesEachTiming(self):
+        seen = []
+        timings = BuildTimings(seen.append)
+        timings.phase("Copying")
+        timings.read(100)
+        timings.read(200)
+        timings.finish()
+        
+        self.assertEquals(seen, timings.timings)
+        self.assertEquals([(timing.name, timing.bytesread) for timing in seen], [("Copying", 300)])
+    
+    def testFinishTwiceIsHarmless(self):
+        timings = BuildTimings()
+        timings.phase("Planning")
+        timings.finish()
+        timings.finish()
+        self.assertEquals(len(timings.timings), 1)
+    
+    def testRowsPerSecond(self):
+        self.assertEquals(Timing("table", "CEDICT", 2.0, 1000).rowsPerSecond(), 500.0)
+        self.assertEquals(Timing("table", "CEDICT", 0.0, 1000).rowsPerSecond(), None)
+        self.assertEquals(Timing("phase", "Indexing", 2.0).rowsPerSecond(), None)
+    
+    def testDescription(self):
+        self.assertEquals(str(Timing("table", "CEDICT", 2.0, 1000, 1048576, 3 * 1048576)), "CEDICT table: 2.00s, 1000 rows, 500 rows/s, 1.0MB read, peak memory 3.0MB")
+        self.assertEquals(str(Timing("phase", "Indexing", 0.5)), "Indexing phase: 0.50s")
+    
+    def testPhasesAreKnown(self):
+        self.assertEquals(buildphases, ["Planning", "Copying", "Importing", "Building", "Indexing", "Compiling images"])
+    
+    def testCountRows(self):
+        def do(path):
+            databasepath = os.path.join(path, "test.db")
+            connection = pinyin.db.sqlite.connect(databasepath)
+            try:
+                connection.execute('CREATE TABLE "Test" ("Value" INTEGER)')
+                connection.executemany('INSERT INTO "Test" VALUES (?)', [(n,) for n in range(3)])
+                connection.commit()
+            finally:
+                connection.close()
+            
+            self.assertEquals(countRows(databasepath, "Test"), 3)
+        
+        withtempdir(do)
+
+class IncrementalBuildTest(unittest.TestCase):
+    def testRebuildsOnlyChangedTables(self):
+        def do(path):
+            sourcepath, installedpath = os.path.join(path, "sources"), os.path.join(path, "installed")
+            os.mkdir(sourcepath)
+            os.mkdir(installedpath)
+            
+            writefile(os.path.join(sourcepath, "cedict_ts.u8"), u"書 书 [shu1] /book/\n圖書館 图书馆 [tu2 shu1 guan3] /library/\n".encode("utf-8"))
+            writefile(os.path.join(sourcepath, "cfdict.u8"), u"書 书 [shu1] /livre/\n".encode("utf-8"))
+            writefile(os.path.join(sourcepath, "handedict.u8"), u"書 书 [shu1] /Buch/\n".encode("utf-8"))
+            writefile(os.path.join(sourcepath, "characterpinyin.tsv"), u"书\tshu1\n发\tfa4 fa1\n".encode("utf-8"))
+            
+            self.build(sourcepath, installedpath, None)
+            firstbuild = self.contents(installedpath)
+            
+            writefile(os.path.join(sourcepath, "cfdict.u8"), u"書 书 [shu1] /livre/\n圖書館 图书馆 [tu2 shu1 guan3] /bibliothèque/\n".encode("utf-8"))
+            rebuilt = self.build(sourcepath, installedpath, os.path.join(installedpath, "cjklib.db"))
+            secondbuild = self.contents(installedpath)
+            
+            self.assertEquals(rebuilt, [("table", "CFDICT"), ("image", "CFDICT")])
+            self.assertEquals([reading for _s, _t, reading, _m in secondbuild["CFDICT"]], [u"shu1", u"tu2 shu1 guan3"])
+            for tablename in ["CEDICT", "HanDeDict", "CharacterPinyin", "PinyinSyllables", "CEDICT.dictimage", "HanDeDict.dictimage", "CharacterPinyin.dictimage"]:
+                self.assertEquals(secondbuild[tablename], firstbuild[tablename], tablename)
+            
+            self.assertNotEquals(secondbuild["CFDICT.dictimage"], firstbuild["CFDICT.dictimage"])
+        
+        withtempdir(do)
+    
+    # Test helpers
+    def build(self, sourcepath, installedpath, existingdatabasepath):
+        satisfiers = []
+        for requirement in ["cedict_ts.u8", "cfdict.u8", "handedict.u8", "characterpinyin.tsv"]:
+            filepath = os.path.join(sourcepath, requirement)
+            satisfiers.append((requirement, SourceFile(requirement, filepath, lambda filepath=filepath: pinyin.utils.filemd5(filepath)), lambda target, filepath=filepath: linkOrCopyFile(filepath, target)))
+        
+        builder = DBBuilder(satisfiers, existingdatabasepath, parallel=False, native=False)
+        builder.cjkdatapath = os.path.join(os.path.dirname(cjklib.__file__), "data")
+        
+        timings = []
+        builder.build(timings.append)
+        
+        # NB: install the database before the images, so the images are no older than it
+        for builtpath, filename in [(builder.builtdatabasepath, "cjklib.db")] + [(builtimagepath, os.path.basename(builtimagepath)) for _tablename, builtimagepath in builder.builtimagepaths]:
+            shutil.copyfile(builtpath, os.path.join(installedpath, filename))
+        
+        return [(timing.kind, timing.name) for timing in timings if timing.kind != "phase"]
+    
+    def contents(self, installedpath):
+        contents = {}
+        connection = pinyin.db.sqlite.connect(os.path.join(installedpath, "cjklib.db"))
+        try:
+            for tablename in ["CEDICT", "CFDICT", "HanDeDict", "CharacterPinyin", "PinyinSyllables"]:
+                contents[tablename] = connection.execute('SELECT * FROM "%s" ORDER BY rowid' % tablename).fetchall()
+        finally:
+            connection.close()
+        
+        for tablename in pinyin.db.image.imagetables:
+            contents[pinyin.db.image.imagefilename(tablename)] = open(os.path.join(installedpath, pinyin.db.image.imagefilename(tablename)), "rb").read()
+        
+        return contents
+
+class SatisfierTest(unittest.TestCase):
+    # NB: bigger than a chunk, and with Windows line endings that must survive extraction untouched
+    contents = "".join(["%d\r\n" % n for n in range(50000)])
+    
+    def testExtractFromZip(self):
+        def do(path):
+            zippath, target = os.path.join(path, "test.zip"), os.path.join(path, "extracted.u8")
+            sourcezip = zipfile.ZipFile(zippath, "w", zipfile.ZIP_DEFLATED)
+            sourcezip.writestr("dictionary/cedict_ts.u8", self.contents)
+            sourcezip.close()
+            
+            extractFromZip(zipfile.ZipFile(zippath, "r"), "dictionary/cedict_ts.u8", target)
+            self.assertEquals(self.read(target), self.contents)
+        
+        withtempdir(do)
+    
+    def testLinkOrCopyFile(self):
+        def do(path):
+            source, target = os.path.join(path, "source.u8"), os.path.join(path, "target.u8")
+            sourcefile = open(source, "wb")
+            try:
+                sourcefile.write(self.contents)
+            finally:
+                sourcefile.close()
+            
+            linkOrCopyFile(source, target)
+            self.assertEquals(self.read(target), self.contents)
+            
+            # Getting rid of the target must leave the original alone
+            os.remove(target)
+            self.assertTrue(os.path.exists(source))
+        
+        withtempdir(do)
+    
+    # Test helpers
+    def read(self, path):
+        file = open(path, "rb")
+        try:
+            return file.read()
+        finally:
+            file.close()
+
+"""
+Runs the action with a connector to a fresh database that has the tables cjklib would build
+(along with some entries) and the indexes we add. The action also gets the path to the database
+if you ask for it.
+"""
+def withDatabase(do, withpath=False):
+    def inner(path):
+        dbpath = os.path.join(path, "test.db")
+        database = cjklib.dbconnector.DatabaseConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) })
+        try:
+            for statement in cjklibschema:
+                database.execute(statement)
+            
+            # NB: the query planner (rightly) prefers scanning a tiny table to using an index, so pad
+            # the tables out with enough filler that they look like real dictionaries to ANALYZE
+            allrows = rows + [(u"詞%d" % n, u"词%d" % n, u"ci2", u"/word/") for n in range(1000)]
+            database.execute(sqlalchemy.text("INSERT INTO CEDICT VALUES (:t, :s, :r, :m)"), [dict(t=t, s=s, r=r, m=m) for t, s, r, m in allrows])
+            database.execute(sqlalchemy.text("INSERT OR IGNORE INTO CharacterPinyin VALUES (:c, :r)"), [dict(c=s, r=r) for _t, s, r, _m in allrows])
+            
+            createRuntimeIndexes(database)
+            if withpath:
+                do(database, dbpath)
+            else:
+                do(database)
+        finally:
+            database.connection.close()
+            database.engine.dispose()
+    
+    withtempdir(inner)
+
+def readfile(path):
+    file = open(path, "rb")
+    try:
+        return file.read()
+    finally:
+        file.close()
+
+def writefile(path, contents):
+    file = open(path, "wb")
+    try:
+        file.write(contents)
+    finally:
+        file.close()
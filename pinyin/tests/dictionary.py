@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import itertools
+import marshal
+import os
+import StringIO
 import unittest
 
+import sqlalchemy
+
 from pinyin.db import database
+import pinyin.db.schema
+import pinyin.dictionary
 from pinyin.dictionary import *
+from pinyin.tests.builder import withDatabase
+from pinyin.trie import Trie
 
 
 dictionaries = PinyinDictionary.loadall()
@@ -120,6 +130,15 @@ class PinyinDictionaryTest(unittest.TestCase):
     def testTradMeanings(self):
         self.assertEquals(self.flatmeanings(englishdict, u"书", prefersimptrad="trad"), [u"book", u"letter", u"see also 書經 Book of History", u"MW: 本 - ben3, 冊 - ce4, 部 - bu4"])
     
+    def testManyMatchesSingle(self):
+        sentences = [u"一个", u"<b>你好</b>", u"", u"书!", u"一个"]
+        self.assertEquals([flatten(reading) for reading in englishdict.readingmany(iter(sentences))],
+                          [flatten(englishdict.reading(sentence)) for sentence in sentences])
+        self.assertEquals([flatten(tonedchars) for tonedchars in englishdict.tonedcharsmany(iter(sentences))],
+                          [flatten(englishdict.tonedchars(sentence)) for sentence in sentences])
+        self.assertEquals([self.flattenall(combinemeaningsmws(*meanings)) for meanings in englishdict.meaningsmany(iter(sentences), "simp")],
+                          [self.flatmeanings(englishdict, sentence) for sentence in sentences])
+    
     def testNonFlatMeanings(self):
         dictmeanings, dictmeasurewords = englishdict.meanings(u"书", prefersimptrad="simp")
         self.assertEquals(self.flattenall(dictmeanings), [u"book", u"letter", u"see also 书经 Book of History"])
@@ -135,4 +154,412 @@ class PinyinDictionaryTest(unittest.TestCase):
         if tokens:
             return [flatten(token) for token in tokens]
         else:
-            return None
\ No newline at end of file
+            return None
+
+class DictionaryFileCacheTest(unittest.TestCase):
+    def testParse(self):
+        def do(path):
+            filename = self.writedictionary(path, u"书 書 [shu1] /book/\n# A comment\n")
+            self.assertEquals(loadDictionaryFile(filename), { u"书" : [(u"shu1", u"/book/")], u"書" : [(u"shu1", u"/book/")] })
+            self.assertTrue(os.path.exists(dictionaryCachePath(filename)))
+        
+        withtempdir(do)
+    
+    def testUsesCache(self):
+        def do(path):
+            filename = self.writedictionary(path, u"书 書 [shu1] /book/\n")
+            loadDictionaryFile(filename)
+            
+            # Sneakily make the cache disagree with the file, so we can tell which one we read
+            stamp, _ = marshal.load(open(dictionaryCachePath(filename), "rb"))
+            marshal.dump((stamp, { u"书" : [(u"shu4", u"/tree/")] }), open(dictionaryCachePath(filename), "wb"))
+            
+            self.assertEquals(loadDictionaryFile(filename), { u"书" : [(u"shu4", u"/tree/")] })
+        
+        withtempdir(do)
+    
+    def testRegeneratesStaleCache(self):
+        def do(path):
+            filename = self.writedictionary(path, u"书 書 [shu1] /book/\n")
+            loadDictionaryFile(filename)
+            
+            self.writedictionary(path, u"好 好 [hao3] /good/\n")
+            self.assertEquals(loadDictionaryFile(filename), { u"好" : [(u"hao3", u"/good/"), (u"hao3", u"/good/")] })
+        
+        withtempdir(do)
+    
+    def testCacheNextToFileByDefault(self):
+        def do(path):
+            filename = self.writedictionary(path, u"书 書 [shu1] /book/\n")
+            
+            oldfilecachedir = pinyin.dictionary.filecachedir
+            pinyin.dictionary.filecachedir = None
+            try:
+                loadDictionaryFile(filename)
+                self.assertTrue(os.path.exists(filename + ".cache"))
+            finally:
+                pinyin.dictionary.filecachedir = oldfilecachedir
+        
+        withtempdir(do)
+    
+    def testIgnoresCorruptCache(self):
+        def do(path):
+            filename = self.writedictionary(path, u"书 書 [shu1] /book/\n")
+            open(dictionaryCachePath(filename), "wb").write("garbage")
+            self.assertEquals(loadDictionaryFile(filename)[u"书"], [(u"shu1", u"/book/")])
+        
+        withtempdir(do)
+    
+    # Test helper
+    def writedictionary(self, path, contents):
+        filename = os.path.join(path, "dict-test.txt")
+        file = open(filename, "w")
+        file.write(contents.encode("utf-8"))
+        file.close()
+        
+        return filename
+
+class WatchedFileSourceTest(unittest.TestCase):
+    def testMissingFile(self):
+        def do(path):
+            source = WatchedFileSource(os.path.join(path, "dict-userdict.txt"), pollinterval=0)
+            self.assertEquals(source(u"书"), [])
+            self.assertEquals(source.poll(), [])
+        
+        withtempdir(do)
+    
+    def testPicksUpCreatedFile(self):
+        def do(path):
+            filename = os.path.join(path, "dict-userdict.txt")
+            source = WatchedFileSource(filename, pollinterval=0)
+            
+            self.writedictionary(filename, [u"书 書 [shu1] /book/"])
+            self.assertEquals(source.poll(), set([u"书", u"書"]))
+            self.assertEquals([reading for reading, _ in source(u"书")], [u"shu1"])
+            self.assertTrue(u"書" in source.prefixes)
+        
+        withtempdir(do)
+    
+    def testOnlyChangedHeadwordsAreReported(self):
+        def do(path):
+            filename = os.path.join(path, "dict-userdict.txt")
+            self.writedictionary(filename, [u"书 書 [shu1] /book/", u"好 好 [hao3] /good/", u"图书馆 圖書館 [tu2 shu1 guan3] /library/"])
+            
+            changes = []
+            source = WatchedFileSource(filename, pollinterval=0)
+            source.listeners.append(changes.append)
+            
+            self.writedictionary(filename, [u"书 書 [shu1] /book/", u"好 好 [hao4] /to like/", u"你 你 [ni3] /you/"])
+            self.assertEquals(source.poll(), set([u"好", u"图书馆", u"圖書館", u"你"]))
+            self.assertEquals(changes, [set([u"好", u"图书馆", u"圖書館", u"你"])])
+            
+            self.assertEquals([reading for reading, _ in source(u"好")], [u"hao4", u"hao4"])
+            self.assertEquals(source(u"图书馆"), [])
+            self.assertFalse(u"图书馆" in source.prefixes)
+            self.assertEquals([reading for reading, _ in source(u"你")], [u"ni3", u"ni3"])
+            self.assertEquals([reading for reading, _ in source(u"书")], [u"shu1"])
+        
+        withtempdir(do)
+    
+    def testKeepsFileOrder(self):
+        def do(path):
+            filename = os.path.join(path, "dict-userdict.txt")
+            self.writedictionary(filename, [u"书 書 [shu1] /book/"])
+            source = WatchedFileSource(filename, pollinterval=0)
+            
+            self.writedictionary(filename, [u"书 书 [shu4] /tree/", u"书 書 [shu1] /book/"])
+            source.poll()
+            self.assertEquals([reading for reading, _ in source(u"书")], [u"shu4", u"shu4", u"shu1"])
+        
+        withtempdir(do)
+    
+    def testPollInterval(self):
+        def do(path):
+            filename = os.path.join(path, "dict-userdict.txt")
+            source = WatchedFileSource(filename, pollinterval=1000)
+            
+            self.writedictionary(filename, [u"书 書 [shu1] /book/"])
+            self.assertEquals(source.poll(), [])
+        
+        withtempdir(do)
+    
+    def testDictionarySeesChanges(self):
+        def do(path):
+            filename = os.path.join(path, "dict-userdict.txt")
+            self.writedictionary(filename, [u"书 書 [shu1] /book/"])
+            dictionary = PinyinDictionary([WatchedFileSource(filename, pollinterval=0)], LRUCache(10))
+            self.assertEquals([text for _, text in dictionary.parse(u"图书馆")], [u"图", u"书", u"馆"])
+            
+            self.writedictionary(filename, [u"书 書 [shu1] /book/", u"图书馆 圖書館 [tu2 shu1 guan3] /library/"])
+            self.assertEquals([text for _, text in dictionary.parse(u"图书馆")], [u"图书馆"])
+        
+        withtempdir(do)
+    
+    # Test helper
+    def writedictionary(self, filename, lines):
+        file = open(filename, "w")
+        file.write(u"\n".join(lines).encode("utf-8") + "\n")
+        file.close()
+
+class SharedSourceTest(unittest.TestCase):
+    def testLoadsOnce(self):
+        loads = []
+        for n in range(2):
+            source = sharedSource(("test", "once"), 1, lambda: loads.append(None) or len(loads))
+        
+        self.assertEquals(source, 1)
+        self.assertEquals(len(loads), 1)
+    
+    def testReloadsWhenStampChanges(self):
+        loads = []
+        for stamp in [1, 1, 2]:
+            source = sharedSource(("test", "stamp"), stamp, lambda: loads.append(None) or len(loads))
+        
+        self.assertEquals(source, 2)
+    
+    def testLanguagesShareSources(self):
+        loads = []
+        def countingFileSource(dictname):
+            loads.append(dictname)
+            return fileSource(dictname)
+        
+        sharedsources.clear()
+        pinyin.dictionary.fileSource = countingFileSource
+        try:
+            dictionaries = PinyinDictionary.loadall()
+            dictionaries('en'), dictionaries('fr'), PinyinDictionary.loadall()('de')
+        finally:
+            pinyin.dictionary.fileSource = fileSource
+            sharedsources.clear()
+        
+        # NB: the user dictionary is a watched source, so isn't loaded by fileSource
+        self.assertEquals(loads, ['pinyin_toolkit_sydict.u8'])
+    
+    def testUserDictionaryShared(self):
+        self.assertTrue(sharedUserDictionarySource() is sharedUserDictionarySource())
+
+class HeadwordPrefixesTest(unittest.TestCase):
+    def testRebuildsCorruptFilter(self):
+        def check(prefixespath):
+            file = open(prefixespath, "wb")
+            try:
+                file.write("PTKBLOM2")
+            finally:
+                file.close()
+            
+            self.assertTrue(u"书" in headwordPrefixes("Test", lambda: [u"书"], 0.01))
+            self.assertTrue(u"书" in headwordPrefixes("Test", lambda: self.fail("Should have saved the rebuilt filter"), 0.01))
+        
+        self.withprefixespath(check)
+    
+    def testBuildsFilterWhenFileUnreadable(self):
+        def check(prefixespath):
+            os.mkdir(prefixespath)
+            self.assertTrue(u"书" in headwordPrefixes("Test", lambda: [u"书"], 0.01))
+        
+        self.withprefixespath(check)
+    
+    # Test helpers
+    def withprefixespath(self, do):
+        def inner(path):
+            olddbpath = pinyin.db.dbpath
+            pinyin.db.dbpath = os.path.join(path, "cjklib.db")
+            try:
+                file = open(pinyin.db.dbpath, "wb")
+                file.close()
+                do(os.path.join(path, "Test.prefixes"))
+            finally:
+                pinyin.db.dbpath = olddbpath
+        
+        withtempdir(inner)
+
+class BatchQueryTest(unittest.TestCase):
+    def testMatchesSQLAlchemy(self):
+        query, makequery = self.makequery()
+        for characters in [[u"书"], [u"书", u"你", u"好"], [u"一", u"个", u"啤", u"酒", u"书"]]:
+            self.assertEquals(sorted(query(characters)), sorted(database.selectRows(makequery(characters))))
+    
+    def testBucketsStatements(self):
+        query, _makequery = self.makequery()
+        query([u"你", u"好", u"书"])
+        query([u"一", u"个", u"书", u"啤"])
+        self.assertEquals(query.statements.keys(), [4])
+    
+    def testNoWords(self):
+        query, _makequery = self.makequery()
+        self.assertEquals(query([]), [])
+    
+    def testFallsBackOnSQLAlchemy(self):
+        query, _makequery = self.makequery()
+        def fail(words):
+            raise ValueError("Broken")
+        query.executeraw = fail
+        
+        self.assertEquals(sorted(query([u"书"])), [(u"书", u"shu1")])
+        self.assertFalse(query.useraw)
+    
+    def testFallsBackOnSQLAlchemyOnlyOnceForDatabaseErrors(self):
+        query, _makequery = self.makequery()
+        def fail(words):
+            raise pinyin.db.sqlite.OperationalError("database is locked")
+        query.executeraw = fail
+        
+        self.assertEquals(sorted(query([u"书"])), [(u"书", u"shu1")])
+        self.assertTrue(query.useraw)
+    
+    def testBucketSizes(self):
+        self.assertEquals([bucketsize(n) for n in [1, 2, 3, 5, 100, 200, 250]], [1, 2, 4, 8, 128, 250, 250])
+    
+    # Test helpers
+    def makequery(self):
+        makequery = lambda characters: characterreadingsquery(pinyin.db.schema.characterpinyin, characters)
+        return BatchQuery(makequery), makequery
+
+class EntryOrderTest(unittest.TestCase):
+    def testEntriesInFileOrder(self):
+        def check(database):
+            # NB: the indexes on the headword pairs would give us the entries sorted by their other headword. Make
+            # sure that SQLite uses them, rather than the indexes cjklib has on each headword by itself
+            for column in ["HeadwordSimplified", "HeadwordTraditional"]:
+                database.execute('DROP INDEX "CEDICT__%s"' % column)
+            
+            self.insertRows(database, "INSERT INTO CEDICT VALUES (:t, :s, :r, :m)", [dict(t=u"髮", s=u"发", r=u"fa4", m=u"/hair/"), dict(t=u"發", s=u"发", r=u"fa1", m=u"/to send out/")])
+            query = entriesquery(pinyin.db.schema.dictionarytables["CEDICT"], [u"发"])
+            self.assertEquals([reading for _s, _t, reading, _m in database.selectRows(query)], [u"fa4", u"fa1"])
+        
+        withDatabase(check)
+    
+    def testCharacterReadingsInFileOrder(self):
+        def check(database):
+            # NB: the primary key would give us the readings sorted alphabetically
+            self.insertRows(database, "INSERT INTO CharacterPinyin VALUES (:c, :r)", [dict(c=u"发", r=u"fa4"), dict(c=u"发", r=u"fa1")])
+            query = characterreadingsquery(pinyin.db.schema.characterpinyin, [u"发"])
+            self.assertEquals([reading for _c, reading in database.selectRows(query)], [u"fa4", u"fa1"])
+        
+        withDatabase(check)
+    
+    # Test helpers
+    def insertRows(self, database, statement, rows):
+        database.execute(sqlalchemy.text(statement), rows)
+
+class PinyinDictionaryParseTest(unittest.TestCase):
+    def testLongestMatch(self):
+        dict = self.makedictionary([u"图", u"图书", u"图书馆", u"馆"])
+        self.assertEquals([text for _, text in dict.parse(u"图书馆!")], [u"图书馆", u"!"])
+    
+    def testLongestMatchAcrossSources(self):
+        dict = self.makedictionary([u"图书"], [u"图书馆"])
+        self.assertEquals([text for _, text in dict.parse(u"图书馆")], [u"图书馆"])
+    
+    def testOnlyAsksSourcesWithTheWord(self):
+        asked = []
+        dict = self.makedictionary([u"图书"], [u"馆"], asked=asked)
+        self.assertEquals([text for _, text in dict.parse(u"图书馆")], [u"图书", u"馆"])
+        self.assertEquals(asked, [(0, u"图书"), (1, u"馆")])
+    
+    def testBatchesLookupsForWholeSentence(self):
+        asked = []
+        dict = self.makedictionary([u"图书", u"馆"], asked=asked)
+        list(dict.parse(u"图书馆"))
+        self.assertEquals(sorted(asked), [(0, u"图书"), (0, u"馆")])
+    
+    def testUnrecognisedCharacters(self):
+        dict = self.makedictionary([u"书"])
+        self.assertEquals(list(dict.parse(u"a书")), [(None, u"a"), ([(u"shu1", None)], u"书")])
+    
+    def testParseMany(self):
+        asked = []
+        dict = self.makedictionary([u"图书", u"馆"], asked=asked)
+        self.assertEquals([[text for _, text in parsed] for parsed in dict.parsemany(iter([u"图书馆", u"<i>图书</i>", u"图书馆"]))],
+                          [[u"图书", u"馆"], [u"图书"], [u"图书", u"馆"]])
+        self.assertEquals(sorted(asked), [(0, u"图书"), (0, u"馆")])
+    
+    def testParseStreamMatchesParse(self):
+        dict = self.makedictionary([u"图", u"图书", u"图书馆", u"馆", u"书"])
+        text = u"我的<b>图书</b>馆有书。<a href='x'>图书馆</a>图"
+        expected = [token for token in dict.parse(text)]
+        for chunksize in range(1, len(text) + 1):
+            chunks = [text[i:i + chunksize] for i in range(0, len(text), chunksize)]
+            self.assertEquals(list(dict.parsestream(chunks)), expected)
+    
+    def testParseStreamFromFile(self):
+        dict = self.makedictionary([u"图书馆", u"书"])
+        self.assertEquals([text for _, text in dict.parsestream(StringIO.StringIO(u"图书馆<br />书"))], [u"图书馆", u"书"])
+    
+    def testParseStreamIsIncremental(self):
+        dict = self.makedictionary([u"图书馆"])
+        def chunks():
+            yield u"图书馆图书馆"
+            yield u"图"
+            raise AssertionError("Read further than we needed to")
+        
+        self.assertEquals([text for _, text in itertools.islice(dict.parsestream(chunks()), 2)], [u"图书馆", u"图书馆"])
+    
+    def testParseStreamLooksUpHeldBackWordsOnce(self):
+        asked = []
+        dict = self.makedictionary([u"图书", u"馆", u"书"], asked=asked)
+        self.assertEquals([text for _, text in dict.parsestream(iter([u"图书", u"馆书"]))], [u"图书", u"馆", u"书"])
+        self.assertEquals(sorted(asked), sorted([(0, u"图书"), (0, u"馆"), (0, u"书")]))
+    
+    def testCachesLookups(self):
+        asked = []
+        dict = self.makedictionary([u"图书", u"馆"], asked=asked, cache=LRUCache(10))
+        list(dict.parse(u"图书馆"))
+        list(dict.parse(u"图书"))
+        self.assertEquals(sorted(asked), [(0, u"图书"), (0, u"馆")])
+    
+    def testCachesNegativeResults(self):
+        asked = []
+        dict = self.makedictionary([u"书"], asked=asked, empty=[u"书"], cache=LRUCache(10))
+        self.assertEquals(dict.parseexact(u"书"), [])
+        self.assertEquals(dict.parseexact(u"书"), [])
+        self.assertEquals(asked, [(0, u"书")])
+    
+    def testCachedResultsCanBeMutated(self):
+        dict = self.makedictionary([u"书"], cache=LRUCache(10))
+        dict.parseexact(u"书").pop()
+        self.assertEquals(dict.parseexact(u"书"), [(u"shu1", None)])
+    
+    def testLoadAllUsesCache(self):
+        lookupcaches.clear()
+        try:
+            dict = PinyinDictionary.loadall(10)('en')
+            dict.reading(u"书")
+            dict.reading(u"书")
+            self.assertEquals([lookupcachestats()['en'][key] for key in ["hits", "misses"]], [1, 1])
+        finally:
+            lookupcaches.clear()
+    
+    def testLoadAllReloadsWhenDatabaseReplaced(self):
+        lookupcaches.clear()
+        try:
+            dicts = PinyinDictionary.loadall(10)
+            dicts('en').reading(u"书")
+            self.assertEquals(dicts('en'), dicts('en'))
+            
+            olddict = dicts('en')
+            database.reset()
+            self.assertNotEquals(dicts('en'), olddict)
+            self.assertEquals(len(lookupcaches['en']), 0)
+        finally:
+            lookupcaches.clear()
+    
+    def testCacheStatistics(self):
+        cache = LRUCache(1)
+        dict = self.makedictionary([u"书", u"馆"], cache=cache)
+        for word in [u"书", u"书", u"馆"]:
+            dict.parseexact(word)
+        
+        self.assertEquals([cache.stats()[key] for key in ["hits", "misses", "evictions", "size"]], [1, 2, 1, 1])
+    
+    # Test helper
+    def makedictionary(self, *sourceswords, **kwargs):
+        asked, empty = kwargs.get("asked", []), kwargs.get("empty", [])
+        def makesource(n, words):
+            def lookupmany(lookupwords):
+                asked.extend([(n, word) for word in lookupwords])
+                return dict([(word, word not in empty and [(u"shu1", None)] or []) for word in lookupwords])
+            
+            return DictionarySource(Trie(words), lookupmany)
+        
+        return PinyinDictionary([makesource(n, words) for n, words in enumerate(sourceswords)], kwargs.get("cache"))
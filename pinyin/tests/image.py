@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from pinyin.db.image import *
+from pinyin.dictionary import DictionarySource, PinyinDictionary
+from pinyin.utils import withtempdir
+
+
+class DictionaryImageTest(unittest.TestCase):
+    rows = [(u"书", u"書", u"shu1", u"/book/"),
+            (u"图书馆", u"圖書館", u"tu2 shu1 guan3", u"/library/"),
+            (u"图书", u"圖書", u"tu2 shu1", u"/books (in a library)/"),
+            (u"书", u"书", u"shu1", u"/letter/"),
+            (u"Ｕ盘", u"Ｕ盤", u"U pan2", u"")]
+    
+    def testLookup(self):
+        self.withImage(lambda image: self.assertEquals(image.lookup(u"图书馆"), [(u"tu2 shu1 guan3", u"/library/")]))
+        self.withImage(lambda image: self.assertEquals(image.lookup(u"圖書"), [(u"tu2 shu1", u"/books (in a library)/")]))
+    
+    def testLookupKeepsEntryOrder(self):
+        self.withImage(lambda image: self.assertEquals(image.lookup(u"书"), [(u"shu1", u"/book/"), (u"shu1", u"/letter/")]))
+    
+    def testLookupMissing(self):
+        self.withImage(lambda image: self.assertEquals(image.lookup(u"图"), []))
+        self.withImage(lambda image: self.assertEquals(image.lookup(u"龍"), []))
+        self.withImage(lambda image: self.assertEquals(image.lookup(u"a"), []))
+    
+    def testEmptyTranslation(self):
+        self.withImage(lambda image: self.assertEquals(image.lookup(u"Ｕ盘"), [(u"U pan2", u"")]))
+    
+    def testPrefixIndex(self):
+        def check(image):
+            self.assertTrue(u"图书" in image)
+            self.assertFalse(u"图" in image)
+            self.assertTrue(image.isprefix(u"图"))
+            self.assertTrue(image.isprefix(u"图书馆"))
+            self.assertFalse(image.isprefix(u"图书馆!"))
+            self.assertEquals(image.maxwordlen, 3)
+            self.assertEquals(len(image), 8)
+        
+        self.withImage(check)
+    
+    def testHeadwordsAreSorted(self):
+        self.withImage(lambda image: self.assertEquals(list(image.headwords()), sorted(list(image.headwords()))))
+    
+    def testEmptyImage(self):
+        def check(image):
+            self.assertEquals(image.lookup(u"书"), [])
+            self.assertFalse(image.isprefix(u"书"))
+        
+        self.withImage(check, rows=[])
+    
+    def testSegmentsWithImageAsIndex(self):
+        def check(image):
+            source = DictionarySource(image, lambda words: dict([(word, [(reading, None) for reading, _ in image.lookup(word)]) for word in words]))
+            self.assertEquals([text for _, text in PinyinDictionary([source]).parse(u"图书馆的书")], [u"图书馆", u"的", u"书"])
+        
+        self.withImage(check)
+    
+    # Test helper
+    def withImage(self, check, rows=None):
+        def go(tempdir):
+            path = os.path.join(tempdir, imagefilename("Test"))
+            writeimage(path, rows is None and self.rows or rows)
+            
+            image = DictionaryImage(path)
+            try:
+                check(image)
+            finally:
+                image.close()
+        
+        withtempdir(go)
@@ -147,6 +147,28 @@ class PinyinTest(unittest.TestCase):
     
     def testRejectsPinyinlikeEnglish(self):
         self.assertRaises(ValueError, lambda: Pinyin.parse("USB"))
+    
+    def testParseSharesPinyin(self):
+        self.assertTrue(Pinyin.parse(u"lü3") is Pinyin.parse(u"lv3"))
+        self.assertTrue(Pinyin.parse(u"lü3") is Pinyin.parse(u"lu:3"))
+        self.assertTrue(Pinyin.parse(u"lü3") is Pinyin.parse(u"lǚ"))
+        self.assertTrue(Pinyin.parse(u"Xiao3") is Pinyin.parse(u"Xiǎo"))
+        self.assertFalse(Pinyin.parse(u"Xiao3") is Pinyin.parse(u"xiao3"))
+    
+    def testParseUpperCaseFromSpellings(self):
+        self.assertTrue(Pinyin.parse(u"ZHONG1") is Pinyin.spellings()[u"ZHONG1"][0])
+        self.assertTrue(Pinyin.parse(u"ZHONG1") is Pinyin.parse(u"ZHŌNG"))
+        self.assertEquals(Pinyin.parse(u"ZHONG1"), Pinyin(u"ZHONG", 1))
+    
+    def testParseUnusualSpellings(self):
+        self.assertEquals(Pinyin.parse(u"xIAO3"), Pinyin(u"xIAO", 3))
+        self.assertEquals(Pinyin.parse(u"xiǎo"), Pinyin(u"xiao", 3))
+        self.assertRaises(ValueError, lambda: Pinyin.parse(u"xiǎo", forcenumeric=True))
+    
+    def testSpellingsParseTheSame(self):
+        for spelling, (pinyin, numeric) in Pinyin.spellings().items():
+            self.assertEquals(Pinyin.parsewithoutspellings(spelling), pinyin)
+            self.assertEquals(numeric, spelling[-1].isdigit())
 
 class TextTest(unittest.TestCase):
     def testNonEmpty(self):
@@ -307,6 +329,10 @@ class TokenizeTest(unittest.TestCase):
         self.assertEquals([Text(u'<span style="">'), Pinyin(u'tou', 2, { "color" : "#123456" }), Text(u'</span>'), Text(u' '), Text(u'<span style="">'), Pinyin(u'er', 4, { "color" : "#123456" }), Text(u'</span>')],
                           tokenize(u'<span style="color:#123456">tou2</span> <span style="color:#123456">er4</span>'))
     
+    def testTokenizeHTMLLeavesParsedPinyinAlone(self):
+        tokenize(u'<span style="color:#123456">tou2</span>')
+        self.assertEquals(Pinyin.parse(u"tou2").htmlattrs, {})
+    
     def testTokenizeUnrecognisedHTML(self):
         self.assertEquals([Text(u'<b>'), Text(u'</b>')], tokenize(u'<b />'))
         self.assertEquals([Text(u'<span style="mehhhh!">'), Text("</span>")], tokenize(u'<span style="mehhhh!"></span>'))
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import unittest
+
+import cjklib.dbconnector
+import sqlalchemy
+
+import pinyin.db
+from pinyin.db.pool import *
+from pinyin.utils import withtempdir
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def testReusesConnectionWithinThread(self):
+        connects, pool = self.makepool()
+        self.assertTrue(pool() is pool())
+        self.assertEquals(len(connects), 1)
+    
+    def testConnectionPerThread(self):
+        connects, pool = self.makepool()
+        connectors = [pool()]
+        
+        thread = threading.Thread(target=lambda: connectors.append(pool()))
+        thread.start()
+        thread.join()
+        
+        self.assertEquals(len(connects), 2)
+        self.assertFalse(connectors[0] is connectors[1])
+    
+    def testForwardsAttributes(self):
+        connects, pool = self.makepool()
+        self.assertEquals(pool.name, "Connector 1")
+    
+    def testResetReconnects(self):
+        connects, pool = self.makepool()
+        old = pool()
+        pool.reset()
+        
+        self.assertFalse(pool() is old)
+        self.assertTrue(old.connection.closed)
+        self.assertEquals(len(connects), 2)
+    
+    # Test helpers
+    def makepool(self):
+        connects = []
+        def connect():
+            connects.append(None)
+            return MockConnector("Connector %d" % len(connects))
+        
+        return connects, ConnectionPool(connect)
+
+class ReadOptimisedConnectionTest(unittest.TestCase):
+    def testAppliesPragmas(self):
+        def do(connector):
+            self.assertEquals(connector.selectScalar(sqlalchemy.text("PRAGMA query_only")), 1)
+            self.assertEquals(connector.selectScalar(sqlalchemy.text("PRAGMA temp_store")), 2)
+        
+        self.withdatabase(pinyin.db.connectreadoptimised, do)
+    
+    def testReadsButDoesNotWrite(self):
+        def do(connector):
+            self.assertEquals(connector.selectRows(sqlalchemy.text("SELECT * FROM Test")), [(1,)])
+            self.assertRaises(Exception, lambda: connector.execute("INSERT INTO Test VALUES (2)"))
+        
+        self.withdatabase(pinyin.db.connectreadoptimised, do)
+    
+    def testDefaultModeLeavesSettingsAlone(self):
+        self.withdatabase(pinyin.db.connectdefault, lambda connector: self.assertEquals(connector.selectScalar(sqlalchemy.text("PRAGMA temp_store")), 0))
+    
+    def testReadOnlyModeOnlyStopsWrites(self):
+        def do(connector):
+            self.assertEquals(connector.selectScalar(sqlalchemy.text("PRAGMA temp_store")), 0)
+            self.assertEquals(connector.selectRows(sqlalchemy.text("SELECT * FROM Test")), [(1,)])
+            self.assertRaises(Exception, lambda: connector.execute("INSERT INTO Test VALUES (2)"))
+        
+        self.withdatabase(pinyin.db.connectreadonly, do)
+    
+    def testSwitchingModeResetsPool(self):
+        generation = pinyin.db.database.generation
+        try:
+            pinyin.db.setreadoptimised(False)
+            self.assertEquals(pinyin.db.database.generation, generation + 1)
+            self.assertFalse(pinyin.db.readoptimised)
+            
+            # Nothing to do if the mode doesn't change
+            pinyin.db.setreadoptimised(False)
+            self.assertEquals(pinyin.db.database.generation, generation + 1)
+        finally:
+            pinyin.db.setreadoptimised(True)
+    
+    # Test helpers
+    def withdatabase(self, connect, do):
+        def inner(path):
+            dbpath = os.path.join(path, u"tést.db")
+            writer = cjklib.dbconnector.DatabaseConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) })
+            writer.execute("CREATE TABLE Test (Column INTEGER)")
+            writer.execute("INSERT INTO Test VALUES (1)")
+            writer.connection.close()
+            
+            do(connect(dbpath))
+            
+            # Opening the file must not have left any journal or stray database file behind
+            self.assertEquals(len(os.listdir(path)), 1)
+        
+        withtempdir(inner)
+
+class InstallDatabaseTest(unittest.TestCase):
+    def testInstallReplacesFiles(self):
+        def do(path):
+            built, installed = self.makefiles(path)
+            
+            generation = pinyin.db.database.generation
+            reader = pinyin.db.connectreadoptimised(installed[0])
+            try:
+                self.assertEquals(reader.selectScalar(sqlalchemy.text("SELECT * FROM Test")), 1)
+                self.assertEquals(pinyin.db.installdatabase(zip(built, installed)), True)
+                
+                # Connections that were already open carry on reading the old file, but the pool will reconnect
+                self.assertEquals(reader.selectScalar(sqlalchemy.text("SELECT * FROM Test")), 1)
+                self.assertEquals(pinyin.db.database.generation, generation + 1)
+            finally:
+                reader.connection.close()
+            
+            reader = pinyin.db.connectreadoptimised(installed[0])
+            try:
+                self.assertEquals(reader.selectScalar(sqlalchemy.text("SELECT * FROM Test")), 2)
+            finally:
+                reader.connection.close()
+            
+            self.assertEquals(self.read(installed[1]), "new image")
+            self.assertTrue(os.path.getmtime(installed[1]) >= os.path.getmtime(installed[0]))
+            self.assertNoStagedFiles(installed)
+        
+        withtempdir(do)
+    
+    def testCorruptDatabaseIsNotInstalled(self):
+        def do(path):
+            built, installed = self.makefiles(path)
+            self.write(built[0], "not a database")
+            
+            generation = pinyin.db.database.generation
+            self.assertRaises(ValueError, lambda: pinyin.db.installdatabase(zip(built, installed)))
+            self.assertEquals(pinyin.db.database.generation, generation)
+            self.assertEquals(self.read(installed[1]), "old image")
+            self.assertNoStagedFiles(installed)
+        
+        withtempdir(do)
+    
+    def testInstallStaged(self):
+        def do(path):
+            built, installed = self.makefiles(path)
+            
+            # Nothing to do if nothing was left behind
+            self.assertEquals(pinyin.db.installstaged(installed), False)
+            self.assertEquals(self.read(installed[1]), "old image")
+            
+            for builtpath, installedpath in zip(built, installed):
+                os.rename(builtpath, pinyin.db.stagedpath(installedpath))
+            
+            pinyin.db.installstaged(installed)
+            self.assertEquals(self.read(installed[1]), "new image")
+            self.assertNoStagedFiles(installed)
+        
+        withtempdir(do)
+    
+    def testInstallsNothingUnlessEveryFileCanBeReplaced(self):
+        def do(path):
+            built, installed = self.makefiles(path)
+            
+            # Pretend that we are on Windows, and that the database is open so we can't move it
+            def rename(source, target):
+                if source == installed[0]:
+                    raise OSError("The database is in use")
+                originalrename(source, target)
+            
+            originalrename, originalreplacesopenfiles = os.rename, pinyin.db.replacesopenfiles
+            os.rename, pinyin.db.replacesopenfiles = rename, False
+            try:
+                generation = pinyin.db.database.generation
+                self.assertEquals(pinyin.db.installdatabase(zip(built, installed)), False)
+                self.assertEquals(pinyin.db.database.generation, generation)
+            finally:
+                os.rename, pinyin.db.replacesopenfiles = originalrename, originalreplacesopenfiles
+            
+            self.assertEquals(self.read(installed[1]), "old image")
+            for installedpath in installed:
+                self.assertTrue(os.path.exists(pinyin.db.stagedpath(installedpath)))
+                self.assertFalse(os.path.exists(pinyin.db.asidepath(installedpath)))
+            
+            # Once the database has been closed, next time round we can install it all
+            pinyin.db.replacesopenfiles = False
+            try:
+                self.assertEquals(pinyin.db.installstaged(installed), True)
+            finally:
+                pinyin.db.replacesopenfiles = originalreplacesopenfiles
+            
+            self.assertEquals(self.read(installed[1]), "new image")
+            self.assertNoStagedFiles(installed)
+            for installedpath in installed:
+                self.assertFalse(os.path.exists(pinyin.db.asidepath(installedpath)))
+        
+        withtempdir(do)
+    
+    # Test helpers
+    def makefiles(self, path):
+        built = [os.path.join(path, "built.db"), os.path.join(path, "built.dictimage")]
+        installed = [os.path.join(path, "installed.db"), os.path.join(path, "installed.dictimage")]
+        for dbpath, value in [(built[0], 2), (installed[0], 1)]:
+            writer = cjklib.dbconnector.DatabaseConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) })
+            writer.execute("CREATE TABLE Test (Column INTEGER)")
+            writer.execute("INSERT INTO Test VALUES (%d)" % value)
+            writer.connection.close()
+            writer.engine.dispose()
+        
+        self.write(built[1], "new image")
+        self.write(installed[1], "old image")
+        return built, installed
+    
+    def assertNoStagedFiles(self, paths):
+        for path in paths:
+            self.assertFalse(os.path.exists(pinyin.db.stagedpath(path)))
+    
+    def read(self, path):
+        file = open(path, "rb")
+        try:
+            return file.read()
+        finally:
+            file.close()
+    
+    def write(self, path, contents):
+        file = open(path, "wb")
+        try:
+            file.write(contents)
+        finally:
+            file.close()
+
+class MockConnection(object):
+    def __init__(self):
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
+
+class MockConnector(object):
+    def __init__(self, name):
+        self.name = name
+        self.connection = MockConnection()
+        self.engine = self
+    
+    def dispose(self):
+        pass
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from pinyin.trie import *
+
+
+class TrieTest(unittest.TestCase):
+    def testEmpty(self):
+        trie = Trie()
+        self.assertEquals(len(trie), 0)
+        self.assertFalse(trie.isprefix(u"你"))
+    
+    def testContains(self):
+        trie = Trie([u"你好", u"你"])
+        self.assertTrue(u"你" in trie)
+        self.assertTrue(u"你好" in trie)
+        self.assertFalse(u"好" in trie)
+        self.assertEquals(len(trie), 2)
+    
+    def testPrefixesAreNotWords(self):
+        trie = Trie([u"图书馆"])
+        self.assertTrue(trie.isprefix(u"图书"))
+        self.assertFalse(u"图书" in trie)
+    
+    def testAddingPrefixLaterKeepsWord(self):
+        trie = Trie([u"图书", u"图"])
+        self.assertTrue(u"图书" in trie)
+        self.assertTrue(u"图" in trie)
+    
+    def testDiscard(self):
+        trie = Trie([u"图", u"图书馆"])
+        trie.discard(u"图书馆")
+        trie.discard(u"书")
+        self.assertFalse(u"图书馆" in trie)
+        self.assertTrue(u"图" in trie)
+        self.assertTrue(trie.isprefix(u"图书馆"))
@@ -55,6 +55,16 @@ class SortingTest(unittest.TestCase):
         self.assertEquals(sorted([(3, 2), (1, 2), (1, 1), (3, 1), (2, 0)], lexically(inReverse())), [(3, 1), (3, 2), (2, 0), (1, 1), (1, 2)])
         self.assertEquals(sorted([(3, 2), (1, 2), (1, 1), (3, 1), (2, 0)], lexically(inReverse(), inReverse())), [(3, 2), (3, 1), (2, 0), (1, 2), (1, 1)])
 
+class ChunkedTest(unittest.TestCase):
+    def testChunkedEmpty(self):
+        self.assertEquals(list(chunked([], 2)), [])
+    
+    def testChunked(self):
+        self.assertEquals(list(chunked([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
+    
+    def testChunkedIterator(self):
+        self.assertEquals(list(chunked(iter(range(5)), 3)), [[0, 1, 2], [3, 4]])
+
 class HeadOrTest(unittest.TestCase):
     def testHeadOrNonEmpty(self):
         self.assertEquals(heador([1], "Another"), 1)
@@ -127,6 +137,21 @@ class TouchTest(unittest.TestCase):
         
         withtempdir(do)
 
+class FileMD5Test(unittest.TestCase):
+    def testMatchesMD5OfContents(self):
+        def do(path):
+            filepath = os.path.join(path, "Dictionary")
+            contents = "".join(["%d\n" % n for n in range(10000)])
+            file = open(filepath, "wb")
+            try:
+                file.write(contents)
+            finally:
+                file.close()
+            
+            self.assertEquals(filemd5(filepath, chunksize=1000), md5(contents))
+        
+        withtempdir(do)
+
 class ThunkTest(unittest.TestCase):
     def testCall(self):
         self.assertEquals(Thunk(lambda: 5)(), 5)
@@ -139,6 +164,16 @@ class ThunkTest(unittest.TestCase):
         delay.append(Thunk(lambda: delay[0].attribute))
         self.assertRaises(ValueError, lambda: delay[0]())
 
+class SynchronizedThunkTest(unittest.TestCase):
+    def testComputesOnce(self):
+        calls = []
+        thunk = SynchronizedThunk(lambda: calls.append(1) or len(calls))
+        self.assertEquals([thunk(), thunk(), thunk()], [1, 1, 1])
+        self.assertEquals(calls, [1])
+    
+    def testTransparency(self):
+        self.assertEquals(SynchronizedThunk(lambda: "hello!").rstrip("!"), "hello")
+
 class RegexParseTest(unittest.TestCase):
     def testParseSimple(self):
         self.assertEquals(self.parse(re.compile("foo"), "foo bar foo bar"),
@@ -176,4 +211,65 @@ class FactoryDictTest(unittest.TestCase):
         
         dict[3] = "Bye"
         self.assertEquals(dict[2], "Hello")
-        self.assertEquals(dict[3], "Bye")
\ No newline at end of file
+        self.assertEquals(dict[3], "Bye")
+
+class LRUCacheTest(unittest.TestCase):
+    def testHitAndMiss(self):
+        cache = LRUCache(2)
+        cache[1] = "one"
+        self.assertEquals(cache.get(1), "one")
+        self.assertEquals(cache.get(2), None)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+    
+    def testEvictsLeastRecentlyUsed(self):
+        cache = LRUCache(2)
+        cache[1] = "one"
+        cache[2] = "two"
+        cache.get(1)
+        cache[3] = "three"
+        
+        self.assertTrue(1 in cache)
+        self.assertFalse(2 in cache)
+        self.assertTrue(3 in cache)
+        self.assertEquals(cache.evictions, 1)
+    
+    def testOverwrite(self):
+        cache = LRUCache(2)
+        cache[1] = "one"
+        cache[1] = "uno"
+        self.assertEquals(len(cache), 1)
+        self.assertEquals(cache.get(1), "uno")
+    
+    def testCachesFalsyValues(self):
+        cache = LRUCache(1)
+        cache[1] = []
+        self.assertEquals(cache.get(1, "missing"), [])
+    
+    def testZeroCapacityDisables(self):
+        cache = LRUCache(0)
+        cache[1] = "one"
+        self.assertEquals(len(cache), 0)
+    
+    def testInvalidateAndClear(self):
+        cache = LRUCache(3)
+        for n in range(3):
+            cache[n] = n
+        
+        cache.invalidate([0, 5])
+        self.assertEquals(len(cache), 2)
+        self.assertFalse(0 in cache)
+        
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+        cache[4] = 4
+        self.assertEquals(cache.get(4), 4)
+    
+    def testResize(self):
+        cache = LRUCache(3)
+        for n in range(3):
+            cache[n] = n
+        
+        cache.resize(1)
+        self.assertEquals(len(cache), 1)
+        self.assertTrue(2 in cache)
+        self.assertEquals(cache.stats()["evictions"], 2)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A prefix trie over dictionary headwords, used to segment text by maximal munch.
+
+To keep the memory overhead down when we load hundreds of thousands of headwords,
+the trie is stored flat: we map every prefix of every word to a flag recording
+whether a complete word ends there. Walking the trie from some position in a
+string then costs one dictionary probe per character.
+"""
+class Trie(object):
+    def __init__(self, words=[]):
+        self.nodes = {}
+        self.maxwordlen = 0
+
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len([isword for isword in self.nodes.values() if isword])
+
+    def __contains__(self, word):
+        return self.nodes.get(word, False)
+
+    def add(self, word):
+        if len(word) == 0:
+            return
+
+        # NB: be careful not to demote an existing word to a mere prefix
+        for prefixlen in range(1, len(word)):
+            self.nodes.setdefault(word[:prefixlen], False)
+        self.nodes[word] = True
+
+        self.maxwordlen = max(self.maxwordlen, len(word))
+
+    """
+    Stop treating the word as a word. We leave it in place as a prefix, which may now be
+    the prefix of nothing: harmless, since walks are always confirmed against real words.
+    """
+    def discard(self, word):
+        if self.nodes.get(word):
+            self.nodes[word] = False
+
+    def isprefix(self, text):
+        return text in self.nodes
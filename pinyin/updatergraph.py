@@ -114,7 +114,7 @@ class GraphBasedUpdater(object):
         self.notifier = notifier
         self.mediamanager = mediamanager
         self.config = config
-        self.dictionaries = dictionary.PinyinDictionary.loadall()
+        self.dictionaries = dictionary.PinyinDictionary.loadall(config.dictionarycachesize, config.dictionaryfalsepositiverate)
         
         self.updaters = [
                 ("simptrad", self.expression2simptrad, ("expression",)),
@@ -7,6 +7,7 @@ import re
 import sys
 import string
 import getpass
+import threading
 import unicodedata
 
 """
@@ -161,6 +162,17 @@ Create an empty file at the given location.
 def touch(where):
     open(where, 'w').close()
 
+"""
+Returns something that changes whenever the file at the path is modified, or None if there is no such file.
+"""
+def filesignature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    
+    return (stat.st_mtime, stat.st_size)
+
 """
 Find the hex-format MD5 digest of the input.
 """
@@ -176,6 +188,28 @@ def md5(what):
     import md5
     return md5.new(what).hexdigest()
 
+"""
+Find the hex-format MD5 digest of the contents of the file at the path, which we read a chunk at a time.
+"""
+def filemd5(path, chunksize=64 * 1024):
+    try:
+        import hashlib
+        digest = hashlib.md5()
+    except ImportError:
+        import md5
+        digest = md5.new()
+    
+    file = open(path, "rb")
+    try:
+        chunk = file.read(chunksize)
+        while chunk:
+            digest.update(chunk)
+            chunk = file.read(chunksize)
+    finally:
+        file.close()
+    
+    return digest.hexdigest()
+
 """
 Lazy evaluation: defer evaluation of the function, then cache the result.
 """
@@ -215,6 +249,29 @@ class Thunk(object):
     def __getattr__(self, name):
         return getattr(self.__call__(), name)
 
+"""
+A Thunk that can safely be forced from several threads at once: the first thread in does
+the computation, and any others wait for it to finish rather than seeing a black hole.
+"""
+class SynchronizedThunk(Thunk):
+    def __init__(self, function):
+        Thunk.__init__(self, function)
+        self.__lock = threading.RLock()
+        self.__computed = False
+    
+    def __call__(self):
+        # Once the result is in it never changes, so there is nothing left to wait for
+        if self.__computed:
+            return Thunk.__call__(self)
+        
+        self.__lock.acquire()
+        try:
+            result = Thunk.__call__(self)
+            self.__computed = True
+            return result
+        finally:
+            self.__lock.release()
+
 """
 Use the regex to parse the text, alternately yielding match objects and strings
 """
@@ -442,6 +499,18 @@ def substrings(text):
         for i in range(0, len(text) - length):
             yield text[i:i+length+1]
 
+"""
+Split a list (or any other iterable) up into consecutive lists of at most the given size.
+"""
+def chunked(xs, size):
+    iterator = iter(xs)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        
+        yield chunk
+
 def marklast(things):
     for i, thing in enumerate(things):
         yield (i == len(things) - 1), thing
@@ -560,6 +629,117 @@ class FactoryDict(dict):
             self[key] = value
             return value
 
+"""
+A dictionary that holds on to at most a fixed number of items, evicting the least recently used
+one to make room for new ones. A capacity of zero disables the cache entirely.
+
+We keep counts of hits, misses and evictions so that we can tell whether the cache is pulling its weight.
+The cache may be shared between threads.
+"""
+class LRUCache(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        
+        # Maps keys to the links of a circular doubly linked list of [previous, next, key, value], which
+        # is kept in order of use: the most recently used link is next to the sentinel on the previous side
+        self.links = {}
+        self.sentinel = []
+        self.sentinel[:] = [self.sentinel, self.sentinel, None, None]
+        
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.links)
+    
+    def __contains__(self, key):
+        return key in self.links
+    
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            
+            self.hits += 1
+            self.unlink(link)
+            self.linkmostrecent(link)
+            return link[3]
+        finally:
+            self.lock.release()
+    
+    def __setitem__(self, key, value):
+        if self.capacity <= 0:
+            return
+        
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is not None:
+                self.unlink(link)
+                link[3] = value
+            else:
+                link = [None, None, key, value]
+                self.links[key] = link
+            
+            self.linkmostrecent(link)
+            self.evict()
+        finally:
+            self.lock.release()
+    
+    def invalidate(self, keys):
+        self.lock.acquire()
+        try:
+            for key in keys:
+                link = self.links.pop(key, None)
+                if link is not None:
+                    self.unlink(link)
+        finally:
+            self.lock.release()
+    
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.links = {}
+            self.sentinel[:] = [self.sentinel, self.sentinel, None, None]
+        finally:
+            self.lock.release()
+    
+    def resize(self, capacity):
+        self.lock.acquire()
+        try:
+            self.capacity = capacity
+            self.evict()
+        finally:
+            self.lock.release()
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return { "size" : len(self.links), "capacity" : self.capacity, "hits" : self.hits, "misses" : self.misses,
+                 "evictions" : self.evictions, "hitrate" : lookups and float(self.hits) / lookups or 0.0 }
+    
+    # Internal helpers for maintaining the list: only call these with the lock held
+    
+    def unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+    
+    def linkmostrecent(self, link):
+        last = self.sentinel[0]
+        link[0], link[1] = last, self.sentinel
+        last[1] = link
+        self.sentinel[0] = link
+    
+    def evict(self):
+        while len(self.links) > max(self.capacity, 0):
+            leastrecent = self.sentinel[1]
+            self.unlink(leastrecent)
+            del self.links[leastrecent[2]]
+            self.evictions += 1
+
 """
 Monadic bind in the Maybe monad (embedded into Python 'None's)
 """